@@ -0,0 +1,444 @@
+import hashlib
+import json
+import os
+import pathlib
+import threading
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from lexical import LexicalIndex, char_ngrams
+from metrics import registry
+from retrieval import RetrievalBackend, create_backend
+
+
+lexical_queries_metric = registry.counter('katyax_lexical_queries_total', 'Count of questions passed through lexical prefilter')
+lexical_hits_metric = registry.counter('katyax_lexical_hits_total', 'Count of questions answered or shortlisted by lexical prefilter')
+lexical_shortcuts_metric = registry.counter('katyax_lexical_shortcuts_total', 'Count of questions answered without model call')
+
+
+def parse_md_answers(path) -> List[str]:
+    """
+    Load and parse markdown file with answers separated by ---
+
+    :param path: path to markdown file
+
+    :returns: list of answers
+    """
+    with open(path, 'r') as f:
+        lines = f.readlines()
+
+    # split answers by ---
+    answers = []
+    answer = []
+    for line in lines:
+        if line == '---\n':
+            answers.append(answer)
+            answer = []
+        else:
+            answer.append(line)
+
+    answers.append(answer)
+
+    return [x[0] for x in answers]
+
+
+def hash_text(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+@dataclass
+class Candidates:
+    version: int
+    ids: np.ndarray
+
+
+@dataclass
+class IndexSnapshot:
+    answers: List[str]
+    embeddings: np.ndarray
+    entry_hashes: List[str]
+    content_hash: str
+    version: int = 0
+    backend: Optional[RetrievalBackend] = None
+    lexical: Optional[LexicalIndex] = None
+    rows: Dict[str, int] = field(default_factory=dict)
+
+    def __post_init__(self):
+        self.rows = {h: i for i, h in enumerate(self.entry_hashes)}
+
+    def top_k(self, query_embeddings: np.ndarray, k: int = 1) -> List[List[Tuple[int, float]]]:
+        """
+        Find k nearest answers for every normalized query embedding
+
+        :param query_embeddings: matrix of normalized query embeddings
+
+        :param k: count of answers for every query
+
+        :returns: list of (answer index, score) pairs for every query
+        """
+        indices, scores = self.backend.top_k(query_embeddings, k)
+        return [[(int(i), float(s)) for i, s in zip(row_indices, row_scores) if i >= 0] for row_indices, row_scores in zip(indices, scores)]
+
+    def search(self, query_embedding: np.ndarray) -> int:
+        """
+        Find best answer for normalized query embedding
+
+        :param query_embedding: normalized query embedding
+
+        :returns: index of answer
+        """
+        return int(self.search_batch(np.atleast_2d(query_embedding))[0])
+
+    def search_batch(self, query_embeddings: np.ndarray, candidates: List[Optional[Candidates]] = None) -> np.ndarray:
+        """
+        Find best answers for matrix of normalized query embeddings
+
+        :param query_embeddings: matrix of normalized query embeddings
+
+        :param candidates: shortlist for every query, only shortlisted answers are scored
+
+        :returns: indexes of answers
+        """
+        queries = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+        result = np.empty(len(queries), dtype=np.int64)
+
+        full_search = []
+        for i, query in enumerate(queries):
+            shortlist = candidates[i] if candidates else None
+
+            # shortlist of another index version points to other rows
+            if shortlist is not None and shortlist.version == self.version:
+                result[i] = shortlist.ids[np.argmax(self.embeddings[shortlist.ids] @ query)]
+            else:
+                full_search.append(i)
+
+        if full_search:
+            indices, _ = self.backend.top_k(queries[full_search], 1)
+            result[full_search] = indices[:, 0]
+
+            # approximate backend may find nothing, -1 must not select the last answer
+            for i in np.flatnonzero(result[full_search] < 0):
+                i = full_search[i]
+                result[i] = np.argmax(self.embeddings @ queries[i])
+
+        return result
+
+
+class AnswerIndex:
+    def __init__(self, model_id: str, cache_dir: str = None, backend: str = None):
+        self.model_id = model_id
+        self.backend = backend
+
+        self.lexical_prefilter = os.getenv('LEXICAL_PREFILTER', '1') == '1'
+        self.shortlist_size = int(os.getenv('LEXICAL_SHORTLIST_SIZE', 50))
+        self.shortcut_threshold = float(os.getenv('LEXICAL_SHORTCUT_THRESHOLD', .95))
+        self.shortcut_min_ngrams = 12
+
+        # generic questions are contained in many answers, shortcut needs a clear winner
+        self.shortcut_margin = float(os.getenv('LEXICAL_SHORTCUT_MARGIN', 1.5))
+        self.shortcut_coverage = float(os.getenv('LEXICAL_SHORTCUT_COVERAGE', .8))
+
+        cache_dir = cache_dir or os.getenv('ANSWERS_INDEX_DIR') or os.path.join(os.getenv('SENTENCE_TRANSFORMERS_HOME', '.cache'), 'answers_index')
+        self.cache_dir = pathlib.Path(cache_dir)
+
+        # readers grab the snapshot once, reloads replace it with a single assignment
+        self.snapshot: Optional[IndexSnapshot] = None
+        self._reload_lock = threading.Lock()
+
+    @property
+    def answers(self) -> List[str]:
+        return self.snapshot.answers if self.snapshot else []
+
+    @property
+    def embeddings(self) -> Optional[np.ndarray]:
+        return self.snapshot.embeddings if self.snapshot else None
+
+    @property
+    def version(self) -> int:
+        return self.snapshot.version if self.snapshot else 0
+
+    @staticmethod
+    def hash_file(path) -> str:
+        """
+        Get content hash of file
+
+        :param path: path to file
+
+        :returns: sha256 hex digest
+        """
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 16), b''):
+                digest.update(chunk)
+
+        return digest.hexdigest()
+
+    @property
+    def model_slug(self) -> str:
+        return self.model_id.replace('/', '__')
+
+    def index_path(self, content_hash: str) -> pathlib.Path:
+        """
+        Get path of persisted index for model and content hash
+
+        :param content_hash: content hash of answers file
+
+        :returns: path to .npy matrix
+        """
+        return self.cache_dir / f'{self.model_slug}-{content_hash}.npy'
+
+    def load_or_build(self, answers: List[str], content_hash: str, encode: Callable[[List[str]], np.ndarray]) -> int:
+        """
+        Load persisted index from disk or build it with encoder and persist.
+        Only answers, which are missing in the previous index, are encoded
+
+        :param answers: parsed answers
+
+        :param content_hash: content hash of answers file
+
+        :param encode: function, that returns normalized embeddings for list of texts
+
+        :returns: count of encoded answers
+        """
+        with self._reload_lock:
+            if self.snapshot is not None and self.snapshot.content_hash == content_hash:
+                return 0
+
+            entry_hashes = [hash_text(x) for x in answers]
+            path = self.index_path(content_hash)
+
+            embeddings = self._load(path, entry_hashes)
+            encoded = 0
+
+            if embeddings is None:
+                previous = self.snapshot or self._load_latest()
+                matrix, encoded = self._build(answers, entry_hashes, previous, encode)
+                self.save(path, matrix, entry_hashes)
+                embeddings = np.load(path, mmap_mode='r')
+
+            version = self.snapshot.version + 1 if self.snapshot else 1
+            self.use(answers, embeddings, content_hash, version)
+
+            return encoded
+
+    def use(self, answers: List[str], embeddings: np.ndarray, content_hash: str, version: int):
+        """
+        Replace current snapshot with ready embeddings, e.g. from shared memory
+
+        :param answers: parsed answers
+
+        :param embeddings: matrix of normalized answer embeddings
+
+        :param content_hash: content hash of answers file
+
+        :param version: version of index
+
+        :returns: None
+        """
+        entry_hashes = [hash_text(x) for x in answers]
+        backend = create_backend(embeddings, self.backend)
+        lexical = LexicalIndex(answers) if self.lexical_prefilter else None
+
+        self.snapshot = IndexSnapshot(answers, embeddings, entry_hashes, content_hash, version, backend, lexical)
+
+    def _build(self, answers: List[str], entry_hashes: List[str], previous: Optional[IndexSnapshot], encode):
+        """
+        Build matrix reusing rows of previous snapshot
+
+        :returns: matrix and count of encoded answers
+        """
+        rows = previous.rows if previous else {}
+        missing = [i for i, h in enumerate(entry_hashes) if h not in rows]
+
+        new_embeddings = None
+        if missing:
+            new_embeddings = np.asarray(encode(['<A>' + answers[i] for i in missing]), dtype=np.float32)
+
+        if previous is not None and len(missing) < len(answers):
+            dim = previous.embeddings.shape[1]
+        else:
+            dim = new_embeddings.shape[1]
+
+        matrix = np.empty((len(answers), dim), dtype=np.float32)
+        for i, h in enumerate(entry_hashes):
+            if h in rows:
+                matrix[i] = previous.embeddings[rows[h]]
+
+        if missing:
+            matrix[missing] = new_embeddings
+
+        return matrix, len(missing)
+
+    def _load(self, path: pathlib.Path, entry_hashes: List[str]) -> Optional[np.ndarray]:
+        if not path.exists():
+            return None
+
+        embeddings = np.load(path, mmap_mode='r')
+
+        # stale or broken file, rebuild it
+        if embeddings.ndim != 2 or embeddings.shape[0] != len(entry_hashes):
+            return None
+
+        return embeddings
+
+    def _load_latest(self) -> Optional[IndexSnapshot]:
+        """
+        Load most recent persisted index of this model to reuse its rows
+
+        :returns: snapshot or None
+        """
+        candidates = sorted(self.cache_dir.glob(f'{self.model_slug}-*.npy'), key=lambda x: x.stat().st_mtime, reverse=True)
+        for path in candidates:
+            hashes_path = path.with_suffix('.json')
+            if not hashes_path.exists():
+                continue
+
+            with open(hashes_path, 'r') as f:
+                entry_hashes = json.load(f)
+
+            embeddings = self._load(path, entry_hashes)
+            if embeddings is not None:
+                return IndexSnapshot([], embeddings, entry_hashes, path.stem)
+
+        return None
+
+    def save(self, path: pathlib.Path, matrix: np.ndarray, entry_hashes: List[str]):
+        """
+        Atomically write matrix with entry hashes to disk and remove stale indexes of this model
+
+        :param path: destination path
+
+        :param matrix: embeddings matrix
+
+        :param entry_hashes: content hashes of answers
+
+        :returns: None
+        """
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_suffix = f'.{os.getpid()}.tmp'
+
+        hashes_path = path.with_suffix('.json')
+        with open(str(hashes_path) + tmp_suffix, 'w') as f:
+            json.dump(entry_hashes, f)
+        os.replace(str(hashes_path) + tmp_suffix, hashes_path)
+
+        with open(str(path) + tmp_suffix, 'wb') as f:
+            np.save(f, matrix)
+        os.replace(str(path) + tmp_suffix, path)
+
+        # mapped files stay readable after unlink, so running readers are safe
+        for stale in self.cache_dir.glob(f'{self.model_slug}-*'):
+            if stale.stem != path.stem and not stale.name.endswith('.tmp'):
+                stale.unlink(missing_ok=True)
+
+    def search(self, query_embedding: np.ndarray) -> str:
+        """
+        Find best answer for normalized query embedding
+
+        :param query_embedding: normalized query embedding
+
+        :returns: answer
+        """
+        snapshot = self.snapshot
+        return snapshot.answers[snapshot.search(query_embedding)]
+
+    def search_batch(self, query_embeddings: np.ndarray, candidates: List[Optional[Candidates]] = None) -> List[str]:
+        """
+        Find best answers for matrix of normalized query embeddings
+
+        :param query_embeddings: matrix of normalized query embeddings
+
+        :param candidates: shortlist for every query from prefilter
+
+        :returns: list of answers
+        """
+        snapshot = self.snapshot
+        return [snapshot.answers[x] for x in snapshot.search_batch(query_embeddings, candidates)]
+
+    def prefilter(self, question: str) -> Tuple[Optional[str], Optional[Candidates]]:
+        """
+        Match question against answers lexically. Near-verbatim questions are answered
+        right away, others get a shortlist of answers for semantic rerank
+
+        :param question: question from user
+
+        :returns: answer if lexical confidence is high and shortlist otherwise
+        """
+        snapshot = self.snapshot
+        if snapshot is None or snapshot.lexical is None:
+            return None, None
+
+        lexical_queries_metric.inc()
+
+        matches = snapshot.lexical.search(question, max(self.shortlist_size, 1))
+        if not matches:
+            return None, None
+
+        best, best_score = matches[0]
+        second_score = matches[1][1] if len(matches) > 1 else 0.0
+
+        # question is contained in the answer and points to it alone, not to several similar answers
+        contained = len(char_ngrams(question)) >= self.shortcut_min_ngrams and snapshot.lexical.containment(question, best) >= self.shortcut_threshold
+        distinct = best_score >= self.shortcut_margin * second_score or snapshot.lexical.coverage(question, best) >= self.shortcut_coverage
+
+        if contained and distinct:
+            lexical_hits_metric.inc()
+            lexical_shortcuts_metric.inc()
+            return snapshot.answers[best], None
+
+        # small corpus is searched fully, shortlist could only lose recall there
+        if self.shortlist_size <= 0 or len(snapshot.answers) <= self.shortlist_size:
+            return None, None
+
+        lexical_hits_metric.inc()
+        return None, Candidates(snapshot.version, np.array([x[0] for x in matches], dtype=np.int64))
+
+    def top_k(self, query_embedding: np.ndarray, k: int = 5) -> List[Tuple[str, float]]:
+        """
+        Find k best answers for normalized query embedding
+
+        :param query_embedding: normalized query embedding
+
+        :param k: count of answers
+
+        :returns: list of (answer, score) pairs sorted by score
+        """
+        snapshot = self.snapshot
+        return [(snapshot.answers[i], score) for i, score in snapshot.top_k(query_embedding, k)[0]]
+
+
+class FileWatcher(threading.Thread):
+    def __init__(self, path, callback: Callable[[], None], interval: float = 5.0):
+        super().__init__(name='file-watcher', daemon=True)
+        self.path = pathlib.Path(path)
+        self.callback = callback
+        self.interval = interval
+
+        self._stop_event = threading.Event()
+        self._last_stat = self._stat()
+
+    def _stat(self):
+        try:
+            stat = self.path.stat()
+        except FileNotFoundError:
+            return None
+
+        return stat.st_mtime_ns, stat.st_size
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            current = self._stat()
+            if current is None or current == self._last_stat:
+                continue
+
+            self._last_stat = current
+
+            try:
+                self.callback()
+            except Exception as e:
+                print(f'Failed to reload {self.path}: {e}')
+
+    def stop(self):
+        self._stop_event.set()
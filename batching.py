@@ -0,0 +1,110 @@
+import os
+import queue
+import threading
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from time import perf_counter
+from typing import Any, Callable, List
+
+import numpy as np
+
+from metrics import registry
+
+
+batch_size_metric = registry.histogram('katyax_inference_batch_size', 'Count of questions encoded in one forward pass', buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+batch_wait_metric = registry.histogram('katyax_inference_batch_wait_seconds', 'Time question waited in queue before its batch started')
+batch_latency_metric = registry.histogram('katyax_inference_batch_seconds', 'Time of batched encode and search')
+queue_depth_metric = registry.gauge('katyax_inference_queue_depth', 'Count of questions waiting for inference')
+
+
+@dataclass
+class InferenceRequest:
+    text: str
+    context: Any = None
+    future: Future = field(default_factory=Future)
+    enqueued_at: float = field(default_factory=perf_counter)
+
+
+class InferenceBatcher:
+    def __init__(self, encode: Callable[[List[str]], np.ndarray], search_batch: Callable[[np.ndarray, List[Any]], List[str]],
+                 max_batch_size: int = None, max_wait_ms: float = None):
+        self.encode = encode
+        self.search_batch = search_batch
+
+        self.max_batch_size = max_batch_size or int(os.getenv('BATCH_MAX_SIZE', 32))
+        self.max_wait = (max_wait_ms if max_wait_ms is not None else float(os.getenv('BATCH_MAX_WAIT_MS', 5))) / 1000
+
+        self._queue: 'queue.Queue[InferenceRequest]' = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name='inference-batcher', daemon=True)
+        self._worker.start()
+
+    def submit(self, text: str, context: Any = None) -> Future:
+        """
+        Put text to inference queue
+
+        :param text: text to encode and search
+
+        :param context: search context of text, e.g. shortlist of answers
+
+        :returns: future with answer
+        """
+        request = InferenceRequest(text, context)
+        self._queue.put(request)
+        queue_depth_metric.inc()
+
+        return request.future
+
+    def answer(self, text: str, context: Any = None, timeout: float = None) -> str:
+        """
+        Get answer for text, waiting for its batch
+
+        :param text: text to encode and search
+
+        :param context: search context of text
+
+        :param timeout: timeout in seconds
+
+        :returns: answer
+        """
+        return self.submit(text, context).result(timeout)
+
+    def _collect(self) -> List[InferenceRequest]:
+        batch = [self._queue.get()]
+        deadline = batch[0].enqueued_at + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - perf_counter()
+
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    # window is over, take only already queued questions
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+
+        queue_depth_metric.dec(len(batch))
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+
+            started_at = perf_counter()
+            for request in batch:
+                batch_wait_metric.observe(started_at - request.enqueued_at)
+            batch_size_metric.observe(len(batch))
+
+            try:
+                embeddings = self.encode([x.text for x in batch])
+                answers = self.search_batch(embeddings, [x.context for x in batch])
+            except Exception as e:
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            finally:
+                batch_latency_metric.observe(perf_counter() - started_at)
+
+            for request, answer in zip(batch, answers):
+                request.future.set_result(answer)
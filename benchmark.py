@@ -0,0 +1,643 @@
+import argparse
+import atexit
+import datetime
+import json
+import logging
+import math
+import os
+import pathlib
+import re
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, sleep, time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import requests
+import telebot
+from requests.adapters import HTTPAdapter
+
+
+BASEMENT = pathlib.Path(__file__).parent.absolute()
+
+SCENARIOS = ('faq_burst', 'escalation', 'long_polls')
+
+# frequent questions repeat, as they do in real bursts
+QUESTIONS = [
+    'Как оплатить обучение?',
+    'Где посмотреть расписание?',
+    'Как получить справку об обучении?',
+    'Когда начинается сессия?',
+    'Как восстановить пароль от личного кабинета?',
+    'Где находится общежитие?',
+    'Как перевестись на другой факультет?',
+    'Можно ли сдать экзамен досрочно?',
+]
+
+USER_BASE_ID = 1000000
+OPERATOR_BASE_ID = 9000000
+
+
+def percentile(values: List[float], q: float) -> float:
+    """
+    Get percentile by nearest rank
+
+    :param values: sorted values
+    :param q: percentile from 0 to 100
+
+    :returns: value or 0 for empty values
+    """
+    if not values:
+        return 0.
+
+    rank = max(0, min(len(values) - 1, math.ceil(q / 100 * len(values)) - 1))
+    return values[rank]
+
+
+def summarize(latencies: List[float], seconds: float, errors: int = 0) -> dict:
+    latencies = sorted(latencies)
+
+    return {
+        'count': len(latencies),
+        'errors': errors,
+        'throughput': len(latencies) / seconds if seconds else 0.,
+        'mean': sum(latencies) / len(latencies) if latencies else 0.,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'max': latencies[-1] if latencies else 0.,
+    }
+
+
+def current_rss_mb() -> float:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def git_commit() -> Tuple[str, bool]:
+    """
+    Get commit of working tree
+
+    :returns: commit hash and whether tree has uncommitted changes
+    """
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=BASEMENT, text=True).strip()
+        dirty = bool(subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=BASEMENT, text=True).strip())
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown', False
+
+    return commit, dirty
+
+
+class ResourceMeter:
+    """
+    CPU and memory of benchmark process during scenario.
+    Bot, webserver and load generators share the process, fake telegram api runs separately
+    """
+
+    def __enter__(self) -> 'ResourceMeter':
+        self.started_at = monotonic()
+        self.usage = resource.getrusage(resource.RUSAGE_SELF)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        self.seconds = monotonic() - self.started_at
+
+        cpu = (usage.ru_utime - self.usage.ru_utime) + (usage.ru_stime - self.usage.ru_stime)
+        self.result = {
+            'seconds': self.seconds,
+            'cpu_percent': 100 * cpu / self.seconds if self.seconds else 0.,
+            'rss_mb': current_rss_mb(),
+            'peak_rss_mb': usage.ru_maxrss / 1024,
+        }
+
+
+class SentLog:
+    """
+    Messages sent by bot, read from fake telegram api
+    """
+
+    def __init__(self, url: str):
+        self.url = url
+        self.records: List[dict] = []
+        self._next = 0
+
+        # replies to user messages by chat and id of question
+        self.replies: Dict[Tuple[int, int], dict] = {}
+
+        # merged messages are split back to lines
+        self.lines: Dict[Tuple[int, str], float] = {}
+
+        self.by_chat: Dict[int, List[dict]] = {}
+
+    def fetch(self):
+        data = requests.get(self.url + '/fake/sent', params={'since': self._next}).json()
+        self._next = data['next']
+
+        for record in data['sent']:
+            self.records.append(record)
+            self.by_chat.setdefault(record['chat_id'], []).append(record)
+
+            message = record['message']
+            if record['method'] != 'sendMessage':
+                continue
+
+            reply_to = message.get('reply_to_message')
+            if reply_to is not None:
+                self.replies.setdefault((record['chat_id'], reply_to['message_id']), record)
+
+            for line in message['text'].split('\n'):
+                self.lines.setdefault((record['chat_id'], line), record['time'])
+
+    def wait(self, done: Callable[[], bool], timeout: float) -> bool:
+        deadline = monotonic() + timeout
+
+        while True:
+            self.fetch()
+            if done():
+                return True
+
+            if monotonic() > deadline:
+                return False
+
+            sleep(.05)
+
+    def find(self, chat_id: int, prefix: str, after: float) -> Optional[dict]:
+        for record in self.by_chat.get(chat_id, []):
+            if record['time'] >= after and record['message']['text'].startswith(prefix):
+                return record
+
+        return None
+
+
+class Harness:
+    def __init__(self, args):
+        self.args = args
+
+        self.fake_url = f'http://127.0.0.1:{free_port()}'
+        self.fake = subprocess.Popen([sys.executable, str(BASEMENT / 'fake_telegram.py'), '--port', self.fake_url.rsplit(':', 1)[1],
+                                      '--latency', str(args.telegram_latency), '--threads', str(args.concurrency + 16)],
+                                     stdout=subprocess.DEVNULL)
+        atexit.register(self.fake.terminate)
+
+        self.web_port = free_port()
+        self.web_url = f'http://127.0.0.1:{self.web_port}'
+
+        # environment must be set before schemes module creates engine
+        os.environ['SQLITE_DB'] = args.database
+        os.environ['BOT_MODE'] = args.mode
+        os.environ['TELEGRAM_API_URL'] = self.fake_url
+        os.environ['REMOTE_ADDR'] = '127.0.0.1'
+        os.environ['FLASK_HOST'] = '127.0.0.1'
+        os.environ['FLASK_PORT'] = str(self.web_port)
+        # telegram delivers updates to webhook server of its own
+        webhook_port = free_port()
+        os.environ['WEBHOOK_HOST'] = '127.0.0.1'
+        os.environ['WEBHOOK_PORT'] = str(webhook_port)
+        os.environ['WEBHOOK_URL'] = f'http://127.0.0.1:{webhook_port}'
+        os.environ.setdefault('WEBHOOK_SECRET', 'benchmark')
+        os.environ.setdefault('BOT_TOKEN', '1:benchmark')
+        os.environ.setdefault('FLASK_SECRET', 'benchmark')
+        os.environ.setdefault('TOKEN_EXPIRE_MINUTES', '60')
+        os.environ.setdefault('MESSAGE_INGEST', args.ingest)
+
+        # every operator tab holds one thread of webserver
+        os.environ.setdefault('FLASK_THREADS', str(args.tabs + 16))
+
+        # limits of real telegram would be measured instead of the bot
+        os.environ.setdefault('TELEGRAM_CHAT_INTERVAL', '0')
+        os.environ.setdefault('TELEGRAM_GLOBAL_RATE', '10000')
+
+        self.wait_for_fake()
+
+        from sqlmodel import SQLModel
+        from sqlalchemy import update
+        from schemes import User, engine
+        from bot import EchoBot
+
+        self.engine = engine
+        if args.reset:
+            SQLModel.metadata.drop_all(engine)
+
+        self.bot = EchoBot(engine)
+
+        if args.pipeline == 'stub':
+            self.bot.ensure_pipeline = lambda: None
+            self.bot.watch_answers = lambda: None
+            self.bot.get_answer_pipeline = self.stub_answer
+            self._encode_lock = threading.Lock()
+
+        self.bot.setup()
+
+        operator_ids = [OPERATOR_BASE_ID + i for i in range(args.operators)]
+        for operator_id in operator_ids:
+            self.bot.create_or_get(operator_id)
+
+        with engine.begin() as connection:
+            connection.execute(update(User).where(User.telegram_id.in_(operator_ids)).values(is_operator=True))
+
+        self.bot.users.invalidate()
+
+        self.serve()
+        self.sent = SentLog(self.fake_url)
+
+        self.http = requests.Session()
+        self.http.mount('http://', HTTPAdapter(pool_maxsize=args.concurrency + args.tabs))
+
+        self._message_id = 0
+        self._lock = threading.Lock()
+
+        # operator tokens of tickets by telegram id of user
+        self.tickets: Dict[int, str] = {}
+
+    def stub_answer(self, question: str) -> str:
+        # one model worker without batching
+        with self._encode_lock:
+            sleep(self.args.encode_ms / 1000)
+
+        return f'Ответ на вопрос: {question}'
+
+    def wait_for_fake(self):
+        deadline = monotonic() + 10
+
+        while monotonic() < deadline:
+            try:
+                requests.get(self.fake_url + '/bot1:x/getMe')
+                return
+            except requests.ConnectionError:
+                sleep(.1)
+
+        raise RuntimeError('fake telegram api did not start')
+
+    def serve(self):
+        if self.args.mode == 'webhook':
+            threading.Thread(target=self.bot.serve_webhook, daemon=True).start()
+        else:
+            from wsgiserver import WSGIServer
+
+            server = WSGIServer(self.bot.webserver, host='127.0.0.1', port=self.web_port, numthreads=int(os.getenv('FLASK_THREADS')))
+            threading.Thread(target=server.start, daemon=True).start()
+
+            self.bot.bot.remove_webhook()
+            threading.Thread(target=self.bot.bot.infinity_polling, kwargs={'timeout': 999999}, daemon=True).start()
+
+        deadline = monotonic() + 10
+        while monotonic() < deadline:
+            try:
+                requests.get(self.web_url)
+                return
+            except requests.ConnectionError:
+                sleep(.1)
+
+        raise RuntimeError('webserver did not start')
+
+    def close(self):
+        # pending getUpdates request is broken by stopped fake api
+        telebot.logger.setLevel(logging.CRITICAL)
+        self.bot.bot.stop_polling()
+
+        self.fake.terminate()
+        self.fake.wait()
+
+    def next_message_id(self) -> int:
+        with self._lock:
+            self._message_id += 1
+            return self._message_id
+
+    def push(self, update: dict) -> Tuple[float, float]:
+        """
+        Send update to bot through fake api
+
+        :returns: time of sending and time of acknowledgement in seconds
+        """
+        started_at = time()
+        response = self.http.post(self.fake_url + '/fake/updates', json=update)
+        response.raise_for_status()
+
+        return started_at, time() - started_at
+
+    def ask(self, chat_id: int, text: str) -> Tuple[int, float, float]:
+        from fake_telegram import make_message_update
+
+        message_id = self.next_message_id()
+        started_at, ack = self.push(make_message_update(chat_id, text, message_id))
+
+        return message_id, started_at, ack
+
+
+def run_faq_burst(h: Harness) -> dict:
+    users = [USER_BASE_ID + i for i in range(h.args.users)]
+    jobs = [(x, QUESTIONS[(x + n) % len(QUESTIONS)]) for n in range(h.args.questions) for x in users]
+
+    with ResourceMeter() as meter:
+        with ThreadPoolExecutor(h.args.concurrency) as pool:
+            asked = list(pool.map(lambda x: (x[0],) + h.ask(*x), jobs))
+
+        h.sent.wait(lambda: all((x[0], x[1]) in h.sent.replies for x in asked), h.args.timeout)
+
+    replies = [(h.sent.replies.get((x[0], x[1])), x[2]) for x in asked]
+    latencies = [x['time'] - started_at for x, started_at in replies if x is not None]
+
+    return {
+        'metrics': {
+            'answer': summarize(latencies, meter.seconds, len(asked) - len(latencies)),
+            'ack': summarize([x[3] for x in asked], meter.seconds),
+        },
+        **meter.result,
+    }
+
+
+def run_escalation(h: Harness) -> dict:
+    from fake_telegram import make_callback_update
+
+    users = [USER_BASE_ID + i for i in range(h.args.users)]
+
+    # every user needs answer with keyboard to press not_helpful
+    questions = {}
+    for user in users:
+        reply = next((x for x in reversed(h.sent.by_chat.get(user, [])) if x['message'].get('reply_markup')), None)
+        if reply is None:
+            questions[user] = h.ask(user, QUESTIONS[user % len(QUESTIONS)])[0]
+
+    h.sent.wait(lambda: all((k, v) in h.sent.replies for k, v in questions.items()), h.args.timeout)
+    answers = {x: next(r for r in reversed(h.sent.by_chat.get(x, [])) if r['message'].get('reply_markup')) for x in users}
+
+    def escalate(user: int) -> Tuple[int, float, float]:
+        started_at, ack = h.push(make_callback_update(user, 'not_helpful', answers[user]['message']))
+        return user, started_at, ack
+
+    with ResourceMeter() as meter:
+        with ThreadPoolExecutor(h.args.concurrency) as pool:
+            escalated = list(pool.map(escalate, users))
+
+        def find(user, started_at):
+            return h.sent.find(user, 'Перенаправляю', started_at)
+
+        h.sent.wait(lambda: all(find(x, started_at) for x, started_at, _ in escalated), h.args.timeout)
+
+    latencies = [find(x, started_at)['time'] - started_at for x, started_at, _ in escalated if find(x, started_at)]
+
+    # operators get link to every ticket
+    h.sent.wait(lambda: len(operator_links(h)) >= len(users), 5)
+    h.tickets = operator_links(h)
+
+    return {
+        'metrics': {
+            'escalation': summarize(latencies, meter.seconds, len(escalated) - len(latencies)),
+            'ack': summarize([x[2] for x in escalated], meter.seconds),
+        },
+        **meter.result,
+    }
+
+
+def operator_links(h: Harness) -> Dict[int, str]:
+    links = {}
+    for record in h.sent.by_chat.get(OPERATOR_BASE_ID, []):
+        for line in record['message']['text'].split('\n'):
+            if '/' not in line:
+                continue
+
+            token = line.strip().rsplit('/', 1)[1]
+            ticket_id = h.bot.webserver.verify_token(token)['ticket_id']
+
+            user = h.bot.users.get(int(ticket_id.split('_')[1]))
+            if user is not None:
+                links[user.telegram_id] = token
+
+    return links
+
+
+def run_long_polls(h: Harness) -> dict:
+    if not h.tickets:
+        run_escalation(h)
+
+    tabs = list(h.tickets.items())[:h.args.tabs]
+
+    pending: Dict[str, float] = {}
+    replies: Dict[Tuple[int, str], float] = {}
+    latencies: Dict[str, List[float]] = {'user_to_operator': [], 'operator_to_user': [], 'chat': []}
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    senders = ThreadPoolExecutor(h.args.concurrency)
+
+    def reply(user: int, token: str, text: str):
+        text = text.replace('bench', 'reply')
+        with lock:
+            replies[(user, text)] = time()
+
+        h.http.post(f'{h.web_url}/{token}/send_message', data={'message': text})
+
+    def tab(user: int, token: str):
+        started_at = time()
+        page = h.http.get(f'{h.web_url}/{token}')
+        page.raise_for_status()
+
+        with lock:
+            latencies['chat'].append(time() - started_at)
+
+        # page polls from the last rendered message, then from the last delivered one
+        cursor = re.search(r"LIVE_CURSOR = '([^']*)'", page.text).group(1)
+
+        while not stop.is_set():
+            data = h.http.get(f'{h.web_url}/{token}/polling/{cursor}', params={'wait_for': 2}).json()
+            cursor = data.get('cursor', cursor)
+            received_at = time()
+
+            for message in data.get('messages', []):
+                with lock:
+                    sent_at = pending.pop(message['message'], None)
+
+                if sent_at is not None:
+                    with lock:
+                        latencies['user_to_operator'].append(received_at - sent_at)
+
+                    senders.submit(reply, user, token, message['message'])
+
+    def produce(user: int):
+        for n in range(h.args.messages):
+            text = f'bench {user} {n}'
+            with lock:
+                pending[text] = time()
+
+            h.ask(user, text)
+            sleep(h.args.interval)
+
+    with ResourceMeter() as meter:
+        tab_threads = [threading.Thread(target=tab, args=x, daemon=True) for x in tabs]
+        for thread in tab_threads:
+            thread.start()
+
+        # tabs are subscribed before users write
+        sleep(1)
+
+        with ThreadPoolExecutor(h.args.concurrency) as pool:
+            list(pool.map(produce, [x for x, _ in tabs]))
+
+        expected = len(tabs) * h.args.messages
+        h.sent.wait(lambda: not pending and len(replies) == expected and all(k in h.sent.lines for k in replies), h.args.timeout)
+
+        stop.set()
+        senders.shutdown()
+
+    for (user, text), sent_at in replies.items():
+        delivered_at = h.sent.lines.get((user, text))
+        if delivered_at is not None:
+            latencies['operator_to_user'].append(delivered_at - sent_at)
+
+    for thread in tab_threads:
+        thread.join(5)
+
+    return {
+        'metrics': {
+            'user_to_operator': summarize(latencies['user_to_operator'], meter.seconds, expected - len(latencies['user_to_operator'])),
+            'operator_to_user': summarize(latencies['operator_to_user'], meter.seconds, expected - len(latencies['operator_to_user'])),
+            'chat': summarize(latencies['chat'], meter.seconds, len(tabs) - len(latencies['chat'])),
+        },
+        'tabs': len(tabs),
+        **meter.result,
+    }
+
+
+def run(args):
+    if args.database is None:
+        args.database = f'sqlite:///{tempfile.mkdtemp(prefix="katyax-benchmark-")}/benchmark.sqlite'
+
+    scenarios = args.scenarios or list(SCENARIOS)
+    h = Harness(args)
+
+    try:
+        results = {}
+        for name in SCENARIOS:
+            if name not in scenarios:
+                continue
+
+            print(f'Running {name}...')
+            results[name] = globals()['run_' + name](h)
+            print(format_scenario(name, results[name]))
+    finally:
+        h.close()
+
+    commit, dirty = git_commit()
+    dialect = h.engine.dialect.name
+
+    report = {
+        'commit': commit,
+        'dirty': dirty,
+        'created_at': datetime.datetime.now().isoformat(),
+        'database': dialect,
+        'config': {k: v for k, v in vars(args).items() if k not in ('func', 'database', 'output')},
+        'env': {k: os.getenv(k) for k in ('BOT_WORKERS', 'BOT_QUEUE_SIZE', 'FLASK_THREADS', 'MESSAGE_BUS', 'MESSAGE_INGEST', 'TELEGRAM_SEND_WORKERS')},
+        'scenarios': results,
+    }
+
+    output = pathlib.Path(args.output)
+    output.mkdir(parents=True, exist_ok=True)
+
+    path = output / f'{commit[:12]}{"-dirty" if dirty else ""}_{dialect}_{args.mode}.json'
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print(f'Results are saved to {path}')
+
+
+def format_scenario(name: str, result: dict) -> str:
+    lines = [f'{name}: {result["seconds"]:.2f} s, cpu {result["cpu_percent"]:.0f}%, rss {result["rss_mb"]:.0f} MB, peak rss {result["peak_rss_mb"]:.0f} MB']
+
+    for metric, stats in result['metrics'].items():
+        lines.append(f'  {metric:<18} n={stats["count"]:<6} errors={stats["errors"]:<4} {stats["throughput"]:>8.1f}/s '
+                     f'p50={stats["p50"] * 1000:>8.1f}ms p95={stats["p95"] * 1000:>8.1f}ms p99={stats["p99"] * 1000:>8.1f}ms')
+
+    return '\n'.join(lines)
+
+
+def compare(args):
+    with open(args.base) as f:
+        base = json.load(f)
+
+    with open(args.new) as f:
+        new = json.load(f)
+
+    print(f'base {base["commit"][:12]} ({base["database"]}), new {new["commit"][:12]} ({new["database"]})')
+
+    def delta(a: float, b: float) -> str:
+        return f'{100 * (b - a) / a:+.1f}%' if a else 'n/a'
+
+    regressions = []
+
+    for name, result in new['scenarios'].items():
+        base_result = base['scenarios'].get(name)
+        if base_result is None:
+            continue
+
+        print(f'\n{name}')
+        print(f'  {"cpu_percent":<30} {base_result["cpu_percent"]:>10.1f} {result["cpu_percent"]:>10.1f} {delta(base_result["cpu_percent"], result["cpu_percent"]):>8}')
+        print(f'  {"peak_rss_mb":<30} {base_result["peak_rss_mb"]:>10.1f} {result["peak_rss_mb"]:>10.1f} {delta(base_result["peak_rss_mb"], result["peak_rss_mb"]):>8}')
+
+        for metric, stats in result['metrics'].items():
+            base_stats = base_result['metrics'].get(metric)
+            if base_stats is None:
+                continue
+
+            for key in ('throughput', 'p50', 'p95', 'p99', 'errors'):
+                scale = 1 if key in ('throughput', 'errors') else 1000
+                print(f'  {metric + "." + key:<30} {base_stats[key] * scale:>10.1f} {stats[key] * scale:>10.1f} {delta(base_stats[key], stats[key]):>8}')
+
+            if base_stats['p95'] and 100 * (stats['p95'] - base_stats['p95']) / base_stats['p95'] > args.max_regression:
+                regressions.append(f'{name}.{metric}.p95')
+
+    if regressions:
+        print(f'\np95 regressed more than {args.max_regression}%: {", ".join(regressions)}')
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test of bot and webserver with simulated users and operators')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='run scenarios and save results')
+    run_parser.add_argument('--database', default=None, help='database url, temporary SQLite by default')
+    run_parser.add_argument('--reset', action='store_true', help='drop all tables before run, use only with dedicated database')
+    run_parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=None)
+    run_parser.add_argument('--mode', choices=('polling', 'webhook'), default='polling')
+    run_parser.add_argument('--ingest', choices=('local', 'http'), default='http')
+    run_parser.add_argument('--pipeline', choices=('model', 'stub'), default='model', help='stub replaces model with fixed delay')
+    run_parser.add_argument('--encode-ms', type=float, default=20, help='delay of stub pipeline')
+    run_parser.add_argument('--users', type=int, default=100)
+    run_parser.add_argument('--questions', type=int, default=3, help='questions of every user in faq_burst')
+    run_parser.add_argument('--operators', type=int, default=1)
+    run_parser.add_argument('--tabs', type=int, default=50, help='open operator tabs in long_polls')
+    run_parser.add_argument('--messages', type=int, default=5, help='messages of every user in long_polls')
+    run_parser.add_argument('--interval', type=float, default=.5, help='seconds between messages of user in long_polls')
+    run_parser.add_argument('--concurrency', type=int, default=32, help='parallel clients sending updates')
+    run_parser.add_argument('--telegram-latency', type=float, default=.05, help='delay of every fake telegram api call')
+    run_parser.add_argument('--timeout', type=float, default=120, help='time to wait for all answers of scenario')
+    run_parser.add_argument('--output', default='benchmark_results')
+    run_parser.set_defaults(func=run)
+
+    compare_parser = subparsers.add_parser('compare', help='compare two saved results')
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--max-regression', type=float, default=float('inf'), help='fail if p95 grew more, in percent')
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,30 +1,68 @@
 import os
-from telebot import TeleBot
+from telebot import TeleBot, apihelper
 from telebot.types import Message, CallbackQuery
 from telebot import types
-from schemes import User, Message, UserTicket, ConversationThread, engine, create_conversation_table, add_conversation_message
-from webserver import WebServer
-from sqlmodel import SQLModel, create_engine, Session, select
-from sentence_transformers import SentenceTransformer, util
+from schemes import User, Message, engine, create_conversation, create_indexes, get_open_ticket
+from webserver import TelegramWebhook, WebServer
+from user_cache import UserCache
+from user_state import UserStateStore
+from telegram_sender import TelegramSender
+from message_ingest import INGEST_CLOSED, INGEST_FAILED, create_ingest
+from update_dispatcher import UpdateDispatcher
+from sqlmodel import SQLModel, select
+from sqlalchemy import update
+from unit_of_work import commit, session_scope, transactional
+from instrumentation import profiler, serve_metrics, timed
 import pathlib
-from typing import List
-import requests
-from time import sleep
+import threading
+from typing import List, TYPE_CHECKING
+
+# model stack is imported lazily in setup_pipeline, so processes, which never
+# answer questions (e.g. webserver), start without numpy and torch
+if TYPE_CHECKING:
+    from answer_index import AnswerIndex, FileWatcher
+    from batching import InferenceBatcher
+    from cache import AnswerCache
+    from encoders import Encoder
 
 
 class EchoBot:
     def __init__(self, engine):
-        self.bot = TeleBot(os.getenv('BOT_TOKEN'))
+        # e.g. local fake api for tests and benchmarks
+        if os.getenv('TELEGRAM_API_URL'):
+            apihelper.API_URL = os.getenv('TELEGRAM_API_URL').rstrip('/') + '/bot{0}/{1}'
+
+        # updates come from getUpdates or from webhook requests to webserver
+        self.mode = os.getenv('BOT_MODE', 'polling')
+
+        # updates are handled by dispatcher workers, telebot runs handlers in the calling thread
+        self.bot = TeleBot(os.getenv('BOT_TOKEN'), threaded=False)
+        self.dispatcher = UpdateDispatcher(lambda updates: TeleBot.process_new_updates(self.bot, updates))
+        self.bot.process_new_updates = self.receive_updates
+
+        # outgoing messages are sent by background workers within telegram rate limits
+        self.sender = TelegramSender(self.bot)
 
         self.model_id = 'clips/mfaq'
-        self.model: SentenceTransformer = None
+        self.model: 'Encoder' = None
+        self.remote_inference = False
 
         self.answers: List[str] = []
+        self.answer_index: 'AnswerIndex' = None
+        self.answers_watcher: 'FileWatcher' = None
+        self.batcher: 'InferenceBatcher' = None
+        self.answer_cache: 'AnswerCache' = None
+        self._pipeline_lock = threading.Lock()
 
         self.engine = engine
+        self.users = UserCache(self.engine)
         self.webserver = WebServer('webserver', self.engine, bot_cls=self)
 
-        self.user_tokens: dict[int, str] = {}
+        # echo mode, open ticket and token of users, who talk to operator
+        self.states = UserStateStore(self.engine, self.users, self.webserver.generate_token)
+
+        # messages of users in conversation are handed to webserver directly or over http
+        self.ingest = create_ingest(self.webserver, self.states, serves_operators=self.mode == 'webhook')
 
     def load_and_parse_md_answers(self, filename: str):
         """
@@ -34,35 +72,110 @@ class EchoBot:
 
         :returns: list of answers
         """
+        from answer_index import parse_md_answers
+
         basement = pathlib.Path(__file__).parent.absolute()
-        answers = basement / filename
-        with open(answers, 'r') as f:
-            lines = f.readlines()
-        
-        # split answers by ---
-        answers = []
-        answer = []
-        for line in lines:
-            if line == '---\n':
-                answers.append(answer)
-                answer = []
-            else:
-                answer.append(line)
-        
-        answers.append(answer)
+        return parse_md_answers(basement / filename)
+    
+    def ensure_pipeline(self):
+        """
+        Setup pipeline on first use
+
+        :returns: None
+        """
+        if self.batcher is not None:
+            return
 
-        answers = [x[0] for x in answers]
+        with self._pipeline_lock:
+            if self.batcher is None:
+                self.setup_pipeline()
 
-        return answers
-    
     def setup_pipeline(self):
         """
         Setup pipeline for model and tokenizer
 
         :returns: None
         """
-        self.answers = self.load_and_parse_md_answers(os.getenv('ANSWERS_FILE'))
-        self.model = SentenceTransformer(self.model_id)
+        from answer_index import AnswerIndex
+        from batching import InferenceBatcher
+        from cache import AnswerCache
+        from encoders import create_encoder
+        from inference_service import SERVICE_ERRORS, InferenceClient, RemoteEncoder
+
+        self.answer_cache = AnswerCache()
+        self.answer_index = AnswerIndex(self.model_id)
+
+        # model and index are shared by inference service if it is configured
+        if os.getenv('INFERENCE_SOCKET'):
+            try:
+                self.model = RemoteEncoder(self.model_id, InferenceClient(), self.answer_index)
+                self.remote_inference = True
+                self.answers = self.answer_index.answers
+            except SERVICE_ERRORS as e:
+                print(f'Inference service is unavailable, loading model locally: {e}')
+
+        if not self.model:
+            self.model = create_encoder(self.model_id)
+
+            # load precomputed answer embeddings or encode them once
+            self.answer_index = AnswerIndex(self.model.name)
+            self.reload_answers()
+
+        # questions of concurrent handlers are encoded and searched in one batch
+        self.batcher = InferenceBatcher(self.encode, self.search_batch)
+
+    def reload_answers(self):
+        """
+        Parse answers file and update answer index, encoding only changed answers
+
+        :returns: count of encoded answers
+        """
+        from answer_index import AnswerIndex
+
+        if self.remote_inference:
+            encoded = self.model.reload()
+            self.answers = self.answer_index.answers
+        else:
+            filename = os.getenv('ANSWERS_FILE')
+            answers_file = pathlib.Path(__file__).parent.absolute() / filename
+
+            answers = self.load_and_parse_md_answers(filename)
+            encoded = self.answer_index.load_or_build(answers, AnswerIndex.hash_file(answers_file), self.encode)
+            self.answers = answers
+
+        # answers of previous index must not be served anymore
+        self.answer_cache.invalidate()
+
+        return encoded
+
+    def watch_answers(self):
+        """
+        Start watcher, that reloads answers on answers file change
+
+        :returns: None
+        """
+        interval = float(os.getenv('ANSWERS_RELOAD_INTERVAL', 5))
+
+        # inference service watches the file itself
+        if interval <= 0 or self.remote_inference:
+            return
+
+        from answer_index import FileWatcher
+
+        answers_file = pathlib.Path(__file__).parent.absolute() / os.getenv('ANSWERS_FILE')
+        self.answers_watcher = FileWatcher(answers_file, self.reload_answers, interval)
+        self.answers_watcher.start()
+
+    def encode(self, texts: List[str]):
+        """
+        Encode texts to normalized embeddings
+
+        :param texts: list of texts
+
+        :returns: matrix of embeddings
+        """
+        with timed('encode'):
+            return self.model.encode(texts)
 
     def get_answer_pipeline(self, question: str):
         """
@@ -72,19 +185,45 @@ class EchoBot:
         
         :returns: answer
         """
-        if not self.model:
-            self.setup_pipeline()
+        self.ensure_pipeline()
+
+        version = self.answer_index.version
+        answer = self.answer_cache.get(question, version)
+        if answer is not None:
+            return answer
+
+        # near-verbatim questions are answered without model
+        with timed('prefilter'):
+            answer, candidates = self.answer_index.prefilter(question)
+        if answer is not None:
+            self.answer_cache.put(question, answer, version)
+            return answer
+
+        return self.batcher.answer('<Q>' + question, (question, candidates))
+
+    def search_batch(self, query_embeddings, contexts):
+        """
+        Find answers for batch of encoded questions, looking for close questions in cache first
+
+        :param query_embeddings: matrix of normalized question embeddings
 
-        question = '<Q>' + question
-        answers = ['<A>' + x for x in self.answers]
+        :param contexts: list of (question, candidates) pairs
 
-        query_embedding = self.model.encode(question)
-        corpus_embeddings = self.model.encode(answers)
+        :returns: list of answers
+        """
+        version = self.answer_index.version
+        answers = [self.answer_cache.get_similar(x, version) for x in query_embeddings]
 
-        result = util.semantic_search(query_embedding, corpus_embeddings)
-        response = sorted([(x['corpus_id'], x['score']) for x in result[0]], key=lambda y: y[1], reverse=True)
+        missing = [i for i, x in enumerate(answers) if x is None]
+        if missing:
+            with timed('semantic_search'):
+                found = self.answer_index.search_batch(query_embeddings[missing], [contexts[i][1] for i in missing])
 
-        return self.answers[response[0][0]]
+            for i, answer in zip(missing, found):
+                answers[i] = answer
+                self.answer_cache.put(contexts[i][0], answer, version, query_embeddings[i])
+
+        return answers
     
     def create_or_get(self, user_id: int):
         """
@@ -94,15 +233,19 @@ class EchoBot:
 
         :returns: user
         """
-        with Session(self.engine) as session:
-            user = select(User).where(User.telegram_id == user_id)
-            user = session.exec(user).first()
-            if not user:
-                user = User(telegram_id=user_id, telegram_username='@' + self.bot.get_chat(user_id).username)
-                session.add(user)
-                session.commit()
+        user = self.users.get_by_telegram_id(user_id)
+        if user:
+            return user
 
-        return user
+        with timed('telegram.get_chat'):
+            username = '@' + self.bot.get_chat(user_id).username
+
+        with session_scope(self.engine) as session:
+            user = User(telegram_id=user_id, telegram_username=username)
+            session.add(user)
+            session.flush()
+
+            return self.users.put(user)
 
     def recreate_operators(self):
         basement = pathlib.Path(__file__).parent.absolute()
@@ -111,55 +254,34 @@ class EchoBot:
         with open(operators, 'r') as f:
             operators = f.read().split('\n')
 
-        with Session(self.engine) as session:
-            old_operators = select(User).where(User.is_operator == True)
-            old_operators = session.exec(old_operators).all()
+        operators = [x.strip() for x in operators if x.strip()]
+
+        # operators are reset by two statements in one transaction
+        with session_scope(self.engine) as session:
+            session.execute(update(User).where(User.is_operator == True).values(is_operator=False).execution_options(synchronize_session=False))
 
-            for operator in old_operators:
-                operator.is_operator = False
-                session.add(operator)
-                session.commit()
+            if operators:
+                session.execute(update(User).where(User.telegram_username.in_(operators)).values(is_operator=True).execution_options(synchronize_session=False))
 
-            for operator in operators:
-                user = select(User).where(User.telegram_username == operator)
-                user = session.exec(user).first()
-                if user:
-                    user.is_operator = True
-                    session.add(user)
-                    session.commit()
+        # cached users may have stale operator flag
+        self.users.invalidate()
 
-    def stack_message(self, message: Message):
+    def stack_message(self, message: Message, user: User = None, response: str = None):
         """
         Stack message to db
 
         :param message: message from user
 
-        :returns: Nonez
-        """
-        with Session(self.engine) as session:
-            user = self.create_or_get(message.from_user.id)
-            session.add(Message(user_id=user.id, message_id=message.id, text=message.text, date=message.date))
-            session.commit()
-
-    # set message response in db
-    def set_message_response(self, message: Message, text: str):
-        """
-        Set message response in db
-
-        :param message: message from user
+        :param user: author of message, it is looked up if not given
 
-        :param text: text of message
+        :param response: answer to message
 
         :returns: None
         """
-        # select message from db by id
-        # set response
-        message = select(Message).where(Message.message_id == message.id)
-        with Session(self.engine) as session:
-            message = session.exec(message).first()
-            message.response = text
-            session.add
-            session.commit()
+        user = user or self.create_or_get(message.from_user.id)
+
+        with session_scope(self.engine) as session:
+            session.add(Message(user_id=user.id, message_id=message.id, text=message.text, date=message.date, response=response))
 
     # solve question in db
     def set_solve(self, message: Message):
@@ -173,28 +295,68 @@ class EchoBot:
         # select message from db by id
         # set solved
         message = select(Message).where(Message.message_id == message.id)
-        with Session(self.engine) as session:
+        with session_scope(self.engine) as session:
             message = session.exec(message).first()
             message.is_solved = True
             session.add(message)
-            session.commit()
+
+            return message.response
 
     def set_echo_status(self, user_id, echo_status: bool):
-        with Session(self.engine) as session:
-            user = select(User).where(User.telegram_id == user_id)
-            user = session.exec(user).first()
+        self.states.set_echo(user_id, echo_status)
 
-            user.enable_echo = echo_status
-            session.add(user)
-            session.commit()
+    def receive_updates(self, updates: list, timeout: float = None) -> bool:
+        """
+        Queue received updates for handling by workers
+
+        :param updates: telegram updates
+
+        :param timeout: time to wait while queue is full, waits without limit if None
+
+        :returns: False if updates were not queued
+        """
+        # next getUpdates request must not return queued updates again
+        for received in updates:
+            self.bot.last_update_id = max(self.bot.last_update_id, received.update_id)
+
+        return self.dispatcher.dispatch(updates, timeout)
+
+    def serve_webhook(self):
+        """
+        Receive updates by webhook on own server, operator routes are served by webserver of this process
+        """
+        from wsgiserver import WSGIServer
+
+        secret = os.getenv('WEBHOOK_SECRET')
+        if not secret:
+            raise ValueError('WEBHOOK_SECRET must be set in webhook mode')
+
+        path = os.getenv('WEBHOOK_PATH', '/telegram/webhook')
+        threads = int(os.getenv('WEBHOOK_THREADS', 4))
+
+        # operator streams hold threads of webserver for long, so updates don't share its pool
+        webhook = TelegramWebhook('webhook', path, secret, self.receive_updates)
+        webhook_server = WSGIServer(webhook, host=os.getenv('WEBHOOK_HOST', os.getenv('FLASK_HOST')), port=int(os.getenv('WEBHOOK_PORT', 8443)), numthreads=threads)
+        threading.Thread(target=webhook_server.start, name='webhook-server', daemon=True).start()
+
+        self.bot.set_webhook(url=os.getenv('WEBHOOK_URL').rstrip('/') + path, secret_token=secret, max_connections=threads)
+
+        server = WSGIServer(self.webserver, host=os.getenv('FLASK_HOST'), port=int(os.getenv('FLASK_PORT')), numthreads=int(os.getenv('FLASK_THREADS', 10)))
+        server.start()
 
     def set_routers(self):
-        self.bot.message_handler(commands=['start'])(self.start)
-        self.bot.message_handler(commands=['closethread'])(self.close_thread)
-        self.bot.message_handler(func=lambda m: m.text.startswith("/newtoken"))(self.regenerate_token)
-        self.bot.message_handler(content_types=['text'])(self.conversation)
-        self.bot.callback_query_handler(func=lambda call: call.data == 'helpful')(self.helpful)
-        self.bot.callback_query_handler(func=lambda call: call.data == 'not_helpful')(self.not_helpful)
+        # every update is handled in one session and one transaction
+        def unit(handler):
+            return transactional(self.engine, handler, 'bot.' + handler.__name__)
+
+        self.bot.message_handler(commands=['start'])(unit(self.start))
+        self.bot.message_handler(commands=['closethread'])(unit(self.close_thread))
+        self.bot.message_handler(commands=['reload'])(unit(self.reload))
+        self.bot.message_handler(commands=['profile'])(unit(self.profile))
+        self.bot.message_handler(func=lambda m: m.text.startswith("/newtoken"))(unit(self.regenerate_token))
+        self.bot.message_handler(content_types=['text'])(unit(self.conversation))
+        self.bot.callback_query_handler(func=lambda call: call.data == 'helpful')(unit(self.helpful))
+        self.bot.callback_query_handler(func=lambda call: call.data == 'not_helpful')(unit(self.not_helpful))
 
     def helpful(self, call: CallbackQuery):
         """
@@ -204,20 +366,16 @@ class EchoBot:
 
         :returns: None
         """
-        self.bot.answer_callback_query(call.id, 'Thank you for your feedback')
+        with timed('telegram.answer_callback_query'):
+            self.bot.answer_callback_query(call.id, 'Thank you for your feedback')
         message: Message = call.message
 
         # set solved status for answered message
-        self.set_solve(message.reply_to_message)
-
-        # get response from message in db
-        _message = select(Message).where(Message.message_id == message.reply_to_message.id)
-        with Session(self.engine) as session:
-            _message = session.exec(_message).first()
-            response = _message.response
+        response = self.set_solve(message.reply_to_message)
+        commit()
 
         # edit message, remove keyboard
-        self.bot.edit_message_text(chat_id=message.chat.id, message_id=message.message_id, text=response)
+        self.sender.call(message.chat.id, 'edit_message_text', chat_id=message.chat.id, message_id=message.message_id, text=response)
 
     def not_helpful(self, call: CallbackQuery):
         """
@@ -227,77 +385,106 @@ class EchoBot:
 
         :returns: None
         """
-        self.bot.answer_callback_query(call.id, 'Thank you for your feedback')
+        with timed('telegram.answer_callback_query'):
+            self.bot.answer_callback_query(call.id, 'Thank you for your feedback')
         message: Message = call.message
 
         # set solved status for answered message
         # self.set_solve(message.reply_to_message)
 
         # get response from message in db
-        _message = select(Message).where(Message.message_id == message.reply_to_message.id)
-        with Session(self.engine) as session:
-            _message = session.exec(_message).first()
-            response = _message.response
+        _message = select(Message.response).where(Message.message_id == message.reply_to_message.id)
+        with session_scope(self.engine) as session:
+            response = session.exec(_message).first()
 
         # edit message, remove keyboard
-        self.bot.edit_message_text(chat_id=message.chat.id, message_id=message.message_id, text=response)
+        self.sender.call(message.chat.id, 'edit_message_text', chat_id=message.chat.id, message_id=message.message_id, text=response)
 
-        self.bot.send_message(message.chat.id, 
+        self.sender.send(message.chat.id, 
             'Перенаправляю вопрос нашему специалисту, ожидайте ответа!\n' \
             'По завершению диалога вы можете закрыть ветку вопроса командой /closethread'
         )
 
         # find operators in db
         operators = select(User).where(User.is_operator == True)
-        with Session(self.engine) as session:
-            operators = session.exec(operators).all()
+        with session_scope(self.engine) as session:
+            operators = [self.users.put(x) for x in session.exec(operators).all()]
 
         user_id = call.message.reply_to_message.from_user.id
+        user = self.users.get_by_telegram_id(user_id)
 
-        with Session(self.engine) as session:
-            user = select(User).where(User.telegram_id == user_id)
-            user = session.exec(user).first()
-
-        # create table
-        with Session(self.engine) as session:
-            ticket_id = create_conversation_table(user.id, session, self.engine)
-
-        # create UserTicket table
-        with Session(self.engine) as session:
-            session.add(UserTicket(user_id=user.id, ticket_id=ticket_id))
-            session.commit()
+        # create ticket with conversation
+        ticket_id = create_conversation(user.id, self.engine)
 
         # set echo status for user
         self.set_echo_status(user_id, True)
 
-        # generate token for user
-        user_token = self.webserver.generate_token(str(user.id), str(user.telegram_id), ticket_id)
-        self.user_tokens[user_id] = user_token
+        # remember ticket and token of user
+        self.states.open_ticket(user, ticket_id)
+
+        # ticket is committed before operators open it
+        commit()
 
         for operator in operators:
             token = self.webserver.generate_token(str(operator.id), str(operator.telegram_id), ticket_id)
             chat_url = f'http://{os.getenv("REMOTE_ADDR")}:{os.getenv("FLASK_PORT")}/{token}'
-            self.bot.send_message(operator.telegram_id, f'New ticket from {user_id} \n\n {chat_url}')
+            self.sender.send(operator.telegram_id, f'New ticket from {user_id} \n\n {chat_url}')
 
     def regenerate_token(self, message: Message):
         args = message.text.split(' ')
         if len(args) < 2:
-            self.bot.reply_to(message, "Пожалуйста, укажите ID тикета, к которому необходимо получить новый токен")
+            self.sender.reply_to(message, "Пожалуйста, укажите ID тикета, к которому необходимо получить новый токен")
             return
 
         ticket_id = args[1]
-
-        with Session(self.engine) as session:
-            user = select(User).where(User.telegram_id == message.from_user.id)
-            user = session.exec(user).first()
+        user = self.users.get_by_telegram_id(message.from_user.id)
 
         if not user.is_operator:
-            self.bot.reply_to(message, "Вы не являетесь оператором")
+            self.sender.reply_to(message, "Вы не являетесь оператором")
             return
 
         token = self.webserver.generate_token(str(user.id), str(user.telegram_id), ticket_id)
         url = f'http://{os.getenv("REMOTE_ADDR")}:{os.getenv("FLASK_PORT")}/{token}'
-        self.bot.reply_to(message, f'Новая ссылка для чата: \n\n {url}')
+        self.sender.reply_to(message, f'Новая ссылка для чата: \n\n {url}')
+
+    def reload(self, message: Message):
+        """
+        Reload answers command handler
+
+        :param message: message from operator
+
+        :returns: None
+        """
+        user = self.users.get_by_telegram_id(message.from_user.id)
+
+        if not user or not user.is_operator:
+            self.sender.reply_to(message, "Вы не являетесь оператором")
+            return
+
+        self.ensure_pipeline()
+
+        encoded = self.reload_answers()
+        self.sender.reply_to(message, f'Ответы обновлены: {len(self.answers)}, переиндексировано: {encoded}')
+
+    def profile(self, message: Message):
+        """
+        Profile next run of handler, e.g. /profile bot.conversation
+
+        :param message: message from operator
+
+        :returns: None
+        """
+        user = self.users.get_by_telegram_id(message.from_user.id)
+
+        if not user or not user.is_operator:
+            self.sender.reply_to(message, "Вы не являетесь оператором")
+            return
+
+        args = message.text.split()[1:]
+        handler = args[0] if args else 'bot.conversation'
+
+        profiler.arm(handler)
+        self.sender.reply_to(message, f'Следующий вызов {handler} будет профилирован, результат сохранится в {profiler.directory}')
 
     def send_echo_message(self, user_id, message):
         """
@@ -307,35 +494,31 @@ class EchoBot:
 
         :param message: message from user
 
-        :returns: None
+        :returns: future with sent message
         """
-        self.bot.send_message(user_id, message)
+        return self.sender.send(user_id, message)
 
     def close_thread(self, message: Message):
         # get user from database
         user = self.create_or_get(message.from_user.id)
 
-        # get last opened user ticket
-        with Session(self.engine) as session:
-            user_ticket = select(UserTicket).where(UserTicket.is_solved == False, UserTicket.user_id == user.id)
-            user_ticket = session.exec(user_ticket).all()
+        # get and close last opened user ticket
+        with session_scope(self.engine) as session:
+            user_ticket = get_open_ticket(session, user.id)
+
+            if user_ticket:
+                user_ticket.is_solved = True
+                session.add(user_ticket)
 
         if not user_ticket:
-            self.bot.reply_to(message, 'У вас нет открытых веток')
+            self.sender.reply_to(message, 'У вас нет открытых веток')
             return
 
-        user_ticket = user_ticket[-1]
-
-        # close user ticket
-        with Session(self.engine) as session:
-            user_ticket.is_solved = True
-            session.add(user_ticket)
-            session.commit()
-
         # set echo status for user
         self.set_echo_status(message.from_user.id, False)
+        commit()
 
-        self.bot.reply_to(message, 'Ветка успешно закрыта')
+        self.sender.reply_to(message, 'Ветка успешно закрыта')
 
     def conversation(self, message: Message):
         """
@@ -345,47 +528,30 @@ class EchoBot:
 
         :returns: None
         """
-        # get user
-        with Session(self.engine) as session:
-            user = select(User).where(User.telegram_id == message.from_user.id)
-            user = session.exec(user).first()
-
-        if user.enable_echo:
-            # get user last opened ticket
-            with Session(self.engine) as session:
-                user_ticket = select(UserTicket).where(UserTicket.is_solved == False, UserTicket.user_id == user.id)
-                user_ticket = session.exec(user_ticket).all()[-1]
-                ticket_id = user_ticket.ticket_id
-
-            # get token for user
-            token = self.user_tokens.get(message.from_user.id, "")
+        # state is kept in memory, no database access is needed to route message
+        state = self.states.get(message.from_user.id)
 
-            success_status = False
+        if state.in_conversation:
+            status = self.ingest.ingest(state, message.text, message.date)
 
-            while not success_status:
-                # send message to webserver
-                request_url = f'http://{os.getenv("REMOTE_ADDR")}:{os.getenv("FLASK_PORT")}/{token}/store_user_message'
-                response = requests.post(request_url, params={'message': message.text, 'date': message.date})
+            if status == INGEST_FAILED:
+                self.sender.reply_to(message, 'Не удалось доставить сообщение оператору, попробуйте позже')
+                return
 
-                if response.status_code == 200:
-                    success_status = True
-                else:
-                    # regenerate token
-                    token = self.webserver.generate_token(str(user.id), str(user.telegram_id), ticket_id)
-                    self.user_tokens[message.from_user.id] = token
+            if status != INGEST_CLOSED:
+                return
 
-                sleep(.00001)
+            # ticket was closed by operator in webserver process, message is answered by bot
+            self.states.refresh(message.from_user.id)
 
-            return
-            
-        self.stack_message(message)
-        self.create_or_get(message.from_user.id)
-
-        # answer the question
+        # answer the question before any write, so slow inference doesn't hold write lock of database
         answer = self.get_answer_pipeline(message.text)
 
-        # stack answer to db
-        self.set_message_response(message, answer)
+        user = self.create_or_get(message.from_user.id)
+
+        # stack question with answer to db in one transaction
+        self.stack_message(message, user, answer)
+        commit()
 
         # create keyboard with buttons: 1) Мне помогло, 2) Мне не помогло
         keyboard = types.InlineKeyboardMarkup()
@@ -393,7 +559,7 @@ class EchoBot:
                         types.InlineKeyboardButton('Мне не помогло', callback_data='not_helpful'))
         
         # send message with keyboard
-        self.bot.reply_to(message, answer + "\n\nВам помог ответ?", reply_markup=keyboard)
+        self.sender.reply_to(message, answer + "\n\nВам помог ответ?", reply_markup=keyboard)
 
     def start(self, message: Message):
         """
@@ -404,15 +570,36 @@ class EchoBot:
         :returns: None
         """
         self.create_or_get(message.from_user.id)
-        self.bot.send_message(message.chat.id, 'Hello, I am EchoBot')
+        self.sender.send(message.chat.id, 'Hello, I am EchoBot')
 
-    def run(self):
+    def setup(self):
         """
-        Run bot
+        Prepare database, states, answer pipeline and handlers of bot
         """
         SQLModel.metadata.create_all(self.engine)
+        create_indexes(self.engine)
+        self.states.rebuild()
+        self.ensure_pipeline()
+        self.watch_answers()
         self.set_routers()
         self.recreate_operators()
+
+    def run(self):
+        """
+        Run bot
+        """
+        self.setup()
+
+        # metrics and profiler are not exposed on the public port of operators
+        if os.getenv('METRICS_PORT'):
+            serve_metrics(os.getenv('METRICS_HOST', '127.0.0.1'), int(os.getenv('METRICS_PORT')))
+
+        if self.mode == 'webhook':
+            self.serve_webhook()
+            return
+
+        # telegram doesn't return updates by getUpdates while webhook is set
+        self.bot.remove_webhook()
         self.bot.infinity_polling(timeout=999999)
 
 if __name__ == '__main__':
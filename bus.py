@@ -0,0 +1,220 @@
+import json
+import os
+import select as select_
+import threading
+import uuid
+from dataclasses import asdict
+from time import time
+from typing import Callable, List
+
+from sqlalchemy import delete, text
+from sqlmodel import Session, select
+
+from metrics import registry
+from schemes import BusEvent, ConversationThread
+from unit_of_work import after_commit, session_scope
+
+
+published_metric = registry.counter('katyax_bus_published_total', 'Count of messages published to message bus')
+received_metric = registry.counter('katyax_bus_received_total', 'Count of messages received from other processes')
+
+Subscriber = Callable[[str, ConversationThread], None]
+
+
+class MessageBus:
+    def __init__(self):
+        self.subscribers: List[Subscriber] = []
+
+    def subscribe(self, callback: Subscriber):
+        """
+        Subscribe to messages of all tickets
+
+        :param callback: function of ticket id and message
+
+        :returns: None
+        """
+        self.subscribers.append(callback)
+
+    def deliver(self, ticket_id: str, message: ConversationThread):
+        for callback in self.subscribers:
+            try:
+                callback(ticket_id, message)
+            except Exception as e:
+                print(f'Failed to deliver message of ticket {ticket_id}: {e}')
+
+    def publish(self, ticket_id: str, message: ConversationThread):
+        """
+        Publish message of ticket to all subscribers
+
+        :param ticket_id: id of ticket
+
+        :param message: stored message
+
+        :returns: None
+        """
+        raise NotImplementedError
+
+    def start(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class InMemoryBus(MessageBus):
+    def publish(self, ticket_id: str, message: ConversationThread):
+        published_metric.inc()
+
+        # message is delivered only if transaction, which stored it, is committed
+        after_commit(lambda: self.deliver(ticket_id, message))
+
+
+class DatabaseBus(MessageBus):
+    CHANNEL = 'katyax_bus'
+
+    # concurrent transactions may commit ids out of order, recent ids are re-read
+    LOOKBACK = 100
+
+    def __init__(self, engine, poll_interval: float = None, retention: float = None):
+        super().__init__()
+        self.engine = engine
+        self.origin = uuid.uuid4().hex
+
+        self.is_postgres = engine.dialect.name == 'postgresql'
+
+        # on postgres NOTIFY wakes the reader, polling is only a safety net
+        default_interval = 5 if self.is_postgres else .2
+        self.poll_interval = poll_interval or float(os.getenv('BUS_POLL_INTERVAL', default_interval))
+        self.retention = retention or float(os.getenv('BUS_RETENTION', 3600))
+
+        self.last_id = 0
+        self._seen = set()
+        self._wakeup = threading.Event()
+        self._stop_event = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    def start(self):
+        BusEvent.__table__.create(self.engine, checkfirst=True)
+
+        # only events published after start are delivered
+        with Session(self.engine) as session:
+            self.last_id = session.exec(select(BusEvent.id).order_by(BusEvent.id.desc())).first() or 0
+            self._seen = set(session.exec(select(BusEvent.id).where(BusEvent.id > self.last_id - self.LOOKBACK)).all())
+
+        self._threads.append(threading.Thread(target=self._read_loop, name='bus-reader', daemon=True))
+        if self.is_postgres:
+            self._threads.append(threading.Thread(target=self._listen_loop, name='bus-listener', daemon=True))
+
+        for thread in self._threads:
+            thread.start()
+
+    def close(self):
+        self._stop_event.set()
+        self._wakeup.set()
+
+    def publish(self, ticket_id: str, message: ConversationThread):
+        published_metric.inc()
+
+        # event is committed together with the message, notification is sent by postgres on commit
+        event = BusEvent(ticket_id=ticket_id, origin=self.origin, payload=json.dumps(asdict(message), default=str), created_at=time())
+        with session_scope(self.engine) as session:
+            session.add(event)
+            session.flush()
+
+            if self.is_postgres:
+                session.execute(text('SELECT pg_notify(:channel, :payload)'), {'channel': self.CHANNEL, 'payload': str(event.id)})
+
+        # local subscribers don't wait for the round-trip through database, but for commit
+        after_commit(lambda: self.deliver(ticket_id, message))
+
+    def _read_loop(self):
+        cleaned_at = time()
+
+        while not self._stop_event.is_set():
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+            try:
+                self._read_events()
+
+                if time() - cleaned_at > self.retention / 10:
+                    self._cleanup()
+                    cleaned_at = time()
+            except Exception as e:
+                print(f'Failed to read message bus: {e}')
+
+    def _read_events(self):
+        with Session(self.engine) as session:
+            events = session.exec(select(BusEvent).where(BusEvent.id > self.last_id - self.LOOKBACK).order_by(BusEvent.id)).all()
+
+        for event in events:
+            if event.id in self._seen:
+                continue
+
+            self._seen.add(event.id)
+            self.last_id = max(self.last_id, event.id)
+
+            if event.origin == self.origin:
+                continue
+
+            received_metric.inc()
+            self.deliver(event.ticket_id, ConversationThread(**json.loads(event.payload)))
+
+        self._seen = {x for x in self._seen if x > self.last_id - self.LOOKBACK}
+
+    def _cleanup(self):
+        with Session(self.engine) as session:
+            session.execute(delete(BusEvent).where(BusEvent.created_at < time() - self.retention))
+            session.commit()
+
+    def _listen_loop(self):
+        while not self._stop_event.is_set():
+            try:
+                connection = self.engine.raw_connection()
+
+                # listening connection is never given back to the pool
+                connection.detach()
+
+                try:
+                    driver_connection = connection.connection
+                    driver_connection.autocommit = True
+
+                    cursor = driver_connection.cursor()
+                    cursor.execute(f'LISTEN {self.CHANNEL};')
+
+                    while not self._stop_event.is_set():
+                        if select_.select([driver_connection], [], [], self.poll_interval) == ([], [], []):
+                            continue
+
+                        driver_connection.poll()
+                        if driver_connection.notifies:
+                            driver_connection.notifies.clear()
+                            self._wakeup.set()
+                finally:
+                    connection.close()
+            except Exception as e:
+                print(f'Message bus listener failed, reconnecting: {e}')
+                self._stop_event.wait(self.poll_interval)
+
+
+def create_bus(engine, name: str = None) -> MessageBus:
+    """
+    Create message bus by name
+
+    :param engine: database engine
+
+    :param name: name of bus, MESSAGE_BUS env by default
+
+    :returns: started message bus
+    """
+    name = name or os.getenv('MESSAGE_BUS', 'memory')
+
+    if name == 'memory':
+        bus = InMemoryBus()
+    elif name == 'database':
+        bus = DatabaseBus(engine)
+    else:
+        raise ValueError(f'unknown message bus {name}, expected memory or database')
+
+    bus.start()
+    return bus
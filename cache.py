@@ -0,0 +1,166 @@
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from time import monotonic
+from typing import Optional
+
+import numpy as np
+
+from lexical import normalize_text
+from metrics import registry
+
+
+cache_hits_metric = registry.counter('katyax_answer_cache_hits_total', 'Count of questions answered from cache by normalized text')
+cache_semantic_hits_metric = registry.counter('katyax_answer_cache_semantic_hits_total', 'Count of questions answered from cache by embedding similarity')
+cache_misses_metric = registry.counter('katyax_answer_cache_misses_total', 'Count of questions missing in cache by normalized text')
+cache_size_metric = registry.gauge('katyax_answer_cache_size', 'Count of cached answers')
+
+
+@dataclass
+class CacheEntry:
+    answer: str
+    expires_at: float
+    embedding: Optional[np.ndarray] = None
+
+
+class AnswerCache:
+    def __init__(self, max_size: int = None, ttl: float = None, similarity_threshold: float = None):
+        self.max_size = max_size if max_size is not None else int(os.getenv('ANSWER_CACHE_SIZE', 1024))
+        self.ttl = ttl if ttl is not None else float(os.getenv('ANSWER_CACHE_TTL', 3600))
+
+        # 0 disables lookup by embedding
+        self.similarity_threshold = similarity_threshold if similarity_threshold is not None else float(os.getenv('ANSWER_CACHE_SIMILARITY', .97))
+
+        self.version = 0
+        self._entries: 'OrderedDict[str, CacheEntry]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize_question(question: str) -> str:
+        """
+        Get cache key of question
+
+        :param question: question from user
+
+        :returns: normalized question
+        """
+        if question.startswith('<Q>'):
+            question = question[3:]
+
+        return normalize_text(question)
+
+    def _sync_version(self, version: int) -> bool:
+        # answers of another index version are stale
+        if version > self.version:
+            self._entries.clear()
+            self.version = version
+            cache_size_metric.set(0)
+
+        return version == self.version
+
+    def get(self, question: str, version: int) -> Optional[str]:
+        """
+        Get cached answer by normalized question
+
+        :param question: question from user
+
+        :param version: version of answer index
+
+        :returns: answer or None
+        """
+        key = self.normalize_question(question)
+
+        with self._lock:
+            entry = self._entries.get(key) if self._sync_version(version) else None
+
+            if entry is not None and entry.expires_at < monotonic():
+                del self._entries[key]
+                entry = None
+
+            if entry is None:
+                cache_misses_metric.inc()
+                return None
+
+            self._entries.move_to_end(key)
+
+        cache_hits_metric.inc()
+        return entry.answer
+
+    def get_similar(self, embedding: np.ndarray, version: int) -> Optional[str]:
+        """
+        Get cached answer of question with close embedding
+
+        :param embedding: normalized embedding of question
+
+        :param version: version of answer index
+
+        :returns: answer or None
+        """
+        if self.similarity_threshold <= 0:
+            return None
+
+        with self._lock:
+            if not self._sync_version(version):
+                return None
+
+            now = monotonic()
+            keys = [k for k, v in self._entries.items() if v.embedding is not None and v.expires_at >= now]
+            if not keys:
+                return None
+
+            matrix = np.stack([self._entries[k].embedding for k in keys])
+            scores = matrix @ np.asarray(embedding, dtype=np.float32)
+
+            best = int(np.argmax(scores))
+            if scores[best] < self.similarity_threshold:
+                return None
+
+            self._entries.move_to_end(keys[best])
+            answer = self._entries[keys[best]].answer
+
+        cache_semantic_hits_metric.inc()
+        return answer
+
+    def put(self, question: str, answer: str, version: int, embedding: np.ndarray = None):
+        """
+        Put answer to cache, evicting least recently used entries
+
+        :param question: question from user
+
+        :param answer: answer to question
+
+        :param version: version of answer index, which gave the answer
+
+        :param embedding: normalized embedding of question
+
+        :returns: None
+        """
+        if self.max_size <= 0:
+            return
+
+        key = self.normalize_question(question)
+        if embedding is not None:
+            embedding = np.asarray(embedding, dtype=np.float32)
+
+        with self._lock:
+            if not self._sync_version(version):
+                return
+
+            self._entries[key] = CacheEntry(answer, monotonic() + self.ttl, embedding)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+            cache_size_metric.set(len(self._entries))
+
+    def invalidate(self):
+        """
+        Drop all cached answers
+
+        :returns: None
+        """
+        with self._lock:
+            self._entries.clear()
+            cache_size_metric.set(0)
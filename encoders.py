@@ -0,0 +1,160 @@
+import json
+import os
+import pathlib
+from typing import Dict, List, Type
+
+import numpy as np
+
+
+class Encoder:
+    def __init__(self, model_id: str):
+        self.model_id = model_id
+
+    @property
+    def name(self) -> str:
+        """
+        Name of encoder, embeddings of encoders with different names are not interchangeable
+        """
+        return self.model_id
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """
+        Encode texts to normalized embeddings
+
+        :param texts: list of texts
+
+        :returns: matrix of embeddings
+        """
+        raise NotImplementedError
+
+
+class TorchEncoder(Encoder):
+    def __init__(self, model_id: str):
+        super().__init__(model_id)
+
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_id)
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        return self.model.encode(texts, convert_to_numpy=True, normalize_embeddings=True)
+
+
+class OnnxEncoder(Encoder):
+    def __init__(self, model_id: str, quantize: bool = False, cache_dir: str = None, batch_size: int = 32):
+        super().__init__(model_id)
+        self.quantize = quantize
+        self.batch_size = batch_size
+
+        cache_dir = cache_dir or os.path.join(os.getenv('SENTENCE_TRANSFORMERS_HOME', '.cache'), 'onnx')
+        self.export_dir = pathlib.Path(cache_dir) / model_id.replace('/', '__')
+
+        model_path = self.export_dir / ('model.int8.onnx' if quantize else 'model.onnx')
+        if not model_path.exists():
+            self.export(model_id, self.export_dir, quantize)
+
+        import onnxruntime
+        from transformers import AutoTokenizer
+
+        self.tokenizer = AutoTokenizer.from_pretrained(str(self.export_dir))
+        self.session = onnxruntime.InferenceSession(str(model_path), providers=['CPUExecutionProvider'])
+
+        with open(self.export_dir / 'export.json', 'r') as f:
+            self.max_seq_length = json.load(f)['max_seq_length']
+
+    @property
+    def name(self) -> str:
+        return f'{self.model_id}-onnx' + ('-int8' if self.quantize else '')
+
+    @staticmethod
+    def export(model_id: str, export_dir: pathlib.Path, quantize: bool):
+        """
+        Export sentence transformer with its pooling to onnx and quantize it
+
+        :param model_id: id of sentence transformer
+
+        :param export_dir: directory for exported model and tokenizer
+
+        :param quantize: make int8 dynamically quantized copy
+
+        :returns: None
+        """
+        export_dir.mkdir(parents=True, exist_ok=True)
+
+        fp32_path = export_dir / 'model.onnx'
+        if not fp32_path.exists():
+            import torch
+            from sentence_transformers import SentenceTransformer
+
+            model = SentenceTransformer(model_id, device='cpu')
+            model.eval()
+
+            class SentenceEmbedding(torch.nn.Module):
+                def __init__(self, model):
+                    super().__init__()
+                    self.model = model
+
+                def forward(self, input_ids, attention_mask):
+                    return self.model({'input_ids': input_ids, 'attention_mask': attention_mask})['sentence_embedding']
+
+            model.tokenizer.save_pretrained(str(export_dir))
+            with open(export_dir / 'export.json', 'w') as f:
+                json.dump({'model_id': model_id, 'max_seq_length': model.max_seq_length}, f)
+
+            dummy = model.tokenizer(['<Q>example'], return_tensors='pt')
+            tmp_path = str(fp32_path) + f'.{os.getpid()}.tmp'
+
+            with torch.no_grad():
+                torch.onnx.export(
+                    SentenceEmbedding(model), (dummy['input_ids'], dummy['attention_mask']), tmp_path,
+                    input_names=['input_ids', 'attention_mask'], output_names=['sentence_embedding'],
+                    dynamic_axes={'input_ids': {0: 'batch', 1: 'sequence'}, 'attention_mask': {0: 'batch', 1: 'sequence'}, 'sentence_embedding': {0: 'batch'}},
+                    opset_version=13,
+                )
+
+            os.replace(tmp_path, fp32_path)
+
+        int8_path = export_dir / 'model.int8.onnx'
+        if quantize and not int8_path.exists():
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+
+            tmp_path = str(int8_path) + f'.{os.getpid()}.tmp'
+            quantize_dynamic(str(fp32_path), tmp_path, weight_type=QuantType.QInt8)
+            os.replace(tmp_path, int8_path)
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        embeddings = []
+        for start in range(0, len(texts), self.batch_size):
+            features = self.tokenizer(texts[start:start + self.batch_size], padding=True, truncation=True, max_length=self.max_seq_length, return_tensors='np')
+            inputs = {'input_ids': features['input_ids'].astype(np.int64), 'attention_mask': features['attention_mask'].astype(np.int64)}
+            embeddings.append(self.session.run(None, inputs)[0])
+
+        embeddings = np.concatenate(embeddings).astype(np.float32)
+        return embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+
+
+ENCODERS: Dict[str, Type[Encoder]] = {
+    'torch': TorchEncoder,
+    'onnx': OnnxEncoder,
+    'onnx-int8': OnnxEncoder,
+}
+
+
+def create_encoder(model_id: str, name: str = None) -> Encoder:
+    """
+    Create encoder by backend name
+
+    :param model_id: id of sentence transformer
+
+    :param name: name of backend, ENCODER_BACKEND env by default
+
+    :returns: encoder
+    """
+    name = name or os.getenv('ENCODER_BACKEND', 'torch')
+
+    if name not in ENCODERS:
+        raise ValueError(f'unknown encoder backend {name}, expected one of {", ".join(ENCODERS)}')
+
+    if name == 'onnx-int8':
+        return OnnxEncoder(model_id, quantize=True)
+
+    return ENCODERS[name](model_id)
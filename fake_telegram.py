@@ -0,0 +1,238 @@
+import argparse
+import datetime
+import json
+import threading
+from time import monotonic, sleep
+from typing import Dict, List, Optional, Tuple
+
+import requests
+from flask import Flask, request, jsonify
+
+
+def make_message_update(chat_id: int, text: str, message_id: int = None, date: int = None) -> dict:
+    """
+    Build update with text message from user
+
+    :param chat_id: telegram id of user, private chat has the same id
+    :param text: text of message
+
+    :returns: update without update_id, it is set by fake api
+    """
+    user = {'id': chat_id, 'is_bot': False, 'first_name': f'user{chat_id}', 'username': f'user{chat_id}'}
+    message = {
+        'message_id': message_id or 1,
+        'date': date or int(datetime.datetime.now().timestamp()),
+        'chat': {'id': chat_id, 'type': 'private'},
+        'from': user,
+        'text': text,
+    }
+
+    # commands are recognized by telebot only with entity
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+
+    return {'message': message}
+
+
+def make_callback_update(chat_id: int, data: str, message: dict) -> dict:
+    """
+    Build update with pressed inline button
+
+    :param chat_id: telegram id of user
+    :param data: callback data of button
+
+    :param message: message of bot with keyboard, as returned by sendMessage
+
+    :returns: update without update_id
+    """
+    user = {'id': chat_id, 'is_bot': False, 'first_name': f'user{chat_id}'}
+    return {'callback_query': {'id': str(monotonic()), 'from': user, 'chat_instance': str(chat_id), 'message': message, 'data': data}}
+
+
+class FakeTelegram(Flask):
+    """
+    Stand-in Telegram Bot API for local tests and benchmarks.
+    Bot is pointed to it by TELEGRAM_API_URL, updates are pushed by /fake/updates
+    and sent messages are read by /fake/sent
+    """
+
+    def __init__(self, name, latency: float = 0):
+        super().__init__(name)
+        self.latency = latency
+
+        self.webhook: Optional[dict] = None
+        self.updates: List[dict] = []
+        self.sent: List[dict] = []
+
+        # messages of users by chat and id, bot replies refer to them
+        self.user_messages: Dict[Tuple[int, int], dict] = {}
+
+        self._update_id = 0
+        self._message_id = 0
+        self._cond = threading.Condition()
+
+        self.set_routers()
+
+    def set_routers(self):
+        self.add_url_rule('/bot<token>/<method>', 'api', self.api, methods=['GET', 'POST'])
+        self.add_url_rule('/fake/updates', 'push_updates', self.push_updates, methods=['POST'])
+        self.add_url_rule('/fake/sent', 'get_sent', self.get_sent, methods=['GET'])
+        self.add_url_rule('/fake/reset', 'reset', self.reset, methods=['POST'])
+
+    def api(self, token, method):
+        params = request.values.to_dict()
+        if request.is_json:
+            params.update(request.get_json())
+
+        handler = getattr(self, 'method_' + method.lower(), None)
+        if handler is None:
+            return jsonify({'ok': False, 'error_code': 404, 'description': f'Not Found: method {method} is not faked'}), 404
+
+        # network and api time of real telegram
+        if self.latency and method != 'getUpdates':
+            sleep(self.latency)
+
+        return jsonify({'ok': True, 'result': handler(params)})
+
+    def _message(self, params: dict, method: str) -> dict:
+        chat_id = int(params['chat_id'])
+
+        with self._cond:
+            self._message_id += 1
+            message = {
+                'message_id': int(params.get('message_id') or self._message_id),
+                'date': int(datetime.datetime.now().timestamp()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': {'id': 0, 'is_bot': True, 'first_name': 'KatyaX'},
+                'text': params.get('text', ''),
+            }
+
+            reply_to = self.user_messages.get((chat_id, int(params.get('reply_to_message_id') or 0)))
+            if reply_to is not None:
+                message['reply_to_message'] = reply_to
+
+            if params.get('reply_markup'):
+                message['reply_markup'] = json.loads(params['reply_markup'])
+
+            self.sent.append({'method': method, 'chat_id': chat_id, 'time': datetime.datetime.now().timestamp(), 'message': message})
+            self._cond.notify_all()
+
+        return message
+
+    def method_getme(self, params):
+        return {'id': 0, 'is_bot': True, 'first_name': 'KatyaX', 'username': 'katyax_bot'}
+
+    def method_sendmessage(self, params):
+        return self._message(params, 'sendMessage')
+
+    def method_editmessagetext(self, params):
+        return self._message(params, 'editMessageText')
+
+    def method_answercallbackquery(self, params):
+        return True
+
+    def method_getchat(self, params):
+        chat_id = int(params['chat_id'])
+        return {'id': chat_id, 'type': 'private', 'username': f'user{chat_id}'}
+
+    def method_setwebhook(self, params):
+        # telebot removes webhook by setting empty url
+        self.webhook = {'url': params['url'], 'secret_token': params.get('secret_token')} if params.get('url') else None
+        return True
+
+    def method_deletewebhook(self, params):
+        self.webhook = None
+        return True
+
+    def method_getupdates(self, params):
+        offset = int(params.get('offset') or 0)
+        timeout = float(params.get('timeout') or 0)
+        deadline = monotonic() + timeout
+
+        with self._cond:
+            # confirmed updates are not returned again
+            self.updates = [x for x in self.updates if x['update_id'] >= offset]
+
+            while not self.updates and monotonic() < deadline:
+                self._cond.wait(deadline - monotonic())
+
+            return self.updates[:int(params.get('limit') or 100)]
+
+    def push_updates(self):
+        """
+        Deliver updates to bot by webhook or queue them for getUpdates
+
+        :returns: update ids and webhook status codes
+        """
+        data = request.get_json()
+        updates = data if isinstance(data, list) else [data]
+
+        with self._cond:
+            for update in updates:
+                self._update_id += 1
+                update['update_id'] = self._update_id
+
+                message = update.get('message')
+                if message is not None:
+                    self.user_messages[(message['chat']['id'], message['message_id'])] = message
+
+        if self.webhook is None:
+            with self._cond:
+                self.updates.extend(updates)
+                self._cond.notify_all()
+
+            return jsonify({'update_ids': [x['update_id'] for x in updates]})
+
+        # webhook requests are sent one by one, as telegram does for one connection
+        headers = {'X-Telegram-Bot-Api-Secret-Token': self.webhook['secret_token'] or ''}
+        statuses = [requests.post(self.webhook['url'], json=x, headers=headers).status_code for x in updates]
+
+        return jsonify({'update_ids': [x['update_id'] for x in updates], 'statuses': statuses})
+
+    def get_sent(self):
+        """
+        Get sent messages, optionally waiting for them
+
+        :returns: messages sent after index `since`, filtered by `chat_id`
+        """
+        since = int(request.args.get('since', 0))
+        chat_id = request.args.get('chat_id', type=int)
+        deadline = monotonic() + float(request.args.get('wait', 0))
+
+        def select_sent() -> List[dict]:
+            return [x for x in self.sent[since:] if chat_id is None or x['chat_id'] == chat_id]
+
+        with self._cond:
+            while not select_sent() and monotonic() < deadline:
+                self._cond.wait(deadline - monotonic())
+
+            return jsonify({'sent': select_sent(), 'next': len(self.sent)})
+
+    def reset(self):
+        with self._cond:
+            self.updates.clear()
+            self.sent.clear()
+            self.user_messages.clear()
+
+        return jsonify({'status': 'ok'})
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run fake Telegram Bot API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0, help='delay of every api call in seconds')
+    parser.add_argument('--threads', type=int, default=32)
+    args = parser.parse_args()
+
+    from wsgiserver import WSGIServer
+
+    app = FakeTelegram(__name__, latency=args.latency)
+    print(f'Fake Telegram API on http://{args.host}:{args.port}, set TELEGRAM_API_URL to this address')
+
+    server = WSGIServer(app, host=args.host, port=args.port, numthreads=args.threads)
+    server.start()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+import threading
+from time import perf_counter
+from typing import Callable, Dict, Optional, Tuple, TypeVar
+
+from metrics import registry
+
+
+waiters_metric = registry.gauge('katyax_polling_waiters', 'Count of pollers waiting for new ticket messages')
+wake_latency_metric = registry.histogram('katyax_polling_wake_to_response_seconds', 'Time from ticket notification to poll response')
+notifications_metric = registry.counter('katyax_ticket_notifications_total', 'Count of ticket notifications')
+
+T = TypeVar('T')
+
+
+class TicketHub:
+    def __init__(self):
+        # conditions are kept only while tickets have waiters, idle and closed tickets are forgotten
+        self._conditions: Dict[str, threading.Condition] = {}
+        self._waiters: Dict[str, int] = {}
+        self._notified_at: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def _acquire(self, ticket_id: str) -> threading.Condition:
+        with self._lock:
+            if ticket_id not in self._conditions:
+                self._conditions[ticket_id] = threading.Condition()
+
+            self._waiters[ticket_id] = self._waiters.get(ticket_id, 0) + 1
+            return self._conditions[ticket_id]
+
+    def _release(self, ticket_id: str, condition: threading.Condition):
+        with self._lock:
+            if self._conditions.get(ticket_id) is not condition:
+                return
+
+            self._waiters[ticket_id] -= 1
+            if not self._waiters[ticket_id]:
+                del self._conditions[ticket_id], self._waiters[ticket_id]
+                self._notified_at.pop(ticket_id, None)
+
+    def notify(self, ticket_id: str):
+        """
+        Wake up all pollers of ticket
+
+        :param ticket_id: id of ticket
+
+        :returns: None
+        """
+        notifications_metric.inc()
+
+        # nobody waits, next waiter checks messages before sleeping
+        condition = self._conditions.get(ticket_id)
+        if condition is None:
+            return
+
+        with condition:
+            self._notified_at[ticket_id] = perf_counter()
+            condition.notify_all()
+
+    def wait(self, ticket_id: str, predicate: Callable[[], T], timeout: float) -> Tuple[T, Optional[float]]:
+        """
+        Sleep until predicate returns truthy value or timeout expires.
+        Predicate is checked under ticket lock, so notification between check and sleep is not lost
+
+        :param ticket_id: id of ticket
+
+        :param predicate: function, that returns result of waiting
+
+        :param timeout: timeout in seconds
+
+        :returns: last result of predicate and time of notification, which woke up the poller
+        """
+        condition = self._acquire(ticket_id)
+        deadline = perf_counter() + timeout
+        notified_at = None
+
+        try:
+            with condition:
+                result = predicate()
+                if result:
+                    return result, None
+
+                waiters_metric.inc()
+                try:
+                    while not result:
+                        remaining = deadline - perf_counter()
+                        if remaining <= 0:
+                            break
+
+                        if condition.wait(remaining):
+                            notified_at = self._notified_at.get(ticket_id)
+
+                        result = predicate()
+
+                        # discarded ticket gets no more notifications
+                        if self._conditions.get(ticket_id) is not condition:
+                            break
+                finally:
+                    waiters_metric.dec()
+        finally:
+            self._release(ticket_id, condition)
+
+        return result, notified_at
+
+    def observe_response(self, notified_at: Optional[float]):
+        """
+        Record time from notification to response
+
+        :param notified_at: time of notification returned by wait
+
+        :returns: None
+        """
+        if notified_at is not None:
+            wake_latency_metric.observe(perf_counter() - notified_at)
+
+    def discard(self, ticket_id: str):
+        """
+        Forget ticket, waiting pollers are woken up
+
+        :param ticket_id: id of ticket
+
+        :returns: None
+        """
+        with self._lock:
+            condition = self._conditions.pop(ticket_id, None)
+            self._waiters.pop(ticket_id, None)
+            self._notified_at.pop(ticket_id, None)
+
+        if condition is not None:
+            with condition:
+                condition.notify_all()
@@ -0,0 +1,321 @@
+import os
+import pathlib
+import queue
+import threading
+from multiprocessing import ProcessError, resource_tracker
+from multiprocessing.connection import Client, Connection, Listener
+from multiprocessing.shared_memory import SharedMemory
+from typing import Optional
+
+import numpy as np
+
+from answer_index import AnswerIndex, FileWatcher, parse_md_answers
+from batching import InferenceBatcher
+from encoders import Encoder, create_encoder
+from metrics import registry
+
+
+remote_calls_metric = registry.counter('katyax_inference_remote_calls_total', 'Count of calls to inference service')
+remote_failures_metric = registry.counter('katyax_inference_remote_failures_total', 'Count of failed or timed out calls to inference service')
+remote_fallbacks_metric = registry.counter('katyax_inference_fallbacks_total', 'Count of encodes served by local fallback encoder')
+
+
+# errors of unavailable or broken service, callers fall back to local model
+SERVICE_ERRORS = (OSError, EOFError, TimeoutError, RuntimeError, ProcessError)
+
+
+def get_authkey() -> bytes:
+    return (os.getenv('INFERENCE_AUTHKEY') or os.getenv('FLASK_SECRET') or 'katyax').encode('utf-8')
+
+
+class SharedMatrix:
+    def __init__(self, shm: SharedMemory, shape, dtype, owner: bool):
+        self.shm = shm
+        self.owner = owner
+        self.array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+    @classmethod
+    def create(cls, matrix: np.ndarray) -> 'SharedMatrix':
+        """
+        Copy matrix to new shared memory block
+
+        :param matrix: matrix to share
+
+        :returns: shared matrix owned by this process
+        """
+        matrix = np.ascontiguousarray(matrix)
+        shm = SharedMemory(create=True, size=max(matrix.nbytes, 1))
+
+        shared = cls(shm, matrix.shape, matrix.dtype, owner=True)
+        shared.array[:] = matrix
+
+        return shared
+
+    @classmethod
+    def attach(cls, name: str, shape, dtype) -> 'SharedMatrix':
+        """
+        Attach to shared memory block of another process without copy
+
+        :returns: shared matrix
+        """
+        shm = SharedMemory(name=name)
+
+        # block belongs to the service, tracker of this process must not unlink it on exit
+        resource_tracker.unregister(shm._name, 'shared_memory')
+
+        return cls(shm, tuple(shape), np.dtype(dtype), owner=False)
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def close(self):
+        self.array = None
+        self.shm.close()
+
+        if self.owner:
+            self.shm.unlink()
+
+
+class InferenceServer:
+    def __init__(self, model_id: str, address: str = None, authkey: bytes = None):
+        self.model_id = model_id
+        self.address = address or os.getenv('INFERENCE_SOCKET')
+        self.authkey = authkey or get_authkey()
+
+        self.encoder: Encoder = create_encoder(model_id)
+        self.answer_index = AnswerIndex(self.encoder.name)
+
+        # requests of all clients share one forward pass
+        self.batcher = InferenceBatcher(self.encoder.encode, lambda embeddings, contexts: list(embeddings))
+
+        self.shared: Optional[SharedMatrix] = None
+        self.info: dict = {}
+        self._publish_lock = threading.Lock()
+
+    def answers_file(self) -> pathlib.Path:
+        return pathlib.Path(__file__).parent.absolute() / os.getenv('ANSWERS_FILE')
+
+    def reload(self) -> int:
+        """
+        Reload answers and publish new index to shared memory
+
+        :returns: count of encoded answers
+        """
+        answers_file = self.answers_file()
+        encoded = self.answer_index.load_or_build(parse_md_answers(answers_file), AnswerIndex.hash_file(answers_file), self.encoder.encode)
+        self.publish()
+
+        return encoded
+
+    def publish(self):
+        """
+        Copy current index to new shared memory block, old block is released after grace period
+
+        :returns: None
+        """
+        with self._publish_lock:
+            snapshot = self.answer_index.snapshot
+            if self.info.get('version') == snapshot.version:
+                return
+
+            shared = SharedMatrix.create(snapshot.embeddings)
+            previous, self.shared = self.shared, shared
+
+            self.info = {
+                'version': snapshot.version,
+                'encoder': self.encoder.name,
+                'content_hash': snapshot.content_hash,
+                'answers': snapshot.answers,
+                'shm_name': shared.name,
+                'shape': shared.array.shape,
+                'dtype': shared.array.dtype.str,
+            }
+
+        # clients, which attached the previous block, keep their mapping after unlink
+        if previous is not None:
+            threading.Timer(60, previous.close).start()
+
+    def handle(self, conn: Connection):
+        with conn:
+            while True:
+                try:
+                    method, args = conn.recv()
+                except (EOFError, OSError):
+                    return
+
+                try:
+                    if method == 'encode':
+                        texts = args[0]
+                        futures = [self.batcher.submit(x) for x in texts]
+                        result = (np.stack([x.result() for x in futures]), self.info['version'])
+                    elif method == 'index_info':
+                        result = self.info
+                    elif method == 'reload':
+                        result = self.reload()
+                    else:
+                        raise ValueError(f'unknown method {method}')
+
+                    conn.send(('ok', result))
+                except Exception as e:
+                    conn.send(('error', f'{type(e).__name__}: {e}'))
+
+    def serve(self):
+        """
+        Serve clients on unix socket until interrupted
+
+        :returns: None
+        """
+        self.reload()
+
+        interval = float(os.getenv('ANSWERS_RELOAD_INTERVAL', 5))
+        if interval > 0:
+            FileWatcher(self.answers_file(), self.reload, interval).start()
+
+        # socket file of previous run is left after crash
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+
+        listener = Listener(self.address, family='AF_UNIX', authkey=self.authkey)
+        print(f'Inference service is listening on {self.address}')
+
+        try:
+            while True:
+                try:
+                    conn = listener.accept()
+                except Exception as e:
+                    print(f'Failed to accept inference client: {e}')
+                    continue
+
+                threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+        finally:
+            listener.close()
+            if self.shared is not None:
+                self.shared.close()
+
+
+class InferenceClient:
+    def __init__(self, address: str = None, authkey: bytes = None, timeout: float = None):
+        self.address = address or os.getenv('INFERENCE_SOCKET')
+        self.authkey = authkey or get_authkey()
+        self.timeout = timeout if timeout is not None else float(os.getenv('INFERENCE_TIMEOUT', 5))
+
+        # idle connections, every call takes one for itself
+        self._connections: 'queue.LifoQueue[Connection]' = queue.LifoQueue()
+        self.shared: Optional[SharedMatrix] = None
+
+    def call(self, method: str, *args, timeout: float = None):
+        """
+        Call method of inference service
+
+        :param method: name of method
+
+        :param timeout: timeout in seconds, INFERENCE_TIMEOUT by default
+
+        :returns: result of method
+        """
+        timeout = timeout or self.timeout
+        remote_calls_metric.inc()
+
+        try:
+            conn = self._connections.get_nowait()
+        except queue.Empty:
+            conn = None
+
+        try:
+            if conn is None:
+                conn = Client(self.address, family='AF_UNIX', authkey=self.authkey)
+
+            conn.send((method, args))
+            if not conn.poll(timeout):
+                raise TimeoutError(f'inference service did not respond in {timeout} seconds')
+
+            status, result = conn.recv()
+        except Exception:
+            remote_failures_metric.inc()
+
+            # connection state is unknown after failure
+            if conn is not None:
+                conn.close()
+            raise
+
+        self._connections.put(conn)
+
+        if status != 'ok':
+            raise RuntimeError(result)
+
+        return result
+
+    def attach(self, answer_index: AnswerIndex) -> dict:
+        """
+        Use index of inference service from shared memory
+
+        :param answer_index: local answer index to update
+
+        :returns: index info
+        """
+        info = self.call('index_info')
+        if info['version'] == answer_index.version:
+            return info
+
+        shared = SharedMatrix.attach(info['shm_name'], info['shape'], info['dtype'])
+        answer_index.use(info['answers'], shared.array, info['content_hash'], info['version'])
+
+        # previous mapping may still be read by running searches, it is released with gc
+        self.shared = shared
+
+        return info
+
+
+class RemoteEncoder(Encoder):
+    def __init__(self, model_id: str, client: InferenceClient, answer_index: AnswerIndex):
+        super().__init__(model_id)
+        self.client = client
+        self.answer_index = answer_index
+        self.local: Optional[Encoder] = None
+
+        self.info = self.client.attach(answer_index)
+
+    @property
+    def name(self) -> str:
+        return self.info['encoder']
+
+    def encode(self, texts):
+        try:
+            embeddings, version = self.client.call('encode', list(texts))
+        except SERVICE_ERRORS as e:
+            print(f'Inference service is unavailable, using local encoder: {e}')
+            return self.local_encode(texts)
+
+        if version != self.answer_index.version:
+            try:
+                self.info = self.client.attach(self.answer_index)
+            except SERVICE_ERRORS as e:
+                print(f'Failed to attach new index: {e}')
+
+        return embeddings
+
+    def local_encode(self, texts):
+        # model is loaded only when service fails
+        if self.local is None:
+            self.local = create_encoder(self.model_id)
+
+        remote_fallbacks_metric.inc()
+        return self.local.encode(texts)
+
+    def reload(self) -> int:
+        """
+        Ask inference service to reload answers
+
+        :returns: count of encoded answers
+        """
+        # reload may encode the whole corpus
+        encoded = self.client.call('reload', timeout=600)
+        self.info = self.client.attach(self.answer_index)
+
+        return encoded
+
+
+if __name__ == '__main__':
+    server = InferenceServer('clips/mfaq')
+    server.serve()
@@ -0,0 +1,263 @@
+import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import pathlib
+import sys
+import threading
+from collections import Counter as StackCounter, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import perf_counter
+from typing import Deque, Dict, Set, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session as OrmSession
+
+from metrics import registry
+
+
+_instrumented: Set[int] = set()
+
+
+def stage_metric(stage: str):
+    return registry.histogram('katyax_stage_seconds', 'Time spent in stage of handling update or request', labels={'stage': stage})
+
+
+def stage_errors_metric(stage: str):
+    return registry.counter('katyax_stage_errors_total', 'Count of stages failed with exception', labels={'stage': stage})
+
+
+@contextmanager
+def timed(stage: str):
+    """
+    Measure time of stage, e.g. encode or telegram.send_message
+
+    :param stage: name of stage
+
+    :returns: context manager
+    """
+    started_at = perf_counter()
+
+    try:
+        yield
+    except Exception:
+        stage_errors_metric(stage).inc()
+        raise
+    finally:
+        stage_metric(stage).observe(perf_counter() - started_at)
+
+
+def instrument_engine(engine):
+    """
+    Measure time of SQL statements of engine by statement type
+
+    :param engine: database engine
+
+    :returns: None
+    """
+    if id(engine) in _instrumented:
+        return
+
+    _instrumented.add(id(engine))
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('katyax_started_at', []).append(perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started_at = conn.info['katyax_started_at'].pop()
+        stage_metric('db.' + statement_type(statement)).observe(perf_counter() - started_at)
+
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(context):
+        started_at = context.connection.info.get('katyax_started_at') if context.connection is not None else None
+        if started_at:
+            started_at.pop()
+
+        stage_errors_metric('db.' + statement_type(context.statement or '')).inc()
+
+
+def statement_type(statement: str) -> str:
+    kind = statement.lstrip()[:6].lower()
+    return kind if kind in ('select', 'insert', 'update', 'delete') else 'other'
+
+
+@event.listens_for(OrmSession, 'after_begin')
+def after_begin(session, transaction, connection):
+    session.info.setdefault('katyax_began_at', perf_counter())
+
+
+@event.listens_for(OrmSession, 'after_transaction_end')
+def after_transaction_end(session, transaction):
+    # time from first statement to commit or rollback of outer transaction
+    if transaction.parent is None and 'katyax_began_at' in session.info:
+        stage_metric('db.transaction').observe(perf_counter() - session.info.pop('katyax_began_at'))
+
+
+class SamplingProfiler:
+    """
+    Samples stack of one handler thread, while it runs, and saves folded stacks,
+    which are read by flamegraph tools. Profiling is requested for one run of a handler
+    """
+
+    def __init__(self, interval_ms: float = None, directory: str = None, keep: int = 10):
+        self.interval = (interval_ms if interval_ms is not None else float(os.getenv('PROFILE_INTERVAL_MS', 5))) / 1000
+        self.directory = pathlib.Path(directory or os.getenv('PROFILE_DIR', 'profiles'))
+
+        # last captured profiles as (handler, path, folded stacks)
+        self.results: Deque[Tuple[str, str, str]] = deque(maxlen=keep)
+
+        self._armed: Dict[str, int] = {}
+        self._requested: ContextVar[bool] = ContextVar('profile_requested', default=False)
+        self._lock = threading.Lock()
+
+    def arm(self, handler: str, count: int = 1):
+        """
+        Profile next runs of handler
+
+        :param handler: name of handler, e.g. bot.conversation or web.polling
+
+        :param count: count of runs to profile
+
+        :returns: None
+        """
+        with self._lock:
+            self._armed[handler] = self._armed.get(handler, 0) + count
+
+    def request(self):
+        """
+        Profile handler of current request or update
+
+        :returns: token to pass to reset
+        """
+        return self._requested.set(True)
+
+    def reset(self, token):
+        self._requested.reset(token)
+
+    def _take(self, handler: str) -> bool:
+        if self._requested.get():
+            return True
+
+        with self._lock:
+            if not self._armed.get(handler):
+                return False
+
+            self._armed[handler] -= 1
+            if not self._armed[handler]:
+                del self._armed[handler]
+
+            return True
+
+    @contextmanager
+    def maybe_profile(self, handler: str):
+        """
+        Profile handler, if it was requested
+
+        :param handler: name of handler
+
+        :returns: context manager
+        """
+        if not self._take(handler):
+            yield
+            return
+
+        thread_id = threading.get_ident()
+        stacks = StackCounter()
+        stopped = threading.Event()
+
+        def sample():
+            while not stopped.wait(self.interval):
+                frame = sys._current_frames().get(thread_id)
+
+                stack = []
+                while frame is not None:
+                    stack.append(f'{frame.f_code.co_name} ({pathlib.Path(frame.f_code.co_filename).name}:{frame.f_lineno})')
+                    frame = frame.f_back
+
+                if stack:
+                    stacks[';'.join(reversed(stack))] += 1
+
+        sampler = threading.Thread(target=sample, name='profiler', daemon=True)
+        started_at = perf_counter()
+        sampler.start()
+
+        try:
+            yield
+        finally:
+            stopped.set()
+            sampler.join()
+            self.save(handler, stacks, perf_counter() - started_at)
+
+    def save(self, handler: str, stacks: StackCounter, seconds: float):
+        folded = '\n'.join(f'{stack} {count}' for stack, count in stacks.most_common())
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.directory / f'{handler}-{datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")}.folded'
+        with open(path, 'w') as f:
+            f.write(folded + '\n')
+
+        self.results.append((handler, str(path), folded))
+        print(f'Profile of {handler} ({seconds:.3f} s, {sum(stacks.values())} samples) is saved to {path}')
+
+
+def serve_metrics(host: str, port: int) -> ThreadingHTTPServer:
+    """
+    Serve /metrics and /profile in background thread on internal port, they are not exposed with operator routes
+
+    :param host: host to listen, local only by default
+    :param port: port to listen
+
+    :returns: server
+    """
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.split('?')[0]
+
+            if path == '/metrics':
+                self.reply(registry.render(), 'text/plain; version=0.0.4')
+            elif path == '/profile':
+                profiles = [{'handler': x, 'path': y, 'folded': z} for x, y, z in profiler.results]
+                self.reply(json.dumps({'profiles': profiles}), 'application/json')
+            else:
+                self.send_error(404)
+
+        def do_POST(self):
+            # next runs of handler are profiled, e.g. POST /profile?handler=web.polling&count=1
+            if self.path.split('?')[0] != '/profile':
+                self.send_error(404)
+                return
+
+            query = parse_qs(urlparse(self.path).query)
+            handler = query.get('handler', ['web.polling'])[0]
+
+            try:
+                profiler.arm(handler, int(query.get('count', [1])[0]))
+            except ValueError:
+                self.send_error(400)
+                return
+
+            self.reply(json.dumps({'status': 'ok', 'handler': handler}), 'application/json')
+
+        def reply(self, text: str, content_type: str):
+            body = text.encode()
+
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+
+    return server
+
+
+profiler = SamplingProfiler()
@@ -0,0 +1,116 @@
+import math
+import re
+from collections import Counter, defaultdict
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+
+_non_word = re.compile(r'[^\w]+')
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normalize text for lexical matching: case, punctuation, whitespace
+
+    :param text: text to normalize
+
+    :returns: normalized text
+    """
+    text = text.lower().replace('ё', 'е')
+    return _non_word.sub(' ', text).strip()
+
+
+def char_ngrams(text: str, n: int = 3) -> List[str]:
+    """
+    Split normalized text to character n-grams
+
+    :param text: text to split
+
+    :param n: size of n-gram
+
+    :returns: list of n-grams
+    """
+    text = f' {normalize_text(text)} '
+    return [text[i:i + n] for i in range(len(text) - n + 1)]
+
+
+class LexicalIndex:
+    def __init__(self, texts: List[str], n: int = 3, k1: float = 1.2, b: float = .75):
+        self.n = n
+        self.size = len(texts)
+
+        docs = [Counter(char_ngrams(x, n)) for x in texts]
+        self.doc_grams = [frozenset(x) for x in docs]
+
+        lengths = np.array([sum(x.values()) for x in docs], dtype=np.float32)
+        avg_length = float(lengths.mean()) if len(lengths) else 0.0
+
+        postings: Dict[str, List[Tuple[int, float]]] = defaultdict(list)
+        for doc_id, grams in enumerate(docs):
+            norm = k1 * (1 - b + b * lengths[doc_id] / max(avg_length, 1e-6))
+            for gram, tf in grams.items():
+                postings[gram].append((doc_id, tf * (k1 + 1) / (tf + norm)))
+
+        # precomputed bm25 weights, so query scoring is a few vectorized additions
+        self.postings: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        for gram, items in postings.items():
+            idf = math.log(1 + (self.size - len(items) + .5) / (len(items) + .5))
+            doc_ids = np.array([x[0] for x in items], dtype=np.int64)
+            weights = np.array([x[1] for x in items], dtype=np.float32) * idf
+            self.postings[gram] = (doc_ids, weights)
+
+    def search(self, query: str, k: int = 20) -> List[Tuple[int, float]]:
+        """
+        Find k best documents by bm25 over character n-grams
+
+        :param query: query text
+
+        :param k: count of documents
+
+        :returns: list of (document index, score) pairs sorted by score
+        """
+        scores = np.zeros(self.size, dtype=np.float32)
+        for gram, count in Counter(char_ngrams(query, self.n)).items():
+            if gram in self.postings:
+                doc_ids, weights = self.postings[gram]
+                scores[doc_ids] += weights * count
+
+        matched = np.flatnonzero(scores)
+        if len(matched) > k:
+            matched = matched[np.argpartition(-scores[matched], k - 1)[:k]]
+
+        matched = matched[np.argsort(-scores[matched])]
+        return [(int(x), float(scores[x])) for x in matched]
+
+    def containment(self, query: str, doc_id: int) -> float:
+        """
+        Get share of query n-grams, which are present in document
+
+        :param query: query text
+
+        :param doc_id: document index
+
+        :returns: value from 0 to 1
+        """
+        grams = set(char_ngrams(query, self.n))
+        if not grams:
+            return 0.0
+
+        return len(grams & self.doc_grams[doc_id]) / len(grams)
+
+    def coverage(self, query: str, doc_id: int) -> float:
+        """
+        Get share of document n-grams, which are present in query
+
+        :param query: query text
+
+        :param doc_id: document index
+
+        :returns: value from 0 to 1
+        """
+        grams = self.doc_grams[doc_id]
+        if not grams:
+            return 0.0
+
+        return len(grams & set(char_ngrams(query, self.n))) / len(grams)
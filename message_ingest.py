@@ -0,0 +1,156 @@
+import datetime
+import json
+import os
+import threading
+from time import perf_counter, sleep
+from typing import TYPE_CHECKING
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import registry
+from user_state import UserState, UserStateStore
+
+if TYPE_CHECKING:
+    from webserver import WebServer
+
+
+INGEST_OK = 'ok'
+INGEST_CLOSED = 'closed'
+INGEST_FAILED = 'failed'
+
+retries_metric = registry.counter('katyax_ingest_retries_total', 'Count of retried deliveries of user messages to webserver')
+dead_letters_metric = registry.counter('katyax_ingest_dead_letters_total', 'Count of user messages, which were not delivered to webserver')
+
+
+def latency_metric(mode: str):
+    return registry.histogram('katyax_ingest_seconds', 'Time of delivering user message to ticket', labels={'mode': mode})
+
+
+class MessageIngest:
+    mode = 'none'
+
+    def ingest(self, state: UserState, text: str, date) -> str:
+        """
+        Deliver message of user to his open ticket
+
+        :param state: state of user in conversation
+
+        :param text: text of message
+        :param date: timestamp of message
+
+        :returns: INGEST_OK, INGEST_CLOSED if ticket was closed or INGEST_FAILED
+        """
+        started_at = perf_counter()
+
+        try:
+            return self._ingest(state, text, date)
+        finally:
+            latency_metric(self.mode).observe(perf_counter() - started_at)
+
+    def _ingest(self, state: UserState, text: str, date) -> str:
+        raise NotImplementedError
+
+
+class LocalIngest(MessageIngest):
+    mode = 'local'
+
+    def __init__(self, webserver: 'WebServer'):
+        self.webserver = webserver
+
+    def _ingest(self, state: UserState, text: str, date) -> str:
+        # message is written to the shared store and bus directly, without http round-trip
+        return self.webserver.ingest_user_message(state.ticket_id, str(state.user_id), text, date)
+
+
+class HttpIngest(MessageIngest):
+    mode = 'http'
+
+    def __init__(self, states: UserStateStore, url: str = None, retries: int = None, backoff: float = None, timeout: float = None, dead_letter: str = None):
+        self.states = states
+        self.url = url or f'http://{os.getenv("REMOTE_ADDR")}:{os.getenv("FLASK_PORT")}'
+        self.retries = retries if retries is not None else int(os.getenv('INGEST_RETRIES', 3))
+        self.backoff = backoff if backoff is not None else float(os.getenv('INGEST_BACKOFF', .2))
+        self.timeout = timeout if timeout is not None else float(os.getenv('INGEST_TIMEOUT', 5))
+        self.dead_letter = dead_letter or os.getenv('INGEST_DEAD_LETTER', 'dead_letters.jsonl')
+
+        # keep-alive connections are reused by all handler threads
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=int(os.getenv('BOT_WORKERS', 8))))
+
+        self._dead_letter_lock = threading.Lock()
+
+    def _ingest(self, state: UserState, text: str, date) -> str:
+        token = state.token or self.states.renew_token(state)
+        error = None
+
+        for attempt in range(self.retries + 1):
+            if attempt:
+                retries_metric.inc()
+                sleep(self.backoff * 2 ** (attempt - 1))
+
+            try:
+                response = self.session.post(f'{self.url}/{token}/store_user_message', params={'message': text, 'date': date}, timeout=self.timeout)
+                data = response.json() if response.status_code == 200 else {}
+            except (requests.RequestException, ValueError) as e:
+                error = e
+                continue
+
+            if data.get('status') in (INGEST_OK, INGEST_CLOSED):
+                return data['status']
+
+            # expired or broken token is answered with error, new one is tried on next attempt
+            error = data.get('error') or f'status code {response.status_code}'
+            if data.get('error'):
+                token = self.states.renew_token(state)
+
+        self.save_dead_letter(state, text, date, error)
+        return INGEST_FAILED
+
+    def save_dead_letter(self, state: UserState, text: str, date, error):
+        """
+        Append undelivered message to dead letter file
+
+        :returns: None
+        """
+        dead_letters_metric.inc()
+        print(f'Failed to deliver message of user {state.telegram_id} to ticket {state.ticket_id}: {error}')
+
+        record = {
+            'ticket_id': state.ticket_id,
+            'user_id': state.user_id,
+            'telegram_id': state.telegram_id,
+            'date': date,
+            'message': text,
+            'error': str(error),
+            'failed_at': datetime.datetime.now().timestamp(),
+        }
+
+        with self._dead_letter_lock, open(self.dead_letter, 'a') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+
+def create_ingest(webserver: 'WebServer', states: UserStateStore, mode: str = None, serves_operators: bool = False) -> MessageIngest:
+    """
+    Create message ingest by mode
+
+    :param webserver: webserver of this process
+
+    :param states: states of users
+
+    :param mode: local or http, MESSAGE_INGEST env by default
+
+    :param serves_operators: webserver of this process serves operator pages, e.g. in webhook mode
+
+    :returns: message ingest
+    """
+    # local messages reach operators, if they are connected to this process or come through database bus
+    is_local = serves_operators or os.getenv('MESSAGE_BUS', 'memory') == 'database'
+    mode = mode or os.getenv('MESSAGE_INGEST', 'local' if is_local else 'http')
+
+    if mode == 'local':
+        return LocalIngest(webserver)
+    elif mode == 'http':
+        return HttpIngest(states)
+
+    raise ValueError(f'unknown message ingest {mode}, expected local or http')
@@ -0,0 +1,277 @@
+import bisect
+import os
+import sys
+import threading
+from collections import OrderedDict
+from time import monotonic
+from typing import Dict, List, Optional, Tuple
+
+from metrics import registry
+from schemes import ConversationThread, get_conversation_messages
+
+
+buffers_metric = registry.gauge('katyax_ticket_buffers', 'Count of tickets buffered in memory')
+buffer_bytes_metric = registry.gauge('katyax_ticket_buffer_bytes', 'Estimated memory of buffered ticket messages')
+buffer_fallbacks_metric = registry.counter('katyax_ticket_buffer_fallbacks_total', 'Count of reads older than buffer served from database')
+buffer_evictions_metric = registry.counter('katyax_ticket_buffer_evictions_total', 'Count of tickets evicted from memory')
+
+# (date, id) of the last delivered message, messages are delivered in order of id,
+# as dates of user messages are set by telegram and may be older than delivered ones
+Cursor = Tuple[float, int]
+
+
+def message_key(message: ConversationThread) -> Tuple[float, int]:
+    return float(message.date), int(message.id or 0)
+
+
+def message_memory(message: ConversationThread) -> int:
+    # key, message object and its fields
+    size = sys.getsizeof(message.id) + sys.getsizeof(message) + sys.getsizeof(message.__dict__)
+    return size + sum(sys.getsizeof(x) for x in message.__dict__.values())
+
+
+class TicketBuffer:
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+
+        # keys and messages are kept sorted by id
+        self.keys: List[int] = []
+        self.messages: List[ConversationThread] = []
+
+        # false when older messages were dropped and live only in database
+        self.complete = True
+        self.touched_at = monotonic()
+
+        # estimated memory is kept up to date on every change
+        self.size = sys.getsizeof(self) + sys.getsizeof(self.keys) + sys.getsizeof(self.messages)
+
+    def add(self, message: ConversationThread) -> bool:
+        """
+        Insert message keeping order, oldest messages are dropped over capacity
+
+        :param message: message of ticket
+
+        :returns: False if message is already buffered
+        """
+        key = int(message.id)
+        position = bisect.bisect_left(self.keys, key)
+
+        if position < len(self.keys) and self.keys[position] == key:
+            return False
+
+        self.keys.insert(position, key)
+        self.messages.insert(position, message)
+        self.size += message_memory(message)
+
+        excess = len(self.keys) - self.capacity
+        if excess > 0:
+            self.size -= sum(message_memory(x) for x in self.messages[:excess])
+
+            del self.keys[:excess]
+            del self.messages[:excess]
+            self.complete = False
+
+        return True
+
+    def covers(self, cursor: Cursor) -> bool:
+        # messages after cursor are all in memory
+        return self.complete or (bool(self.keys) and cursor[1] >= self.keys[0])
+
+    def since(self, cursor: Cursor) -> List[ConversationThread]:
+        return self.messages[bisect.bisect_right(self.keys, cursor[1]):]
+
+    def memory(self) -> int:
+        """
+        Estimate memory of buffered messages
+
+        :returns: size in bytes
+        """
+        return self.size
+
+
+class MessageStore:
+    def __init__(self, engine, capacity: int = None, idle_ttl: float = None, closed_size: int = 10000):
+        self.engine = engine
+        self.capacity = capacity if capacity is not None else int(os.getenv('TICKET_BUFFER_SIZE', 500))
+        self.idle_ttl = idle_ttl if idle_ttl is not None else float(os.getenv('TICKET_IDLE_TTL', 1800))
+
+        self._buffers: Dict[str, TicketBuffer] = {}
+        self._lock = threading.Lock()
+        self._swept_at = monotonic()
+
+        # closed tickets get no new messages and are never buffered again
+        self._closed: 'OrderedDict[str, None]' = OrderedDict()
+        self._closed_size = closed_size
+
+        # running total of buffer sizes, buffers are not walked to export metrics
+        self._memory = 0
+
+    def __contains__(self, ticket_id: str) -> bool:
+        return ticket_id in self._buffers
+
+    def load(self, ticket_id: str, messages: List[ConversationThread] = None, complete: bool = True) -> Optional[TicketBuffer]:
+        """
+        Buffer latest messages of ticket
+
+        :param ticket_id: id of ticket
+
+        :param messages: latest messages of conversation by id, they are read from database if not given
+
+        :param complete: whether messages are the whole conversation
+
+        :returns: buffer of ticket or None for closed ticket
+        """
+        if ticket_id in self._closed:
+            return None
+
+        if messages is None:
+            messages, has_more = get_conversation_messages(self.engine, ticket_id, limit=self.capacity)
+            complete = not has_more
+
+        buffer = TicketBuffer(self.capacity)
+        buffer.complete = complete
+
+        for message in messages:
+            buffer.add(message)
+
+        with self._lock:
+            # ticket may be closed while conversation was read
+            if ticket_id in self._closed:
+                return None
+
+            # messages delivered while conversation was read are kept
+            previous = self._buffers.get(ticket_id)
+            if previous is not None:
+                for message in previous.messages:
+                    buffer.add(message)
+
+                self._memory -= previous.size
+
+            self._buffers[ticket_id] = buffer
+            self._memory += buffer.size
+
+        self._sweep()
+        self._update_metrics()
+
+        return buffer
+
+    def ensure(self, ticket_id: str) -> Optional[TicketBuffer]:
+        buffer = self._buffers.get(ticket_id)
+        return buffer if buffer is not None else self.load(ticket_id)
+
+    def append(self, ticket_id: str, message: ConversationThread) -> bool:
+        """
+        Add new message to buffer of ticket, tickets, which are not buffered, are skipped
+
+        :param ticket_id: id of ticket
+
+        :param message: new message
+
+        :returns: True if message was added
+        """
+        with self._lock:
+            buffer = self._buffers.get(ticket_id)
+            added = False
+
+            if buffer is not None:
+                size = buffer.size
+                added = buffer.add(message)
+
+                buffer.touched_at = monotonic()
+                self._memory += buffer.size - size
+
+        if added:
+            self._update_metrics()
+
+        self._sweep()
+        return added
+
+    def peek(self, ticket_id: str, cursor: Cursor) -> Optional[List[ConversationThread]]:
+        """
+        Get messages after cursor from memory only, it is safe to call under other locks
+
+        :param ticket_id: id of ticket
+
+        :param cursor: (date, id) of last delivered message
+
+        :returns: messages sorted by id or None if they are not in memory
+        """
+        with self._lock:
+            buffer = self._buffers.get(ticket_id)
+            if buffer is None or not buffer.covers(cursor):
+                return None
+
+            buffer.touched_at = monotonic()
+            return buffer.since(cursor)
+
+    def since(self, ticket_id: str, cursor: Cursor) -> List[ConversationThread]:
+        """
+        Get messages after cursor, older history than buffer is read from database
+
+        :param ticket_id: id of ticket
+
+        :param cursor: (date, id) of last delivered message
+
+        :returns: messages sorted by id
+        """
+        self.ensure(ticket_id)
+
+        messages = self.peek(ticket_id, cursor)
+        if messages is not None:
+            return messages
+
+        buffer_fallbacks_metric.inc()
+        return get_conversation_messages(self.engine, ticket_id, after_id=cursor[1])[0]
+
+    def evict(self, ticket_id: str, closed: bool = False):
+        """
+        Drop buffer of ticket
+
+        :param ticket_id: id of ticket
+
+        :param closed: ticket is closed and must not be buffered again
+
+        :returns: None
+        """
+        with self._lock:
+            buffer = self._buffers.pop(ticket_id, None)
+
+            if buffer is not None:
+                self._memory -= buffer.size
+                buffer_evictions_metric.inc()
+
+            if closed:
+                self._closed[ticket_id] = None
+
+                if len(self._closed) > self._closed_size:
+                    self._closed.popitem(last=False)
+
+        self._update_metrics()
+
+    def _sweep(self):
+        now = monotonic()
+        if now - self._swept_at < min(self.idle_ttl / 10, 60):
+            return
+
+        with self._lock:
+            self._swept_at = now
+            idle = [k for k, v in self._buffers.items() if now - v.touched_at > self.idle_ttl]
+
+            for ticket_id in idle:
+                self._memory -= self._buffers.pop(ticket_id).size
+
+        buffer_evictions_metric.inc(len(idle))
+        self._update_metrics()
+
+    def memory_usage(self) -> Dict[str, int]:
+        """
+        Estimate memory of every buffered ticket
+
+        :returns: size in bytes by ticket id
+        """
+        with self._lock:
+            return {k: v.memory() for k, v in self._buffers.items()}
+
+    def _update_metrics(self):
+        buffers_metric.set(len(self._buffers))
+        buffer_bytes_metric.set(self._memory)
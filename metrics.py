@@ -0,0 +1,152 @@
+import bisect
+import threading
+from typing import Dict, List, Optional, Sequence
+
+
+def format_labels(labels: Dict[str, str]) -> str:
+    # values are escaped as prometheus text format requires
+    def escape(value) -> str:
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    return ','.join(f'{k}="{escape(v)}"' for k, v in sorted(labels.items()))
+
+
+def metric_key(name: str, labels: Optional[Dict[str, str]] = None) -> str:
+    """
+    Get key of metric with labels, e.g. name{handler="start"}
+
+    :param name: name of metric
+
+    :param labels: labels of metric
+
+    :returns: key of metric
+    """
+    if not labels:
+        return name
+
+    return name + '{' + format_labels(labels) + '}'
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str = '', labels: Dict[str, str] = None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels or {}
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+
+class Gauge:
+    def __init__(self, name: str, documentation: str = '', labels: Dict[str, str] = None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels or {}
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def set(self, value: float):
+        with self._lock:
+            self.value = value
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1):
+        with self._lock:
+            self.value -= amount
+
+
+class Histogram:
+    DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+    def __init__(self, name: str, documentation: str = '', labels: Dict[str, str] = None, buckets: Sequence[float] = None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels or {}
+        self.buckets = tuple(sorted(buckets or self.DEFAULT_BUCKETS))
+
+        # last bucket is +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sum += value
+            self.count += 1
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: Dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, documentation, labels, *args, **kwargs):
+        key = metric_key(name, labels)
+
+        with self._lock:
+            if key not in self.metrics:
+                self.metrics[key] = cls(name, documentation, labels, *args, **kwargs)
+
+            metric = self.metrics[key]
+
+        if not isinstance(metric, cls):
+            raise ValueError(f'metric {key} is already registered as {type(metric).__name__}')
+
+        return metric
+
+    def counter(self, name: str, documentation: str = '', labels: Dict[str, str] = None) -> Counter:
+        return self._get_or_create(Counter, name, documentation, labels)
+
+    def gauge(self, name: str, documentation: str = '', labels: Dict[str, str] = None) -> Gauge:
+        return self._get_or_create(Gauge, name, documentation, labels)
+
+    def histogram(self, name: str, documentation: str = '', buckets: Sequence[float] = None, labels: Dict[str, str] = None) -> Histogram:
+        return self._get_or_create(Histogram, name, documentation, labels, buckets)
+
+    def render(self) -> str:
+        """
+        Render all metrics in prometheus text format
+
+        :returns: text of metrics
+        """
+        # metrics with different labels share one header
+        families: Dict[str, List[object]] = {}
+        for metric in list(self.metrics.values()):
+            families.setdefault(metric.name, []).append(metric)
+
+        lines = []
+        for name, metrics in sorted(families.items()):
+            kind = {Counter: 'counter', Gauge: 'gauge', Histogram: 'histogram'}[type(metrics[0])]
+
+            lines.append(f'# HELP {name} {metrics[0].documentation}')
+            lines.append(f'# TYPE {name} {kind}')
+
+            for metric in metrics:
+                if not isinstance(metric, Histogram):
+                    lines.append(f'{metric_key(name, metric.labels)} {float(metric.value)!r}')
+                    continue
+
+                with metric._lock:
+                    counts, total, count = list(metric.counts), metric.sum, metric.count
+
+                cumulative = 0
+                for bound, bucket_count in zip(metric.buckets + (float('inf'),), counts):
+                    cumulative += bucket_count
+                    le = '+Inf' if bound == float('inf') else repr(float(bound))
+                    lines.append(f'{metric_key(name + "_bucket", {**metric.labels, "le": le})} {cumulative}')
+
+                lines.append(f'{metric_key(name + "_sum", metric.labels)} {float(total)!r}')
+                lines.append(f'{metric_key(name + "_count", metric.labels)} {count}')
+
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
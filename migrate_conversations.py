@@ -0,0 +1,102 @@
+import argparse
+from time import perf_counter
+
+from sqlalchemy import inspect, insert, text, update
+from sqlmodel import Session, select
+
+from schemes import ConversationMessage, UserTicket, engine
+
+
+def migrate_ticket(connection, user_ticket: UserTicket, batch_size: int) -> int:
+    """
+    Copy messages of per-ticket table to conversation message table in batches
+
+    :param connection: database connection
+    :param user_ticket: ticket to migrate
+
+    :param batch_size: count of rows inserted by one statement
+
+    :returns: count of copied messages
+    """
+    table = connection.dialect.identifier_preparer.quote(user_ticket.ticket_id)
+    rows = connection.execute(text(f'SELECT user_id, date, message FROM {table} ORDER BY id'))
+
+    copied = 0
+    while True:
+        batch = rows.fetchmany(batch_size)
+        if not batch:
+            break
+
+        connection.execute(insert(ConversationMessage.__table__), [{
+            'user_ticket_id': user_ticket.id,
+            'ticket_id': user_ticket.ticket_id,
+            'user_id': int(x.user_id),
+            'date': float(x.date),
+            'message': x.message,
+        } for x in batch])
+        copied += len(batch)
+
+    return copied
+
+
+def backfill_user_ticket_ids(engine) -> int:
+    """
+    Set missing reference to ticket, first messages of tickets were stored without it
+
+    :param engine: database engine
+
+    :returns: count of fixed messages
+    """
+    table = ConversationMessage.__table__
+    user_ticket_id = select(UserTicket.id).where(UserTicket.ticket_id == table.c.ticket_id).scalar_subquery()
+
+    with engine.begin() as connection:
+        result = connection.execute(update(table).where(table.c.user_ticket_id == None).values(user_ticket_id=user_ticket_id))
+
+    return result.rowcount
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Move messages of per-ticket tables to conversation message table')
+    parser.add_argument('--batch-size', type=int, default=1000, help='count of rows inserted by one statement')
+    parser.add_argument('--force', action='store_true', help='copy tickets, which already have messages in new table')
+    parser.add_argument('--drop', action='store_true', help='drop per-ticket tables after copy')
+    args = parser.parse_args()
+
+    ConversationMessage.__table__.create(engine, checkfirst=True)
+
+    with Session(engine) as session:
+        user_tickets = session.exec(select(UserTicket).order_by(UserTicket.id)).all()
+
+    tables = set(inspect(engine).get_table_names())
+    started_at = perf_counter()
+    migrated, skipped, copied = 0, 0, 0
+
+    for user_ticket in user_tickets:
+        if user_ticket.ticket_id not in tables:
+            continue
+
+        # every ticket is copied in own transaction, so interrupted migration can be resumed
+        with engine.begin() as connection:
+            exists = connection.execute(select(ConversationMessage.id).where(ConversationMessage.ticket_id == user_ticket.ticket_id).limit(1)).first()
+
+            if exists is not None and not args.force:
+                skipped += 1
+            else:
+                if exists is not None:
+                    connection.execute(ConversationMessage.__table__.delete().where(ConversationMessage.ticket_id == user_ticket.ticket_id))
+
+                copied += migrate_ticket(connection, user_ticket, args.batch_size)
+                migrated += 1
+
+            if args.drop:
+                table = connection.dialect.identifier_preparer.quote(user_ticket.ticket_id)
+                connection.execute(text(f'DROP TABLE {table}'))
+
+    fixed = backfill_user_ticket_ids(engine)
+
+    print(f'migrated tickets: {migrated}, skipped tickets: {skipped}, copied messages: {copied}, fixed references: {fixed}, seconds: {perf_counter() - started_at:.2f}')
+
+
+if __name__ == '__main__':
+    main()
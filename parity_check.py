@@ -0,0 +1,93 @@
+import argparse
+import os
+import pathlib
+import sys
+from time import perf_counter
+from typing import List
+
+import numpy as np
+
+from answer_index import parse_md_answers
+from encoders import Encoder, create_encoder
+
+
+def timed_encode(encoder: Encoder, texts: List[str]):
+    started_at = perf_counter()
+    embeddings = encoder.encode(texts)
+    return embeddings, perf_counter() - started_at
+
+
+def check_parity(reference: Encoder, candidate: Encoder, answers: List[str], questions: List[str]) -> dict:
+    """
+    Compare retrieval of candidate encoder with reference encoder
+
+    :param reference: reference encoder, usually torch one
+
+    :param candidate: encoder to check
+
+    :param answers: parsed answers
+
+    :param questions: questions to retrieve answers for
+
+    :returns: report with embedding similarity, top-1 agreement and encode time
+    """
+    answer_texts = ['<A>' + x for x in answers]
+    question_texts = ['<Q>' + x for x in questions]
+
+    reference_answers, reference_answers_time = timed_encode(reference, answer_texts)
+    candidate_answers, candidate_answers_time = timed_encode(candidate, answer_texts)
+    reference_questions, reference_questions_time = timed_encode(reference, question_texts)
+    candidate_questions, candidate_questions_time = timed_encode(candidate, question_texts)
+
+    # embeddings are normalized, so row-wise dot product is cosine
+    cosine = np.concatenate([(reference_answers * candidate_answers).sum(axis=1), (reference_questions * candidate_questions).sum(axis=1)])
+
+    reference_top = np.argmax(reference_questions @ reference_answers.T, axis=1)
+    candidate_top = np.argmax(candidate_questions @ candidate_answers.T, axis=1)
+
+    return {
+        'answers': len(answers),
+        'questions': len(questions),
+        'cosine_mean': float(cosine.mean()),
+        'cosine_min': float(cosine.min()),
+        'top1_agreement': float((reference_top == candidate_top).mean()),
+        'reference_seconds': reference_answers_time + reference_questions_time,
+        'candidate_seconds': candidate_answers_time + candidate_questions_time,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check retrieval parity of encoder backend against torch backend')
+    parser.add_argument('--backend', default='onnx-int8', help='encoder backend to check')
+    parser.add_argument('--reference', default='torch', help='reference encoder backend')
+    parser.add_argument('--model-id', default='clips/mfaq')
+    parser.add_argument('--answers', default=os.getenv('ANSWERS_FILE', 'answers.md'), help='markdown file with answers')
+    parser.add_argument('--questions', default='parity_questions.txt', help='file with one held-out question per line')
+    parser.add_argument('--min-agreement', type=float, default=1.0, help='fail if top-1 agreement is lower')
+    args = parser.parse_args()
+
+    basement = pathlib.Path(__file__).parent.absolute()
+    answers = parse_md_answers(basement / args.answers)
+
+    # answers as questions agree trivially, drift of int8 shows only on paraphrased questions
+    with open(basement / args.questions, 'r') as f:
+        questions = [x.strip() for x in f if x.strip()]
+
+    if not questions:
+        print(f'no questions in {args.questions}')
+        sys.exit(1)
+
+    reference = create_encoder(args.model_id, args.reference)
+    candidate = create_encoder(args.model_id, args.backend)
+
+    report = check_parity(reference, candidate, answers, questions)
+    for key, value in report.items():
+        print(f'{key}: {value}')
+
+    if report['top1_agreement'] < args.min_agreement:
+        print(f'top-1 agreement {report["top1_agreement"]:.3f} is lower than {args.min_agreement:.3f}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+import os
+from typing import Dict, Tuple, Type
+
+import numpy as np
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Get indexes of k largest scores in every row, sorted by score
+
+    :param scores: matrix of scores
+
+    :param k: count of indexes
+
+    :returns: matrix of indexes
+    """
+    k = min(k, scores.shape[1])
+    if k < scores.shape[1]:
+        # partial selection instead of sorting all the scores
+        indices = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        indices = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+
+    order = np.argsort(-np.take_along_axis(scores, indices, axis=1), axis=1)
+    return np.take_along_axis(indices, order, axis=1)
+
+
+class RetrievalBackend:
+    def __init__(self, embeddings: np.ndarray):
+        self.embeddings = embeddings
+
+    def top_k(self, query_embeddings: np.ndarray, k: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find k nearest answers for every normalized query embedding
+
+        :param query_embeddings: matrix of normalized query embeddings
+
+        :param k: count of answers for every query
+
+        :returns: matrix of answer indexes and matrix of scores, -1 marks missing answer
+        """
+        raise NotImplementedError
+
+
+class ExactSearch(RetrievalBackend):
+    def top_k(self, query_embeddings: np.ndarray, k: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+        queries = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+        scores = queries @ self.embeddings.T
+
+        indices = top_k_indices(scores, k)
+        return indices, np.take_along_axis(scores, indices, axis=1)
+
+
+class IVFSearch(RetrievalBackend):
+    def __init__(self, embeddings: np.ndarray, n_lists: int = None, n_probe: int = None, iterations: int = 10, seed: int = 0):
+        super().__init__(embeddings)
+
+        n_lists = n_lists or int(os.getenv('IVF_NLIST', 0)) or int(np.sqrt(len(embeddings)))
+        self.n_lists = max(1, min(n_lists, len(embeddings)))
+
+        # recall/latency knob: more probed lists give better recall and slower search
+        self.n_probe = max(1, min(n_probe or int(os.getenv('IVF_NPROBE', 8)), self.n_lists))
+
+        self.centroids = self._train(np.asarray(embeddings, dtype=np.float32), iterations, seed)
+
+        # store vectors grouped by list, so every probe reads contiguous memory
+        assignments = self._assign(embeddings)
+        self.ids = np.argsort(assignments, kind='stable')
+        self.vectors = np.ascontiguousarray(embeddings[self.ids], dtype=np.float32)
+        self.offsets = np.searchsorted(assignments[self.ids], np.arange(self.n_lists + 1))
+
+    def _assign(self, embeddings: np.ndarray, chunk_size: int = 65536) -> np.ndarray:
+        assignments = np.empty(len(embeddings), dtype=np.int64)
+        for start in range(0, len(embeddings), chunk_size):
+            chunk = np.asarray(embeddings[start:start + chunk_size], dtype=np.float32)
+            assignments[start:start + chunk_size] = np.argmax(chunk @ self.centroids.T, axis=1)
+
+        return assignments
+
+    def _train(self, embeddings: np.ndarray, iterations: int, seed: int) -> np.ndarray:
+        """
+        Train centroids with spherical k-means
+
+        :returns: matrix of normalized centroids
+        """
+        rng = np.random.default_rng(seed)
+
+        sample = embeddings
+        if len(embeddings) > self.n_lists * 256:
+            sample = embeddings[rng.choice(len(embeddings), self.n_lists * 256, replace=False)]
+
+        centroids = sample[rng.choice(len(sample), self.n_lists, replace=False)].copy()
+
+        for _ in range(iterations):
+            assignments = np.argmax(sample @ centroids.T, axis=1)
+
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, sample)
+
+            # reseed empty lists with random points
+            empty = np.bincount(assignments, minlength=self.n_lists) == 0
+            sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+
+            centroids = sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12)
+
+        return centroids
+
+    def top_k(self, query_embeddings: np.ndarray, k: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+        queries = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+
+        # lists without vectors are never probed, so every query gets candidates
+        centroid_scores = queries @ self.centroids.T
+        centroid_scores[:, np.diff(self.offsets) == 0] = -np.inf
+
+        probes = top_k_indices(centroid_scores, self.n_probe)
+
+        for i, query in enumerate(queries):
+            rows = np.concatenate([np.arange(self.offsets[c], self.offsets[c + 1]) for c in probes[i]])
+
+            candidate_scores = self.vectors[rows] @ query
+            best = top_k_indices(candidate_scores[None, :], k)[0]
+
+            indices[i, :len(best)] = self.ids[rows[best]]
+            scores[i, :len(best)] = candidate_scores[best]
+
+        return indices, scores
+
+
+BACKENDS: Dict[str, Type[RetrievalBackend]] = {
+    'exact': ExactSearch,
+    'ivf': IVFSearch,
+}
+
+
+def create_backend(embeddings: np.ndarray, name: str = None) -> RetrievalBackend:
+    """
+    Create retrieval backend by name
+
+    :param embeddings: matrix of normalized answer embeddings
+
+    :param name: name of backend, RETRIEVAL_BACKEND env by default
+
+    :returns: retrieval backend
+    """
+    name = name or os.getenv('RETRIEVAL_BACKEND', 'exact')
+
+    if name not in BACKENDS:
+        raise ValueError(f'unknown retrieval backend {name}, expected one of {", ".join(BACKENDS)}')
+
+    return BACKENDS[name](embeddings)
@@ -1,18 +1,56 @@
-from webserver import WebServer
-from bot import EchoBot
+import argparse
 import os
-from schemes import engine
-from flask_cors import CORS
-from wsgiserver import WSGIServer
+import sys
+from startup import StartupProfiler
 
-if __name__ == '__main__':
-    bot = EchoBot(engine)
-    webserver = WebServer(__name__, engine, bot)
-    CORS(webserver, resources={r"/*": {"origins": "*"}})
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--profile-startup', action='store_true', help='print startup phases report and exit')
+    parser.add_argument('--profile-output', default=None, help='write startup report to json file')
+    args = parser.parse_args()
+
+    profiler = StartupProfiler(enabled=args.profile_startup)
+
+    with profiler.phase('import schemes'):
+        from schemes import engine
+
+    with profiler.phase('import bot'):
+        from bot import EchoBot
+
+    with profiler.phase('import server extensions'):
+        from flask_cors import CORS
+        from wsgiserver import WSGIServer
+
+    with profiler.phase('init bot'):
+        bot = EchoBot(engine)
+
+    with profiler.phase('init webserver'):
+        # bot builds the webserver it sends messages through, a second one would have own bus, hub and buffers
+        webserver = bot.webserver
+        CORS(webserver, resources={r"/*": {"origins": "*"}})
+
+    if args.profile_startup:
+        print(profiler.report())
+        if args.profile_output:
+            profiler.dump(args.profile_output)
+
+        # webserver must start without model stack
+        sys.exit(1 if profiler.heavy_modules() else 0)
+
+    # metrics and profiler are not exposed on the public port of operators
+    if os.getenv('METRICS_PORT'):
+        from instrumentation import serve_metrics
+        serve_metrics(os.getenv('METRICS_HOST', '127.0.0.1'), int(os.getenv('METRICS_PORT')))
 
     if os.getenv('FLAST_DEBUG'):
         webserver.run(host=os.getenv('FLASK_HOST'), port=os.getenv('FLASK_PORT'), debug=True)
-    
+
     else:
-        server = WSGIServer(webserver, host=os.getenv('FLASK_HOST'), port=int(os.getenv('FLASK_PORT')))
+        # every open operator stream holds one thread
+        server = WSGIServer(webserver, host=os.getenv('FLASK_HOST'), port=int(os.getenv('FLASK_PORT')), numthreads=int(os.getenv('FLASK_THREADS', 10)))
         server.start()
+
+
+if __name__ == '__main__':
+    main()
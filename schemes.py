@@ -1,7 +1,9 @@
 from sqlmodel import SQLModel, Field, select, create_engine
 from dataclasses import dataclass
-from sqlalchemy import text
-from typing import Optional
+from sqlalchemy import Index, and_, insert, or_
+from typing import List, Optional, Tuple
+from unit_of_work import session_scope
+from instrumentation import instrument_engine
 import os
 
 
@@ -45,6 +47,9 @@ class ConversationThread:
 
 
 class UserTicket(SQLModel, table=True):
+    # open ticket of user is looked up on every message in echo mode
+    __table_args__ = (Index('ix_userticket_user_id_is_solved', 'user_id', 'is_solved'),)
+
     id: Optional[int] = Field(default=None, primary_key=True)
     user_id: int = Field(default=None, index=True)
     ticket_id: str = Field(default=None, index=True)
@@ -54,46 +59,165 @@ class UserTicket(SQLModel, table=True):
         return {c.name: getattr(self, c.name) for c in self.__table__.columns}
 
 
-def create_conversation_table(user_id, session, engine):
-    # get all messages from user from last entry with is_solved = False
-    # create table with name = ticket_id
-    # insert all messages to table
-    messages = select(Message).where(Message.user_id == user_id, Message.is_solved == False)
-    case_message = session.exec(messages).all()[-1]
+# describe the event of message bus, shared by all web workers and the bot
+class BusEvent(SQLModel, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    ticket_id: str = Field(default=None, index=True)
+    origin: str = Field(default=None)
+    payload: str = Field(default=None)
+    created_at: float = Field(default=None, index=True)
+
+
+# describe message of ticket conversation, all tickets share one table
+class ConversationMessage(SQLModel, table=True):
+    __table_args__ = (Index('ix_conversationmessage_ticket_id_date', 'ticket_id', 'date'),)
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    user_ticket_id: int = Field(default=None, foreign_key='userticket.id')
+    ticket_id: str = Field(default=None)
+    user_id: int = Field(default=None)
+    date: float = Field(default=None)
+    message: str = Field(default=None)
+
+    def as_thread(self):
+        return ConversationThread(id=self.id, user_id=self.user_id, date=self.date, message=self.message)
+
+
+def create_indexes(engine):
+    # create_all creates indexes only with new tables
+    for table in SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
 
-    ticket_id = ConversationThread.generate_id(user_id)
-    
-    # create table with sql query
-    create_table_query = f'CREATE TABLE IF NOT EXISTS "{ticket_id}" ("id" SERIAL PRIMARY KEY, "user_id" INTEGER, "date" TEXT, "message" TEXT);'
-    with engine.connect() as conn:
-        conn.execute(text(create_table_query))
-        conn.commit()
+def get_open_ticket(session, user_id) -> Optional[UserTicket]:
+    # last opened ticket of user
+    ticket = select(UserTicket).where(UserTicket.user_id == user_id, UserTicket.is_solved == False).order_by(UserTicket.id.desc()).limit(1)
+    return session.exec(ticket).first()
 
-    add_conversation_message(engine, ticket_id, user_id=case_message.user_id, date=case_message.date, message=case_message.text)
 
-    return ticket_id
+def create_conversation(user_id, engine):
+    # get last message from user with is_solved = False
+    # create user ticket with new ticket_id
+    # insert the message as first message of conversation
+    with session_scope(engine) as session:
+        messages = select(Message).where(Message.user_id == user_id, Message.is_solved == False).order_by(Message.id.desc()).limit(1)
+        case_message = session.exec(messages).one()
+
+        ticket = UserTicket(user_id=user_id, ticket_id=ConversationThread.generate_id(user_id))
+        session.add(ticket)
+
+        # ticket is not visible to other sessions and to subquery before flush, its id is passed explicitly
+        session.flush()
+        insert_conversation_message(session, ticket.ticket_id, ticket.id, user_id=case_message.user_id, date=case_message.date, message=case_message.text)
+
+    return ticket.ticket_id
+
+
+def conversation_message_insert(ticket_id, user_ticket_id):
+    # ticket reference is a value or a subquery, which is resolved by the insert itself
+    return insert(ConversationMessage.__table__).values(ticket_id=ticket_id, user_ticket_id=user_ticket_id)
+
+
+def insert_conversation_message(session, ticket_id, user_ticket_id, user_id, date, message) -> int:
+    # id is taken from the insert itself, RETURNING on postgres and lastrowid on sqlite
+    result = session.execute(conversation_message_insert(ticket_id, user_ticket_id), {'user_id': int(user_id), 'date': float(date), 'message': message})
+
+    return result.inserted_primary_key[0]
 
 
 def add_conversation_message(engine, ticket_id, user_id, date, message):
-    query_ = f'''INSERT INTO "{ticket_id}" ("user_id", "date", "message") VALUES ('{user_id}', '{date}', '{message}');'''
-    with engine.connect() as conn:
-        conn.execute(text(query_))
-        conn.commit()
+    # ticket is already committed or flushed, its id is looked up by the insert itself
+    user_ticket_id = select(UserTicket.id).where(UserTicket.ticket_id == ticket_id).scalar_subquery()
+
+    with session_scope(engine) as session:
+        return insert_conversation_message(session, ticket_id, user_ticket_id, user_id, date, message)
+
+
+def add_conversation_messages(engine, ticket_id, messages: List[dict]) -> List[int]:
+    """
+    Insert many messages of ticket in one transaction
+
+    :param engine: database engine
+    :param ticket_id: id of ticket
+
+    :param messages: dicts with user_id, date and message
+
+    :returns: ids of inserted messages in the same order
+    """
+    if not messages:
+        return []
+
+    user_ticket_id = select(UserTicket.id).where(UserTicket.ticket_id == ticket_id).scalar_subquery()
+    rows = [{'user_id': int(x['user_id']), 'date': float(x['date']), 'message': x['message']} for x in messages]
+
+    with session_scope(engine) as session:
+        # postgres inserts the whole batch and returns its ids in one round-trip
+        if session.get_bind().dialect.insert_executemany_returning:
+            statement = conversation_message_insert(ticket_id, user_ticket_id).returning(ConversationMessage.__table__.c.id)
+            return [x.id for x in session.execute(statement, rows)]
+
+        return [insert_conversation_message(session, ticket_id, user_ticket_id, **x) for x in rows]
+
+
+def get_conversation_messages(engine, ticket_id, after_id: int = None, limit: int = None) -> Tuple[List[ConversationThread], bool]:
+    """
+    Get messages of ticket in order of delivery to operators
+
+    :param engine: database engine
+    :param ticket_id: id of ticket
+
+    :param after_id: id of last delivered message, messages from the start if None
+
+    :param limit: count of latest messages, all messages if None
+
+    :returns: messages sorted by id and whether older messages exist
+    """
+    with session_scope(engine) as session:
+        messages = select(ConversationMessage).where(ConversationMessage.ticket_id == ticket_id)
+
+        if after_id is not None:
+            messages = messages.where(ConversationMessage.id > after_id)
+
+        if limit is None:
+            return [x.as_thread() for x in session.exec(messages.order_by(ConversationMessage.id)).all()], False
+
+        # one extra row tells whether there are older messages
+        messages = messages.order_by(ConversationMessage.id.desc()).limit(limit + 1)
+        messages = [x.as_thread() for x in session.exec(messages).all()]
+
+    return messages[:limit][::-1], len(messages) > limit
+
+
+def get_conversation_page(engine, ticket_id, before: Tuple[float, int] = None, limit: int = 50) -> Tuple[List[ConversationThread], bool]:
+    """
+    Get latest messages of ticket older than cursor
+
+    :param engine: database engine
+    :param ticket_id: id of ticket
+
+    :param before: (date, id) of oldest loaded message, latest messages are returned if None
+
+    :param limit: count of messages
 
-    # get id of this query from table
-    query_ = f'''SELECT id FROM "{ticket_id}" WHERE "user_id" = '{user_id}' AND "date" = '{date}' AND "message" = '{message}';'''
-    with engine.connect() as conn:
-        result = conn.execute(text(query_)).fetchall()
+    :returns: messages sorted by date and whether older messages exist
+    """
+    with session_scope(engine) as session:
+        messages = select(ConversationMessage).where(ConversationMessage.ticket_id == ticket_id)
 
-    return result[0][0]
+        if before is not None:
+            date, id_ = before
+            messages = messages.where(or_(ConversationMessage.date < date, and_(ConversationMessage.date == date, ConversationMessage.id < id_)))
 
+        # one extra row tells whether there is a next page
+        messages = messages.order_by(ConversationMessage.date.desc(), ConversationMessage.id.desc()).limit(limit + 1)
+        messages = [x.as_thread() for x in session.exec(messages).all()]
 
-def get_conversation_messages(engine, ticket_id):
-    query_ = f'''SELECT * FROM "{ticket_id}";'''
-    with engine.connect() as conn:
-        result = conn.execute(text(query_)).fetchall()
+    has_more = len(messages) > limit
+    return messages[:limit][::-1], has_more
 
-    return [ConversationThread(id=row[0], user_id=row[1], date=row[2], message=row[3]) for row in result]
 
+engine = create_engine(os.getenv('SQLITE_DB'))
 
-engine = create_engine(os.getenv('SQLITE_DB'))
\ No newline at end of file
+# time of statements and transactions by type
+instrument_engine(engine)
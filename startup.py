@@ -0,0 +1,76 @@
+import json
+import sys
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from time import perf_counter
+from typing import List
+
+
+# modules, which must not be imported by processes without model
+HEAVY_MODULES = ('torch', 'transformers', 'sentence_transformers', 'onnxruntime', 'numpy')
+
+
+@dataclass
+class StartupPhase:
+    name: str
+    seconds: float
+    modules: List[str] = field(default_factory=list)
+
+
+class StartupProfiler:
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.phases: List[StartupPhase] = []
+        self.started_at = perf_counter()
+
+    @contextmanager
+    def phase(self, name: str):
+        """
+        Measure startup phase and modules imported during it
+
+        :param name: name of phase
+
+        :returns: context manager
+        """
+        if not self.enabled:
+            yield
+            return
+
+        modules_before = set(sys.modules)
+        started_at = perf_counter()
+
+        try:
+            yield
+        finally:
+            seconds = perf_counter() - started_at
+            modules = sorted(x for x in set(sys.modules) - modules_before if '.' not in x)
+            self.phases.append(StartupPhase(name, seconds, modules))
+
+    def heavy_modules(self) -> List[str]:
+        return [x for x in HEAVY_MODULES if x in sys.modules]
+
+    def as_dict(self) -> dict:
+        return {
+            'total_seconds': perf_counter() - self.started_at,
+            'phases': [asdict(x) for x in self.phases],
+            'heavy_modules': self.heavy_modules(),
+        }
+
+    def report(self) -> str:
+        """
+        Format startup report
+
+        :returns: report text
+        """
+        lines = [f'{"phase":<32} {"seconds":>10} {"modules":>8}']
+        for phase in self.phases:
+            lines.append(f'{phase.name:<32} {phase.seconds:>10.4f} {len(phase.modules):>8}')
+
+        lines.append(f'{"total":<32} {perf_counter() - self.started_at:>10.4f} {len(sys.modules):>8}')
+        lines.append('heavy modules: ' + (', '.join(self.heavy_modules()) or 'none'))
+
+        return '\n'.join(lines)
+
+    def dump(self, path: str):
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2)
@@ -23,72 +23,123 @@ var solveTicket = function(token, url_) {
     location.reload();
 }
 
-// get server timestamp
-var getTimestamp = function(token, url) {
-    var http_url = url + '/' + token + '/get_timestamp'
-    var xhr = new XMLHttpRequest();
-    xhr.open('GET', http_url, false);
-    xhr.send();
-    return JSON.parse(xhr.responseText).timestamp;
-}
-    
-// polling for new messages
-var poll = function(timestamp, token, url_) {
-    this.timestamp = timestamp;
-
-    var poll_response = $.ajax({
-        url: url_ + '/' + token + '/polling/' + timestamp,
+// polling for new messages, cursor points to the last received message
+var poll = function(cursor, token, url_) {
+    $.ajax({
+        url: url_ + '/' + token + '/polling/' + encodeURIComponent(cursor),
         type: 'GET',
         success: function(data) {
-            this.timestamp = data.timestamp;
             appendMessage(data.messages, data.users);
-            return poll(this.timestamp, token, url_);
-            // console.log(data);
+
+            // closed ticket gets no more messages
+            if (!data.closed) {
+                return poll(data.cursor, token, url_);
+            }
         },
-        // complete: function() { poll(this.timestamp, ticket, token); },
         dataType: 'json'
     });
 }
 
+// subscribe to server-sent events of ticket,
+// falls back to polling if browser or server can't stream
+var subscribe = function(cursor, token, url_) {
+    if (!window.EventSource) {
+        return poll(cursor, token, url_);
+    }
+
+    // on reconnect browser sends id of the last event, so messages are not repeated
+    var source = new EventSource(url_ + '/' + token + '/stream?cursor=' + encodeURIComponent(cursor));
+
+    source.addEventListener('messages', function(event) {
+        var data = JSON.parse(event.data);
+        cursor = event.lastEventId;
+        appendMessage(data.messages, data.users);
+    });
+
+    // ticket is closed or token expired, nothing will come anymore
+    source.addEventListener('closed', function(event) {
+        source.close();
+    });
+
+    source.onerror = function() {
+        // browser reconnects by itself unless stream is closed
+        if (source.readyState === EventSource.CLOSED) {
+            poll(cursor, token, url_);
+        }
+    };
+
+    return source;
+}
+
 var timestampToDate = function(timestamp) {
     var date = new Date(timestamp);
     return date.getHours() + ':' + date.getMinutes() + ':' + date.getSeconds() + ", " + date.toDateString();
 }
 
+// render message div
+var renderMessage = function(message, user) {
+    var date = timestampToDate(parseFloat(message.date) * 1000);
+    var cls = user.is_operator ? 'message-operator' : 'message-user';
+
+    return '<div class="' + cls + '">\n' + 
+    '<div class="message-header">\n' + 
+    '<p>' + user.telegram_username.toString() + '</p>\n' +
+    '<p>' + date + '</p>\n' +
+    '</div>\n' +
+    '<div class="message-body">\n' +
+    '<p>' + message.message.toString() + '</p>\n' +
+    '</div>\n' +
+    '</div>\n';
+}
+
 // append to messages content div
 var appendMessage = function(messages, users) {
     for (let i = 0; i < messages.length; i++) {
         let message = messages[i];
         let user = users[message.user_id.toString()];
-        var date = timestampToDate(parseFloat(message.date) * 1000);
-        
-        if (user.is_operator) {
-            $('.messages').append('<div class="message-operator">\n' + 
-            '<div class="message-header">\n' + 
-            '<p>' + user.telegram_username.toString() + '</p>\n' +
-            '<p>' + date + '</p>\n' +
-            '</div>\n' +
-            '<div class="message-body">\n' +
-            '<p>' + message.message.toString() + '</p>\n' +
-            '</div>\n' +
-            '</div>\n'
-            );
-        } else {
-            $('.messages').append('<div class="message-user">\n' + 
-            '<div class="message-header">\n' + 
-            '<p>' + user.telegram_username.toString() + '</p>\n' +
-            '<p>' + date + '</p>\n' +
-            '</div>\n' +
-            '<div class="message-body">\n' +
-            '<p>' + message.message.toString() + '</p>\n' +
-            '</div>\n' +
-            '</div>\n'
-            );
-        }
+
+        $('.messages').append(renderMessage(message, user));
     }
 
     // scroll to bottom
     if (messages.length > 0) {
         $('.messages').scrollTop($('.messages')[0].scrollHeight);
     }
-}
\ No newline at end of file
+}
+
+// load page of older messages by cursor and prepend them,
+// keeping scroll position of operator
+var historyLoading = false;
+
+var loadHistory = function(token, url_) {
+    if (historyLoading || !HISTORY_CURSOR) {
+        return;
+    }
+
+    historyLoading = true;
+
+    $.ajax({
+        url: url_ + '/' + token + '/history',
+        data: {cursor: HISTORY_CURSOR},
+        type: 'GET',
+        success: function(data) {
+            var container = $('.messages');
+            var height = container[0].scrollHeight;
+
+            var html = '';
+            for (let i = 0; i < data.messages.length; i++) {
+                let message = data.messages[i];
+                html += renderMessage(message, data.users[message.user_id.toString()]);
+            }
+
+            container.prepend(html);
+            container.scrollTop(container.scrollTop() + container[0].scrollHeight - height);
+
+            HISTORY_CURSOR = data.cursor || '';
+        },
+        complete: function() {
+            historyLoading = false;
+        },
+        dataType: 'json'
+    });
+}
@@ -0,0 +1,234 @@
+import os
+import threading
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from time import monotonic
+from typing import Deque, Dict, List, Optional, Set
+
+from requests.exceptions import ConnectionError, Timeout
+from telebot import TeleBot
+from telebot.apihelper import ApiTelegramException
+
+from instrumentation import timed
+from metrics import registry
+
+
+queue_depth_metric = registry.gauge('katyax_telegram_queue_depth', 'Count of outgoing telegram requests waiting in queue')
+send_latency_metric = registry.histogram('katyax_telegram_send_seconds', 'Time from enqueue to successful telegram request')
+retries_metric = registry.counter('katyax_telegram_retries_total', 'Count of retried telegram requests')
+coalesced_metric = registry.counter('katyax_telegram_coalesced_total', 'Count of messages merged into previous queued message')
+failures_metric = registry.counter('katyax_telegram_failures_total', 'Count of telegram requests failed after all attempts')
+
+# telegram rejects longer messages
+MAX_MESSAGE_LENGTH = 4096
+
+
+@dataclass
+class OutgoingRequest:
+    chat_id: int
+    method: str
+    args: list
+    kwargs: dict
+    futures: List[Future] = field(default_factory=list)
+    enqueued_at: float = field(default_factory=monotonic)
+    attempts: int = 0
+
+    # plain text messages of one chat may be merged into one message
+    mergeable: bool = False
+
+
+class TelegramSender:
+    def __init__(self, bot: TeleBot, workers: int = None, chat_interval: float = None, global_rate: float = None, max_retries: int = None):
+        self.bot = bot
+        self.workers = workers or int(os.getenv('TELEGRAM_SEND_WORKERS', 4))
+        self.chat_interval = chat_interval if chat_interval is not None else float(os.getenv('TELEGRAM_CHAT_INTERVAL', 1))
+        self.global_rate = global_rate or float(os.getenv('TELEGRAM_GLOBAL_RATE', 30))
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv('TELEGRAM_SEND_RETRIES', 5))
+
+        self._queues: Dict[int, Deque[OutgoingRequest]] = {}
+        self._ready_at: Dict[int, float] = {}
+        self._busy: Set[int] = set()
+        self._depth = 0
+
+        # token bucket of global rate limit, one second of burst is allowed
+        self._tokens = self.global_rate
+        self._refilled_at = monotonic()
+
+        self._cond = threading.Condition()
+        self._threads: List[threading.Thread] = []
+        self._stopped = False
+
+    def start(self):
+        with self._cond:
+            if self._threads:
+                return
+
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f'telegram-sender-{i}', daemon=True)
+                self._threads.append(thread)
+                thread.start()
+
+    def close(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def send(self, chat_id: int, text: str, **kwargs) -> Future:
+        """
+        Queue text message to chat, plain messages waiting for the same chat are merged
+
+        :param chat_id: telegram chat id
+
+        :param text: text of message
+
+        :returns: future with sent message
+        """
+        return self._submit(OutgoingRequest(int(chat_id), 'send_message', [int(chat_id), text], kwargs, mergeable=not kwargs))
+
+    def reply_to(self, message, text: str, **kwargs) -> Future:
+        return self._submit(OutgoingRequest(int(message.chat.id), 'reply_to', [message, text], kwargs))
+
+    def call(self, chat_id: int, method: str, /, *args, **kwargs) -> Future:
+        """
+        Queue any method of bot, that sends to chat
+
+        :param chat_id: telegram chat id, requests of one chat are sent in order
+
+        :param method: name of TeleBot method
+
+        :returns: future with result of method
+        """
+        return self._submit(OutgoingRequest(int(chat_id), method, list(args), kwargs))
+
+    def _submit(self, request: OutgoingRequest) -> Future:
+        future = Future()
+        self.start()
+
+        with self._cond:
+            queue = self._queues.setdefault(request.chat_id, deque())
+
+            last = queue[-1] if queue else None
+            if request.mergeable and last is not None and last.mergeable and len(last.args[1]) + len(request.args[1]) < MAX_MESSAGE_LENGTH:
+                last.args[1] = last.args[1] + '\n' + request.args[1]
+                last.futures.append(future)
+                coalesced_metric.inc()
+                return future
+
+            request.futures.append(future)
+            queue.append(request)
+
+            self._depth += 1
+            queue_depth_metric.set(self._depth)
+            self._cond.notify()
+
+        return future
+
+    def _take_token(self, now: float) -> float:
+        # returns 0 if token is taken, otherwise time to wait for it
+        self._tokens = min(self.global_rate, self._tokens + (now - self._refilled_at) * self.global_rate)
+        self._refilled_at = now
+
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+
+        return (1 - self._tokens) / self.global_rate
+
+    def _next(self) -> Optional[OutgoingRequest]:
+        # oldest request of chat, which is neither sending nor rate limited
+        with self._cond:
+            while not self._stopped:
+                now = monotonic()
+
+                pending = [k for k, v in self._queues.items() if v and k not in self._busy]
+                ready = [k for k in pending if self._ready_at.get(k, 0) <= now]
+                waiting = [self._ready_at[k] - now for k in pending if self._ready_at.get(k, 0) > now]
+
+                if ready:
+                    wait = self._take_token(now)
+                    if wait == 0:
+                        chat_id = min(ready, key=lambda x: self._queues[x][0].enqueued_at)
+                        self._busy.add(chat_id)
+
+                        self._depth -= 1
+                        queue_depth_metric.set(self._depth)
+
+                        return self._queues[chat_id].popleft()
+
+                    waiting.append(wait)
+
+                self._cond.wait(min(waiting) if waiting else None)
+
+        return None
+
+    def _done(self, request: OutgoingRequest, retry_in: float = None):
+        with self._cond:
+            self._busy.discard(request.chat_id)
+            self._ready_at[request.chat_id] = monotonic() + max(self.chat_interval, retry_in or 0)
+
+            queue = self._queues[request.chat_id]
+            if retry_in is not None:
+                queue.appendleft(request)
+                self._depth += 1
+                queue_depth_metric.set(self._depth)
+            elif not queue:
+                del self._queues[request.chat_id]
+
+                # limits of idle chats have passed
+                if len(self._ready_at) > 1024:
+                    now = monotonic()
+                    self._ready_at = {k: v for k, v in self._ready_at.items() if v > now}
+
+            self._cond.notify_all()
+
+    def _retry_in(self, request: OutgoingRequest, error: Exception) -> Optional[float]:
+        if request.attempts > self.max_retries:
+            return None
+
+        if isinstance(error, ApiTelegramException):
+            if error.error_code == 429:
+                return float((error.result_json.get('parameters') or {}).get('retry_after', 1))
+
+            # bad requests fail the same way on retry
+            if error.error_code < 500:
+                return None
+
+        elif not isinstance(error, (ConnectionError, Timeout)):
+            return None
+
+        return min(2 ** (request.attempts - 1), 30)
+
+    def _run(self):
+        while True:
+            request = self._next()
+            if request is None:
+                return
+
+            request.attempts += 1
+
+            try:
+                with timed('telegram.' + request.method):
+                    result = getattr(self.bot, request.method)(*request.args, **request.kwargs)
+            except Exception as e:
+                retry_in = self._retry_in(request, e)
+
+                if retry_in is not None:
+                    retries_metric.inc()
+                    self._done(request, retry_in)
+                    continue
+
+                failures_metric.inc()
+                print(f'Failed to send {request.method} to chat {request.chat_id}: {e}')
+
+                self._done(request)
+                for future in request.futures:
+                    future.set_exception(e)
+
+                continue
+
+            send_latency_metric.observe(monotonic() - request.enqueued_at)
+
+            self._done(request)
+            for future in request.futures:
+                future.set_result(result)
@@ -0,0 +1,68 @@
+import os
+import pathlib
+import sys
+import tempfile
+
+import pytest
+
+# modules of the bot live in the root of repository
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+
+# schemes creates engine on import, tests use their own engines
+os.environ.setdefault('SQLITE_DB', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'katyax.sqlite'))
+os.environ.setdefault('FLASK_SECRET', 'secret')
+os.environ.setdefault('TOKEN_EXPIRE_MINUTES', '60')
+
+
+@pytest.fixture
+def engine(tmp_path):
+    from sqlmodel import SQLModel, create_engine
+
+    # tables are registered in metadata on import of schemes
+    import schemes  # noqa: F401
+
+    engine = create_engine(f'sqlite:///{tmp_path / "katyax.sqlite"}')
+    SQLModel.metadata.create_all(engine)
+
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def ticket(engine):
+    """
+    Open ticket, escalated from the first question of user
+
+    :returns: dict with ticket_id, user_id and operator_id
+    """
+    from sqlmodel import Session
+    from schemes import Message, User, create_conversation
+
+    with Session(engine) as session:
+        user = User(telegram_id=1, telegram_username='@user')
+        operator = User(telegram_id=2, telegram_username='@operator', is_operator=True)
+        session.add(user)
+        session.add(operator)
+        session.commit()
+
+        session.add(Message(user_id=user.id, message_id=10, text='it is broken', date='1700000000'))
+        session.commit()
+
+        user_id, operator_id = user.id, operator.id
+
+    return {'ticket_id': create_conversation(user_id, engine), 'user_id': user_id, 'operator_id': operator_id}
+
+
+@pytest.fixture
+def webserver(engine):
+    from webserver import WebServer
+
+    webserver = WebServer('webserver', engine)
+
+    yield webserver
+    webserver.bus.close()
+
+
+@pytest.fixture
+def operator_token(webserver, ticket):
+    return webserver.generate_token(str(ticket['operator_id']), '2', ticket['ticket_id'])
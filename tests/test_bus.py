@@ -0,0 +1,99 @@
+from time import monotonic, sleep
+
+import pytest
+
+from bus import DatabaseBus, InMemoryBus
+from schemes import ConversationThread
+from unit_of_work import UnitOfWork
+
+
+def subscribed(bus):
+    received = []
+    bus.subscribe(lambda ticket_id, message: received.append((ticket_id, message.message)))
+    return received
+
+
+def wait_for(predicate, timeout: float = 5):
+    deadline = monotonic() + timeout
+    while not predicate() and monotonic() < deadline:
+        sleep(.01)
+
+    return predicate()
+
+
+def test_memory_bus_delivers_at_once_without_unit_of_work():
+    bus = InMemoryBus()
+    received = subscribed(bus)
+
+    bus.publish('ticket', ConversationThread(id=1, user_id=1, date=1.0, message='hello'))
+
+    assert received == [('ticket', 'hello')]
+
+
+def test_memory_bus_delivers_after_commit(engine):
+    bus = InMemoryBus()
+    received = subscribed(bus)
+
+    with UnitOfWork(engine, 'test'):
+        bus.publish('ticket', ConversationThread(id=1, user_id=1, date=1.0, message='hello'))
+        assert received == []
+
+    assert received == [('ticket', 'hello')]
+
+
+def test_memory_bus_drops_message_on_rollback(engine):
+    bus = InMemoryBus()
+    received = subscribed(bus)
+
+    with pytest.raises(RuntimeError):
+        with UnitOfWork(engine, 'test'):
+            bus.publish('ticket', ConversationThread(id=1, user_id=1, date=1.0, message='hello'))
+            raise RuntimeError('handler failed')
+
+    assert received == []
+
+
+def test_database_bus_delivers_to_other_process_after_commit(engine):
+    publisher = DatabaseBus(engine, poll_interval=.02)
+    reader = DatabaseBus(engine, poll_interval=.02)
+    published, read = subscribed(publisher), subscribed(reader)
+
+    publisher.start()
+    reader.start()
+
+    try:
+        with UnitOfWork(engine, 'test'):
+            publisher.publish('ticket', ConversationThread(id=1, user_id=1, date=1.0, message='hello'))
+            assert published == []
+
+        assert published == [('ticket', 'hello')]
+        assert wait_for(lambda: read == [('ticket', 'hello')])
+
+        # own events are not delivered twice
+        sleep(.1)
+        assert published == [('ticket', 'hello')]
+    finally:
+        publisher.close()
+        reader.close()
+
+
+def test_database_bus_drops_event_on_rollback(engine):
+    publisher = DatabaseBus(engine, poll_interval=.02)
+    reader = DatabaseBus(engine, poll_interval=.02)
+    published, read = subscribed(publisher), subscribed(reader)
+
+    publisher.start()
+    reader.start()
+
+    try:
+        with pytest.raises(RuntimeError):
+            with UnitOfWork(engine, 'test'):
+                publisher.publish('ticket', ConversationThread(id=1, user_id=1, date=1.0, message='hello'))
+                raise RuntimeError('handler failed')
+
+        sleep(.2)
+        assert published == []
+        assert read == []
+    finally:
+        publisher.close()
+        reader.close()
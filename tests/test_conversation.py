@@ -0,0 +1,66 @@
+from sqlmodel import Session, select
+
+from schemes import ConversationMessage, Message, UserTicket, add_conversation_message, add_conversation_messages, create_conversation
+from unit_of_work import UnitOfWork
+
+
+def ticket_messages(engine, ticket_id):
+    with Session(engine) as session:
+        ticket = session.exec(select(UserTicket).where(UserTicket.ticket_id == ticket_id)).one()
+        messages = session.exec(select(ConversationMessage).where(ConversationMessage.ticket_id == ticket_id).order_by(ConversationMessage.id)).all()
+
+    return ticket, messages
+
+
+def test_first_message_refers_to_ticket(engine, ticket):
+    ticket_row, messages = ticket_messages(engine, ticket['ticket_id'])
+
+    assert [x.message for x in messages] == ['it is broken']
+    assert messages[0].user_ticket_id == ticket_row.id
+
+
+def test_first_message_refers_to_ticket_in_unit_of_work(engine, ticket):
+    # second question of the same user is escalated by bot handler
+    with Session(engine) as session:
+        session.add(Message(user_id=ticket['user_id'], message_id=11, text='still broken', date='1700000100'))
+        session.commit()
+
+    with UnitOfWork(engine, 'test'):
+        ticket_id = create_conversation(ticket['user_id'], engine)
+        add_conversation_message(engine, ticket_id, ticket['user_id'], 1700000200, 'any news?')
+
+    ticket_row, messages = ticket_messages(engine, ticket_id)
+
+    assert [x.message for x in messages] == ['still broken', 'any news?']
+    assert all(x.user_ticket_id == ticket_row.id for x in messages)
+
+
+def test_backfill_sets_missing_ticket_references(engine, ticket):
+    from migrate_conversations import backfill_user_ticket_ids
+
+    with Session(engine) as session:
+        for message in session.exec(select(ConversationMessage)).all():
+            message.user_ticket_id = None
+            session.add(message)
+
+        session.commit()
+
+    assert backfill_user_ticket_ids(engine) == 1
+    assert backfill_user_ticket_ids(engine) == 0
+
+    ticket_row, messages = ticket_messages(engine, ticket['ticket_id'])
+    assert messages[0].user_ticket_id == ticket_row.id
+
+
+def test_bulk_insert_returns_ids_in_order_and_refers_to_ticket(engine, ticket):
+    rows = [{'user_id': ticket['user_id'], 'date': 1700000100 + n, 'message': f'message {n}'} for n in range(20)]
+
+    ids = add_conversation_messages(engine, ticket['ticket_id'], rows)
+    ticket_row, messages = ticket_messages(engine, ticket['ticket_id'])
+
+    assert ids == sorted(ids)
+    assert [x.message for x in messages if x.id in ids] == [x['message'] for x in rows]
+    assert {x.id: x.message for x in messages}[ids[5]] == 'message 5'
+    assert all(x.user_ticket_id == ticket_row.id for x in messages)
+
+    assert add_conversation_messages(engine, ticket['ticket_id'], []) == []
@@ -0,0 +1,45 @@
+import re
+
+import pytest
+
+from schemes import add_conversation_message
+
+
+@pytest.fixture
+def conversation(engine, ticket):
+    # the first message of ticket is older than all of these
+    for n in range(120):
+        add_conversation_message(engine, ticket['ticket_id'], ticket['user_id'], 1800000000 + n // 2, f'message {n}')
+
+    return ['it is broken'] + [f'message {n}' for n in range(120)]
+
+
+def test_history_pages_cover_conversation_once(webserver, operator_token, conversation, monkeypatch):
+    monkeypatch.setenv('CHAT_PAGE_SIZE', '50')
+    client = webserver.test_client()
+
+    page = client.get(f'/{operator_token}').data.decode()
+    cursor = re.search(r"HISTORY_CURSOR = '([^']*)'", page).group(1)
+    assert page.count('message-body') == 50
+
+    loaded = []
+    while cursor:
+        data = client.get(f'/{operator_token}/history', query_string={'cursor': cursor, 'limit': 17}).json
+        loaded = [x['message'] for x in data['messages']] + loaded
+        cursor = data['cursor']
+
+    # messages with equal dates are ordered by id, none is lost or repeated on page borders
+    assert loaded == conversation[:-50]
+
+
+@pytest.mark.parametrize('limit, count', [('0', 1), ('-1', 1), ('3', 3), ('1000', 121)])
+def test_history_limit_is_clamped(webserver, operator_token, conversation, limit, count):
+    response = webserver.test_client().get(f'/{operator_token}/history', query_string={'limit': limit})
+
+    assert response.status_code == 200
+    assert len(response.json['messages']) == count
+
+
+@pytest.mark.parametrize('query', [{'limit': 'abc'}, {'cursor': 'zzz'}])
+def test_history_rejects_invalid_parameters(webserver, operator_token, query):
+    assert webserver.test_client().get(f'/{operator_token}/history', query_string=query).status_code == 400
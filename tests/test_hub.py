@@ -0,0 +1,135 @@
+import threading
+from time import perf_counter
+
+from hub import TicketHub
+
+
+def test_wait_returns_at_once_if_predicate_is_true():
+    hub = TicketHub()
+
+    result, notified_at = hub.wait('ticket', lambda: [1], timeout=5)
+
+    assert result == [1]
+    assert notified_at is None
+
+
+def test_wait_times_out():
+    hub = TicketHub()
+    started_at = perf_counter()
+
+    result, notified_at = hub.wait('ticket', lambda: [], timeout=.1)
+
+    assert result == []
+    assert notified_at is None
+    assert perf_counter() - started_at >= .1
+
+
+def test_notify_wakes_up_waiter():
+    hub = TicketHub()
+    messages = []
+    results = []
+
+    waiter = threading.Thread(target=lambda: results.append(hub.wait('ticket', lambda: list(messages), timeout=5)))
+    waiter.start()
+
+    while not hub._conditions:
+        pass
+
+    messages.append('hello')
+    hub.notify('ticket')
+    waiter.join(5)
+
+    result, notified_at = results[0]
+    assert result == ['hello']
+    assert notified_at is not None
+
+
+def test_notify_of_other_ticket_does_not_wake_up_waiter():
+    hub = TicketHub()
+    messages = []
+    results = []
+
+    waiter = threading.Thread(target=lambda: results.append(hub.wait('ticket', lambda: list(messages), timeout=.3)))
+    waiter.start()
+
+    messages.append('hello')
+    hub.notify('other')
+    waiter.join(5)
+
+    # predicate is rechecked only when the ticket itself is notified or wait times out
+    assert results[0][1] is None
+
+
+def test_notification_during_predicate_is_not_lost():
+    hub = TicketHub()
+    messages = []
+    checks = []
+
+    def predicate():
+        checks.append(1)
+
+        # message arrives after the first check and before sleep, notifier waits for the ticket lock
+        if len(checks) == 1:
+            notifier = threading.Thread(target=lambda: (messages.append('hello'), hub.notify('ticket')))
+            notifier.start()
+
+        return list(messages)
+
+    started_at = perf_counter()
+    result, _ = hub.wait('ticket', predicate, timeout=5)
+
+    assert result == ['hello']
+    assert perf_counter() - started_at < 1
+
+
+def test_discard_wakes_up_waiters():
+    hub = TicketHub()
+    results = []
+
+    waiter = threading.Thread(target=lambda: results.append(hub.wait('ticket', lambda: [], timeout=5)))
+    started_at = perf_counter()
+    waiter.start()
+
+    while not hub._conditions:
+        pass
+
+    hub.discard('ticket')
+    waiter.join(5)
+
+    assert results
+    assert perf_counter() - started_at < 5
+
+
+def test_tickets_without_waiters_are_forgotten():
+    hub = TicketHub()
+
+    # tickets, which went idle or were closed elsewhere, are not kept
+    hub.notify('ticket')
+    hub.wait('ticket', lambda: [], timeout=.01)
+    hub.wait('other', lambda: [1], timeout=5)
+
+    assert hub._conditions == {}
+    assert hub._waiters == {}
+    assert hub._notified_at == {}
+
+
+def test_ticket_is_kept_while_other_waiter_sleeps():
+    hub = TicketHub()
+    messages = []
+    results = []
+
+    waiter = threading.Thread(target=lambda: results.append(hub.wait('ticket', lambda: list(messages), timeout=5)))
+    waiter.start()
+
+    while not hub._conditions:
+        pass
+
+    hub.wait('ticket', lambda: [], timeout=.01)
+    assert 'ticket' in hub._conditions
+
+    messages.append('hello')
+    hub.notify('ticket')
+    waiter.join(5)
+
+    assert results[0][0] == ['hello']
+    assert hub._conditions == {}
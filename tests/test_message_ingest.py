@@ -0,0 +1,27 @@
+import pytest
+
+from message_ingest import HttpIngest, LocalIngest, create_ingest
+from user_state import UserState
+
+
+@pytest.mark.parametrize('bus, serves_operators, expected', [
+    ('memory', False, HttpIngest),
+    ('memory', True, LocalIngest),
+    ('database', False, LocalIngest),
+])
+def test_ingest_is_local_when_operators_see_messages_of_this_process(webserver, monkeypatch, bus, serves_operators, expected):
+    monkeypatch.setenv('MESSAGE_BUS', bus)
+    monkeypatch.delenv('MESSAGE_INGEST', raising=False)
+
+    assert isinstance(create_ingest(webserver, None, serves_operators=serves_operators), expected)
+
+
+def test_local_ingest_stores_message_and_reports_closed_ticket(webserver, ticket):
+    ingest = create_ingest(webserver, None, mode='local')
+    state = UserState(telegram_id=1, user_id=ticket['user_id'], ticket_id=ticket['ticket_id'])
+
+    assert ingest.ingest(state, 'hello', 1800000000) == 'ok'
+    assert webserver.messages.since(ticket['ticket_id'], (0.0, 0))[-1].message == 'hello'
+
+    webserver.test_client().get('/' + webserver.generate_token(str(ticket['operator_id']), '2', ticket['ticket_id']) + '/close_thread')
+    assert ingest.ingest(state, 'are you here?', 1800000001) == 'closed'
@@ -0,0 +1,111 @@
+from message_store import MessageStore, TicketBuffer, message_memory
+from schemes import ConversationThread, add_conversation_message
+
+
+def thread(id_: int, date: float, text: str = None) -> ConversationThread:
+    return ConversationThread(id=id_, user_id=1, date=date, message=text or f'message {id_}')
+
+
+def test_buffer_keeps_order_and_drops_oldest_messages():
+    buffer = TicketBuffer(capacity=3)
+
+    for id_, date in [(2, 2.0), (1, 1.0), (4, 4.0), (3, 3.0)]:
+        assert buffer.add(thread(id_, date))
+
+    assert not buffer.add(thread(4, 4.0))
+    assert [x.id for x in buffer.messages] == [2, 3, 4]
+    assert not buffer.complete
+
+    # older messages than buffer are not covered, newer are
+    assert not buffer.covers((1.0, 1))
+    assert buffer.covers((2.0, 2))
+    assert [x.id for x in buffer.since((2.0, 2))] == [3, 4]
+
+
+def test_buffer_delivers_in_order_of_id_not_date():
+    buffer = TicketBuffer(capacity=10)
+
+    # user message keeps its telegram date, which is older than the operator message stored before it
+    buffer.add(thread(1, 1800000005.5, 'operator'))
+    buffer.add(thread(2, 1800000005.0, 'user'))
+
+    assert [x.message for x in buffer.since((1800000005.5, 1))] == ['user']
+
+
+def test_buffer_memory_is_kept_up_to_date():
+    buffer = TicketBuffer(capacity=2)
+    empty = buffer.memory()
+
+    messages = [thread(1, 1.0), thread(2, 2.0, 'x' * 1000), thread(3, 3.0)]
+    for message in messages:
+        buffer.add(message)
+
+    assert buffer.memory() == empty + sum(message_memory(x) for x in messages[1:])
+
+
+def test_since_reads_older_messages_from_database(engine, ticket):
+    ticket_id, user_id = ticket['ticket_id'], ticket['user_id']
+    store = MessageStore(engine, capacity=2)
+
+    ids = [add_conversation_message(engine, ticket_id, user_id, 1800000000 - n, f'message {n}') for n in range(5)]
+
+    store.load(ticket_id)
+    messages = store.since(ticket_id, (0.0, 0))
+
+    # the first message of ticket and all added ones in order of id, though only two are buffered
+    assert [x.message for x in messages][1:] == [f'message {n}' for n in range(5)]
+    assert [x.message for x in store.since(ticket_id, (1800000000.0, ids[1]))] == ['message 2', 'message 3', 'message 4']
+
+
+def test_peek_reads_only_memory(engine, ticket):
+    store = MessageStore(engine)
+
+    assert store.peek(ticket['ticket_id'], (0.0, 0)) is None
+    assert ticket['ticket_id'] not in store
+
+    store.load(ticket['ticket_id'])
+    assert len(store.peek(ticket['ticket_id'], (0.0, 0))) == 1
+
+
+def test_closed_ticket_is_not_buffered_again(engine, ticket):
+    ticket_id = ticket['ticket_id']
+    store = MessageStore(engine)
+
+    store.load(ticket_id)
+    store.evict(ticket_id, closed=True)
+
+    # history is still served from database
+    assert len(store.since(ticket_id, (0.0, 0))) == 1
+    assert store.load(ticket_id) is None
+    assert ticket_id not in store
+    assert not store.append(ticket_id, thread(100, 1800000000.0))
+
+
+def test_store_memory_follows_buffers(engine, ticket):
+    ticket_id = ticket['ticket_id']
+    store = MessageStore(engine, capacity=2)
+
+    store.load(ticket_id)
+    for n in range(3):
+        store.append(ticket_id, thread(100 + n, 1800000000.0 + n))
+
+    assert store._memory == sum(store.memory_usage().values())
+
+    store.evict(ticket_id)
+    assert store._memory == 0
+
+
+def test_closed_ticket_is_not_buffered_by_polls(webserver, ticket, operator_token):
+    client = webserver.test_client()
+    cursor = webserver.encode_cursor(None)
+
+    assert client.get(f'/{operator_token}/polling/{cursor}?wait_for=0').status_code == 200
+    assert ticket['ticket_id'] in webserver.messages
+
+    assert client.get(f'/{operator_token}/close_thread').status_code == 200
+    assert ticket['ticket_id'] not in webserver.messages
+
+    # page is reloaded and polled after ticket is closed
+    assert client.get(f'/{operator_token}').status_code == 200
+    assert client.get(f'/{operator_token}/polling/{cursor}?wait_for=0').json['closed'] is False
+    assert ticket['ticket_id'] not in webserver.messages
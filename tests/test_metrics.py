@@ -0,0 +1,44 @@
+import socket
+
+import requests
+
+from instrumentation import profiler, serve_metrics
+from metrics import registry
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def test_operator_port_doesnt_expose_metrics_and_profiler(webserver, monkeypatch):
+    monkeypatch.setenv('PROFILE_SECRET', 'secret')
+    client = webserver.test_client()
+
+    # path is taken for a token of operator page
+    assert b'katyax_' not in client.get('/metrics').data
+
+    assert client.post('/profile?handler=web.chat', headers={'X-Profile-Secret': 'secret'}).status_code != 200
+    assert not profiler._take('web.chat')
+
+
+def test_internal_port_serves_metrics_and_profiler():
+    registry.counter('katyax_test_total', 'Count of test events').inc()
+
+    port = free_port()
+    server = serve_metrics('127.0.0.1', port)
+
+    try:
+        url = f'http://127.0.0.1:{port}'
+        assert 'katyax_test_total 1.0' in requests.get(f'{url}/metrics', timeout=5).text
+
+        response = requests.post(f'{url}/profile', params={'handler': 'web.test', 'count': 1}, timeout=5)
+        assert response.json() == {'status': 'ok', 'handler': 'web.test'}
+        assert profiler._take('web.test')
+
+        assert requests.post(f'{url}/profile', params={'count': 'x'}, timeout=5).status_code == 400
+        assert 'profiles' in requests.get(f'{url}/profile', timeout=5).json()
+    finally:
+        server.shutdown()
+        server.server_close()
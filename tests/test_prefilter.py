@@ -0,0 +1,36 @@
+import numpy as np
+
+from answer_index import AnswerIndex, IndexSnapshot
+from lexical import LexicalIndex
+
+
+ANSWERS = [
+    'Как запустить контейнер docker run с пробросом портов',
+    'Как запустить контейнер в фоновом режиме',
+    'Как остановить контейнер и удалить его',
+    'Чем docker run отличается от docker start для контейнера',
+    'Как посмотреть логи сервиса в kubernetes',
+]
+
+
+def prefilter(question: str):
+    index = AnswerIndex('model')
+    index.shortlist_size = 2
+    index.snapshot = IndexSnapshot(ANSWERS, np.zeros((len(ANSWERS), 1), dtype=np.float32), [str(x) for x in range(len(ANSWERS))], '', lexical=LexicalIndex(ANSWERS))
+
+    return index.prefilter(question)
+
+
+def test_generic_question_is_not_answered_without_model():
+    for question in ('запустить контейнер', 'docker run контейнер'):
+        answer, candidates = prefilter(question)
+
+        assert answer is None
+        assert candidates is not None
+
+
+def test_near_verbatim_question_is_answered_without_model():
+    answer, candidates = prefilter('как запустить контейнер в фоновом режиме?')
+
+    assert answer == ANSWERS[1]
+    assert candidates is None
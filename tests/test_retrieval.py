@@ -0,0 +1,31 @@
+import numpy as np
+
+from retrieval import ExactSearch, IVFSearch
+
+
+def normalized(count: int, dim: int = 16, seed: int = 0) -> np.ndarray:
+    embeddings = np.random.default_rng(seed).normal(size=(count, dim)).astype(np.float32)
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+
+def test_ivf_skips_empty_lists():
+    embeddings = normalized(200)
+    search = IVFSearch(embeddings, n_lists=8, n_probe=1)
+
+    # first lists lose their vectors, their centroids stay the closest for some queries
+    search.offsets = np.concatenate([np.zeros(4, dtype=search.offsets.dtype), search.offsets[4:]])
+
+    indices, scores = search.top_k(embeddings, 1)
+
+    assert (indices >= 0).all()
+    assert np.isfinite(scores).all()
+
+
+def test_ivf_matches_exact_search_with_all_lists_probed():
+    embeddings = normalized(100)
+    ivf = IVFSearch(embeddings, n_lists=4, n_probe=4)
+
+    ivf_indices, _ = ivf.top_k(embeddings[:20], 3)
+    exact_indices, _ = ExactSearch(embeddings).top_k(embeddings[:20], 3)
+
+    assert (ivf_indices == exact_indices).all()
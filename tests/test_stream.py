@@ -0,0 +1,120 @@
+import threading
+
+from sqlalchemy import event
+
+from schemes import get_conversation_messages
+from webserver import WebServer
+
+
+def read_events(response, count: int):
+    # events are separated by blank line, comments and retry are skipped
+    events = []
+    for chunk in response.response:
+        chunk = chunk.decode() if isinstance(chunk, bytes) else chunk
+
+        fields = dict(line.split(': ', 1) for line in chunk.strip().split('\n') if ': ' in line and not line.startswith(':'))
+        if 'event' in fields:
+            events.append(fields)
+
+        if len(events) == count:
+            break
+
+    return events
+
+
+def test_stream_sends_event_ids_and_resumes_from_last_event_id(webserver, operator_token):
+    client = webserver.test_client()
+
+    first = client.post(f'/{operator_token}/send_message', data={'message': 'first'})
+    assert first.status_code == 200
+
+    response = client.get(f'/{operator_token}/stream?cursor={WebServer.encode_cursor(None)}', buffered=False)
+    events = read_events(response, 1)
+    response.close()
+
+    # the first message of ticket and the operator message
+    assert events[0]['event'] == 'messages'
+    assert 'first' in events[0]['data']
+    last_event_id = events[0]['id']
+
+    client.post(f'/{operator_token}/send_message', data={'message': 'second'})
+
+    # browser reconnects to the original url with Last-Event-ID header
+    response = client.get(f'/{operator_token}/stream?cursor={WebServer.encode_cursor(None)}', headers={'Last-Event-ID': last_event_id}, buffered=False)
+    events = read_events(response, 1)
+    response.close()
+
+    assert 'second' in events[0]['data']
+    assert 'first' not in events[0]['data']
+
+
+def test_stream_ends_when_ticket_is_closed(webserver, operator_token, monkeypatch):
+    # ticket closed before stream started waiting is noticed on heartbeat
+    monkeypatch.setenv('STREAM_HEARTBEAT', '.2')
+
+    client = webserver.test_client()
+    events = []
+
+    response = client.get(f'/{operator_token}/stream', buffered=False)
+    reader = threading.Thread(target=lambda: events.extend(read_events(response, 2)))
+    reader.start()
+
+    assert client.get(f'/{operator_token}/close_thread').status_code == 200
+
+    reader.join(5)
+    assert not reader.is_alive()
+    assert events[-1]['event'] == 'closed'
+
+    # browser stops reconnecting on no content
+    assert client.get(f'/{operator_token}/stream').status_code == 204
+
+
+def test_polling_continues_from_cursor_of_last_delivered_message(webserver, operator_token):
+    client = webserver.test_client()
+
+    client.post(f'/{operator_token}/send_message', data={'message': 'first'})
+    data = client.get(f'/{operator_token}/polling/{WebServer.encode_cursor(None)}?wait_for=0').json
+    assert [x['message'] for x in data['messages']][-1] == 'first'
+
+    # the same cursor doesn't repeat delivered messages
+    cursor = data['cursor']
+    assert WebServer.decode_cursor(cursor)
+    assert client.get(f'/{operator_token}/polling/{cursor}?wait_for=0').json['messages'] == []
+
+    client.post(f'/{operator_token}/send_message', data={'message': 'second'})
+    data = client.get(f'/{operator_token}/polling/{cursor}?wait_for=0').json
+
+    assert [x['message'] for x in data['messages']] == ['second']
+    assert data['closed'] is False
+
+
+def test_user_message_with_older_telegram_date_is_not_skipped(webserver, ticket, operator_token):
+    client = webserver.test_client()
+
+    client.post(f'/{operator_token}/send_message', data={'message': 'operator'})
+    cursor = client.get(f'/{operator_token}/polling/{WebServer.encode_cursor(None)}?wait_for=0').json['cursor']
+
+    # telegram date is whole seconds before the operator message
+    date = WebServer.decode_cursor(cursor)[0] - 1
+    assert webserver.ingest_user_message(ticket['ticket_id'], ticket['user_id'], 'user', date) == 'ok'
+
+    data = client.get(f'/{operator_token}/polling/{cursor}?wait_for=0').json
+    assert [(x['message'], x['date']) for x in data['messages']] == [('user', date)]
+
+
+
+def test_polling_returns_connection_to_pool_while_waiting(webserver, engine, ticket, operator_token, monkeypatch):
+    checked_out = []
+    event.listen(engine, 'checkout', lambda *args: checked_out.append(1))
+    event.listen(engine, 'checkin', lambda *args: checked_out.pop())
+
+    held = []
+    wait = webserver.hub.wait
+    monkeypatch.setattr(webserver.hub, 'wait', lambda *args: held.append(len(checked_out)) or wait(*args))
+
+    # first poll loads the buffer from database in the unit of work of request, then waits
+    latest, _ = get_conversation_messages(engine, ticket['ticket_id'], limit=1)
+    response = webserver.test_client().get(f'/{operator_token}/polling/{WebServer.encode_cursor(latest[-1])}?wait_for=0')
+
+    assert response.status_code == 200
+    assert held == [0]
@@ -0,0 +1,101 @@
+import threading
+from collections import defaultdict
+from time import sleep
+
+from telebot import types
+
+from fake_telegram import make_message_update
+from update_dispatcher import UpdateDispatcher, chat_key
+
+
+def update(update_id: int, chat_id: int) -> types.Update:
+    data = make_message_update(chat_id, f'message {update_id}', message_id=update_id)
+    data['update_id'] = update_id
+    return types.Update.de_json(data)
+
+
+def test_updates_of_one_chat_are_handled_in_order_one_by_one():
+    handled = defaultdict(list)
+    running = set()
+    overlaps = []
+    lock = threading.Lock()
+
+    def process(updates):
+        key = chat_key(updates[0])
+
+        with lock:
+            if key in running:
+                overlaps.append(key)
+            running.add(key)
+
+        sleep(.001)
+
+        with lock:
+            running.discard(key)
+            handled[key].append(updates[0].update_id)
+
+    dispatcher = UpdateDispatcher(process, workers=4)
+    updates = [update(n, chat_id=n % 5) for n in range(1, 201)]
+
+    dispatcher.dispatch(updates)
+    dispatcher.close(timeout=10)
+
+    assert not overlaps
+    for chat_id in range(5):
+        assert handled[chat_id] == [x.update_id for x in updates if x.message.chat.id == chat_id]
+
+
+def test_slow_chat_does_not_block_other_chats():
+    release = threading.Event()
+    handled = []
+
+    def process(updates):
+        if chat_key(updates[0]) == 1:
+            release.wait(5)
+
+        handled.append(updates[0].update_id)
+
+    dispatcher = UpdateDispatcher(process, workers=2)
+    dispatcher.dispatch([update(1, chat_id=1), update(2, chat_id=1), update(3, chat_id=2), update(4, chat_id=2)])
+
+    for _ in range(500):
+        if handled == [3, 4]:
+            break
+        sleep(.01)
+
+    assert handled == [3, 4]
+
+    release.set()
+    dispatcher.close(timeout=5)
+    assert handled == [3, 4, 1, 2]
+
+
+def test_full_queue_rejects_updates_after_timeout():
+    release = threading.Event()
+
+    dispatcher = UpdateDispatcher(lambda updates: release.wait(5), workers=1, queue_size=1)
+
+    # the first update is taken by worker, the second one fills the queue
+    assert dispatcher.dispatch([update(1, chat_id=1)])
+    sleep(.05)
+    assert dispatcher.dispatch([update(2, chat_id=1)])
+    assert not dispatcher.dispatch([update(3, chat_id=1)], timeout=.05)
+
+    release.set()
+    dispatcher.close(timeout=5)
+
+
+def test_failed_update_does_not_stop_worker():
+    handled = []
+
+    def process(updates):
+        if updates[0].update_id == 1:
+            raise RuntimeError('handler failed')
+
+        handled.append(updates[0].update_id)
+
+    dispatcher = UpdateDispatcher(process, workers=1)
+    dispatcher.dispatch([update(1, chat_id=1), update(2, chat_id=1)])
+    dispatcher.close(timeout=5)
+
+    assert handled == [2]
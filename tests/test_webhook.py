@@ -0,0 +1,58 @@
+from fake_telegram import make_message_update
+from webserver import TelegramWebhook
+
+
+def webhook_client(accept: bool = True):
+    received = []
+
+    def receive(updates, timeout=None):
+        received.extend(updates)
+        return accept
+
+    return TelegramWebhook('webhook', '/telegram/webhook', 'secret', receive).test_client(), received
+
+
+def test_webhook_queues_update_with_valid_secret():
+    client, received = webhook_client()
+    update = {**make_message_update(1, 'hello'), 'update_id': 7}
+
+    response = client.post('/telegram/webhook', json=update, headers={'X-Telegram-Bot-Api-Secret-Token': 'secret'})
+
+    assert response.status_code == 200
+    assert [x.update_id for x in received] == [7]
+
+
+def test_webhook_rejects_invalid_requests():
+    client, received = webhook_client()
+    update = {**make_message_update(1, 'hello'), 'update_id': 7}
+
+    assert client.post('/telegram/webhook', json=update, headers={'X-Telegram-Bot-Api-Secret-Token': 'wrong'}).status_code == 403
+    assert client.post('/telegram/webhook', json={'message': {}}, headers={'X-Telegram-Bot-Api-Secret-Token': 'secret'}).status_code == 400
+    assert received == []
+
+
+def test_webhook_asks_telegram_to_retry_when_queue_is_full():
+    client, _ = webhook_client(accept=False)
+    update = {**make_message_update(1, 'hello'), 'update_id': 7}
+
+    assert client.post('/telegram/webhook', json=update, headers={'X-Telegram-Bot-Api-Secret-Token': 'secret'}).status_code == 503
+
+
+def test_streams_over_limit_are_rejected(webserver, operator_token):
+    webserver.max_streams = 2
+    client = webserver.test_client()
+
+    streams = [client.get(f'/{operator_token}/stream', buffered=False) for _ in range(2)]
+    assert [x.status_code for x in streams] == [200, 200]
+
+    # page falls back to polling and the rest of threads serve other requests
+    assert client.get(f'/{operator_token}/stream', buffered=False).status_code == 503
+    assert client.get(f'/{operator_token}/polling/{webserver.encode_cursor(None)}?wait_for=0').status_code == 200
+
+    streams[0].close()
+    response = client.get(f'/{operator_token}/stream', buffered=False)
+    assert response.status_code == 200
+
+    response.close()
+    streams[1].close()
+    assert webserver._streams == 0
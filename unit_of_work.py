@@ -0,0 +1,227 @@
+import functools
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import perf_counter
+from typing import Callable, Dict, List, Optional, Set
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session as OrmSession
+from sqlmodel import Session
+
+from instrumentation import profiler
+from metrics import registry
+
+
+_current: ContextVar[Optional['UnitOfWork']] = ContextVar('unit_of_work', default=None)
+_instrumented: Set[int] = set()
+
+
+def _handler_metrics(name: str) -> Dict[str, object]:
+    labels = {'handler': name}
+
+    return {
+        'units': registry.counter('katyax_uow_total', 'Count of handled updates and requests', labels),
+        'sessions': registry.counter('katyax_uow_sessions_total', 'Count of database sessions used by handler', labels),
+        'statements': registry.counter('katyax_uow_statements_total', 'Count of SQL statements executed by handler', labels),
+        'commits': registry.counter('katyax_uow_commits_total', 'Count of commits made by handler', labels),
+        'seconds': registry.histogram('katyax_uow_seconds', 'Time of handling update or request', labels=labels),
+    }
+
+
+def instrument(engine):
+    """
+    Count statements of engine and sessions, that are used by current unit of work
+
+    :param engine: database engine
+
+    :returns: None
+    """
+    if id(engine) in _instrumented:
+        return
+
+    _instrumented.add(id(engine))
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        unit = _current.get()
+        if unit is not None:
+            unit.statements += 1
+
+            if not statement.lstrip()[:6].upper() == 'SELECT':
+                unit.has_writes = True
+
+
+@event.listens_for(OrmSession, 'after_begin')
+def after_begin(session, transaction, connection):
+    unit = _current.get()
+    if unit is not None:
+        unit.session_ids.add(id(session))
+
+
+@event.listens_for(OrmSession, 'after_commit')
+def count_commit(session):
+    unit = _current.get()
+    if unit is not None:
+        unit.commits += 1
+
+
+class UnitOfWork:
+    def __init__(self, engine, name: str):
+        self.engine = engine
+        self.name = name
+
+        self.statements = 0
+        self.commits = 0
+        self.has_writes = False
+        self.session_ids: Set[int] = set()
+
+        self._session: Optional[Session] = None
+        self._after_commit: List[Callable[[], None]] = []
+        self._token = None
+        self._started_at = perf_counter()
+
+        instrument(engine)
+
+    @property
+    def session(self) -> Session:
+        # session is opened on first use, handlers without database access don't open it
+        if self._session is None:
+            self._session = Session(self.engine, expire_on_commit=False)
+
+        return self._session
+
+    def commit(self):
+        """
+        Commit changes made so far, e.g. before slow network calls
+
+        :returns: None
+        """
+        if self._session is not None and self.has_writes:
+            self._session.commit()
+            self.has_writes = False
+
+        callbacks, self._after_commit = self._after_commit, []
+        for callback in callbacks:
+            callback()
+
+    def release(self):
+        """
+        Commit changes and return connection to pool, e.g. before long waits.
+        Next database access opens a new session
+
+        :returns: None
+        """
+        self.commit()
+
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+    def __enter__(self) -> 'UnitOfWork':
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.commit()
+            else:
+                # changes are not stored, so nobody is told about them
+                self._after_commit = []
+
+                if self._session is not None:
+                    self._session.rollback()
+        finally:
+            if self._session is not None:
+                self._session.close()
+
+            _current.reset(self._token)
+
+            metrics = _handler_metrics(self.name)
+            metrics['units'].inc()
+            metrics['sessions'].inc(len(self.session_ids))
+            metrics['statements'].inc(self.statements)
+            metrics['commits'].inc(self.commits)
+            metrics['seconds'].observe(perf_counter() - self._started_at)
+
+
+def commit():
+    """
+    Commit current unit of work, if there is one
+
+    :returns: None
+    """
+    unit = _current.get()
+    if unit is not None:
+        unit.commit()
+
+
+def release():
+    """
+    Commit current unit of work and close its session, if there is one
+
+    :returns: None
+    """
+    unit = _current.get()
+    if unit is not None:
+        unit.release()
+
+
+def after_commit(callback: Callable[[], None]):
+    """
+    Run callback after current unit of work is committed, it is dropped on rollback.
+    Without unit of work changes are already committed, so callback runs at once
+
+    :param callback: function without arguments
+
+    :returns: None
+    """
+    unit = _current.get()
+    if unit is None:
+        callback()
+    else:
+        unit._after_commit.append(callback)
+
+
+@contextmanager
+def session_scope(engine):
+    """
+    Get session of current unit of work or a new session, that is committed on exit.
+    Changes in session of unit of work are flushed and committed together with the unit
+
+    :param engine: database engine
+
+    :returns: context manager with session
+    """
+    unit = _current.get()
+
+    if unit is not None and unit.engine is engine:
+        yield unit.session
+        unit.session.flush()
+        return
+
+    # loaded rows stay readable after commit, as they do in unit of work
+    with Session(engine, expire_on_commit=False) as session:
+        yield session
+        session.commit()
+
+
+def transactional(engine, func: Callable, name: str = None) -> Callable:
+    """
+    Run handler in its own unit of work
+
+    :param engine: database engine
+    :param func: handler of update or request
+
+    :param name: name of handler in metrics, name of function by default
+
+    :returns: wrapped handler
+    """
+    name = name or func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with UnitOfWork(engine, name), profiler.maybe_profile(name):
+            return func(*args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,152 @@
+import os
+import threading
+from collections import deque
+from time import monotonic
+from typing import Callable, Deque, Dict, List, Optional, Set, Tuple
+
+from telebot import types
+
+from metrics import registry
+
+
+queue_depth_metric = registry.gauge('katyax_bot_queue_depth', 'Count of telegram updates waiting for worker')
+update_latency_metric = registry.histogram('katyax_bot_update_seconds', 'Time from receiving telegram update to end of its handling')
+failures_metric = registry.counter('katyax_bot_update_failures_total', 'Count of telegram updates failed in handler')
+backpressure_metric = registry.counter('katyax_bot_backpressure_total', 'Count of times receiving of updates waited for full queue')
+
+
+def chat_key(update: types.Update) -> int:
+    """
+    Get key, which orders updates of one chat
+
+    :param update: telegram update
+
+    :returns: chat id, user id or update id for updates without chat
+    """
+    if update.message is not None:
+        return update.message.chat.id
+
+    if update.edited_message is not None:
+        return update.edited_message.chat.id
+
+    if update.callback_query is not None:
+        query = update.callback_query
+        return query.message.chat.id if query.message is not None else query.from_user.id
+
+    # updates of other types don't depend on each other
+    return -update.update_id
+
+
+class UpdateDispatcher:
+    def __init__(self, process: Callable[[List[types.Update]], None], workers: int = None, queue_size: int = None):
+        self.process = process
+        self.workers = max(1, workers or int(os.getenv('BOT_WORKERS', 8)))
+        self.queue_size = max(1, queue_size or int(os.getenv('BOT_QUEUE_SIZE', 1000)))
+
+        # updates of one chat are handled one by one in order of receiving
+        self._queues: Dict[int, Deque[Tuple[types.Update, float]]] = {}
+        self._busy: Set[int] = set()
+        self._depth = 0
+
+        self._cond = threading.Condition()
+        self._threads: List[threading.Thread] = []
+        self._stopped = False
+
+    def start(self):
+        with self._cond:
+            if self._threads:
+                return
+
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f'bot-worker-{i}', daemon=True)
+                self._threads.append(thread)
+                thread.start()
+
+    def close(self, timeout: float = None):
+        """
+        Stop workers after queued updates are handled
+
+        :param timeout: time to wait for queued updates
+
+        :returns: None
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._depth == 0 and not self._busy, timeout)
+            self._stopped = True
+            self._cond.notify_all()
+
+    def dispatch(self, updates: List[types.Update], timeout: float = None) -> bool:
+        """
+        Queue updates for workers, waits while queue is full
+
+        :param updates: telegram updates
+
+        :param timeout: time to wait for free place in queue, waits without limit if None
+
+        :returns: False if queue stayed full and the rest of updates was not queued
+        """
+        self.start()
+
+        for update in updates:
+            with self._cond:
+                # receiving stops until workers catch up, telegram keeps the rest of updates
+                if self._depth >= self.queue_size:
+                    backpressure_metric.inc()
+
+                    if not self._cond.wait_for(lambda: self._depth < self.queue_size or self._stopped, timeout):
+                        return False
+
+                self._queues.setdefault(chat_key(update), deque()).append((update, monotonic()))
+
+                self._depth += 1
+                queue_depth_metric.set(self._depth)
+                self._cond.notify_all()
+
+        return True
+
+    def _next(self) -> Optional[Tuple[int, types.Update, float]]:
+        # oldest update of chat, which is not handled by other worker
+        with self._cond:
+            while not self._stopped:
+                ready = [k for k, v in self._queues.items() if v and k not in self._busy]
+
+                if ready:
+                    key = min(ready, key=lambda x: self._queues[x][0][1])
+                    self._busy.add(key)
+
+                    self._depth -= 1
+                    queue_depth_metric.set(self._depth)
+                    self._cond.notify_all()
+
+                    update, received_at = self._queues[key].popleft()
+                    return key, update, received_at
+
+                self._cond.wait()
+
+        return None
+
+    def _done(self, key: int):
+        with self._cond:
+            self._busy.discard(key)
+
+            if not self._queues[key]:
+                del self._queues[key]
+
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            item = self._next()
+            if item is None:
+                return
+
+            key, update, received_at = item
+
+            try:
+                self.process([update])
+            except Exception as e:
+                failures_metric.inc()
+                print(f'Failed to handle update {update.update_id} of chat {key}: {e}')
+            finally:
+                update_latency_metric.observe(monotonic() - received_at)
+                self._done(key)
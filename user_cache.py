@@ -0,0 +1,145 @@
+import os
+import threading
+from collections import OrderedDict
+from time import monotonic
+from typing import Dict, Iterable, Optional, Tuple
+
+from sqlmodel import select
+
+from metrics import registry
+from schemes import User
+from unit_of_work import session_scope
+
+
+user_cache_hits_metric = registry.counter('katyax_user_cache_hits_total', 'Count of users found in cache')
+user_cache_misses_metric = registry.counter('katyax_user_cache_misses_total', 'Count of users loaded from database')
+user_cache_size_metric = registry.gauge('katyax_user_cache_size', 'Count of cached users')
+
+
+class UserCache:
+    def __init__(self, engine, max_size: int = None, ttl: float = None):
+        self.engine = engine
+        self.max_size = max_size if max_size is not None else int(os.getenv('USER_CACHE_SIZE', 10000))
+        self.ttl = ttl if ttl is not None else float(os.getenv('USER_CACHE_TTL', 300))
+
+        # cached rows are detached copies, changes must be written to database and put back
+        self._entries: 'OrderedDict[int, Tuple[User, float]]' = OrderedDict()
+        self._telegram_ids: Dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def copy(user: User) -> User:
+        return User(**user.as_dict())
+
+    def _get_cached(self, user_id: int) -> Optional[User]:
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+
+        user, expires_at = entry
+        if expires_at < monotonic():
+            self._remove(user_id)
+            return None
+
+        self._entries.move_to_end(user_id)
+        return user
+
+    def _remove(self, user_id: int):
+        user, _ = self._entries.pop(user_id)
+        self._telegram_ids.pop(user.telegram_id, None)
+
+    def put(self, user: User) -> User:
+        """
+        Put user row to cache, evicting least recently used users
+
+        :param user: user loaded from database
+
+        :returns: cached copy of user
+        """
+        user = self.copy(user)
+
+        if self.max_size <= 0:
+            return user
+
+        with self._lock:
+            if user.id in self._entries:
+                self._remove(user.id)
+
+            self._entries[user.id] = (user, monotonic() + self.ttl)
+            self._telegram_ids[user.telegram_id] = user.id
+
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+            user_cache_size_metric.set(len(self._entries))
+
+        return user
+
+    def get_many(self, user_ids: Iterable[int]) -> Dict[int, User]:
+        """
+        Get users by ids, missing users are loaded by one query
+
+        :param user_ids: ids of users
+
+        :returns: users by id, unknown ids are skipped
+        """
+        user_ids = {int(x) for x in user_ids}
+
+        with self._lock:
+            users = {x: self._get_cached(x) for x in user_ids}
+            users = {k: v for k, v in users.items() if v is not None}
+
+        missing = user_ids - set(users)
+        user_cache_hits_metric.inc(len(users))
+
+        if missing:
+            user_cache_misses_metric.inc(len(missing))
+
+            with session_scope(self.engine) as session:
+                for user in session.exec(select(User).where(User.id.in_(missing))).all():
+                    users[user.id] = self.put(user)
+
+        return users
+
+    def get(self, user_id: int) -> Optional[User]:
+        return self.get_many([user_id]).get(int(user_id))
+
+    def get_by_telegram_id(self, telegram_id: int) -> Optional[User]:
+        """
+        Get user by telegram id
+
+        :param telegram_id: telegram user id
+
+        :returns: user or None
+        """
+        with self._lock:
+            user_id = self._telegram_ids.get(int(telegram_id))
+            user = self._get_cached(user_id) if user_id is not None else None
+
+        if user is not None:
+            user_cache_hits_metric.inc()
+            return user
+
+        user_cache_misses_metric.inc()
+
+        with session_scope(self.engine) as session:
+            user = session.exec(select(User).where(User.telegram_id == telegram_id)).first()
+
+            return self.put(user) if user is not None else None
+
+    def invalidate(self, user_id: int = None):
+        """
+        Drop user from cache
+
+        :param user_id: id of user, all users are dropped if None
+
+        :returns: None
+        """
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+                self._telegram_ids.clear()
+            elif int(user_id) in self._entries:
+                self._remove(int(user_id))
+
+            user_cache_size_metric.set(len(self._entries))
@@ -0,0 +1,170 @@
+import threading
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional
+
+from sqlmodel import select
+
+from schemes import User, UserTicket, get_open_ticket
+from unit_of_work import session_scope
+from user_cache import UserCache
+
+
+@dataclass
+class UserState:
+    telegram_id: int
+    user_id: Optional[int] = None
+    enable_echo: bool = False
+    ticket_id: Optional[str] = None
+    token: Optional[str] = None
+
+    @property
+    def in_conversation(self) -> bool:
+        return self.enable_echo and self.ticket_id is not None
+
+
+class UserStateStore:
+    def __init__(self, engine, users: UserCache, generate_token: Callable[[str, str, str], str]):
+        self.engine = engine
+        self.users = users
+        self.generate_token = generate_token
+
+        # only users in conversation with operator are kept, others have default state
+        self._states: Dict[int, UserState] = {}
+        self._lock = threading.Lock()
+
+    def rebuild(self) -> int:
+        """
+        Load states of users with echo mode or open tickets from database
+
+        :returns: count of loaded states
+        """
+        with session_scope(self.engine) as session:
+            users = session.exec(select(User).where(User.enable_echo == True)).all()
+            tickets = session.exec(select(UserTicket).where(UserTicket.is_solved == False).order_by(UserTicket.id)).all()
+
+            # users with open tickets may have echo disabled
+            known = {x.id for x in users}
+            missing = {x.user_id for x in tickets} - known
+            if missing:
+                users += session.exec(select(User).where(User.id.in_(missing))).all()
+
+            users = [self.users.put(x) for x in users]
+
+        # last opened ticket wins
+        open_tickets = {x.user_id: x.ticket_id for x in tickets}
+
+        states = {}
+        for user in users:
+            states[user.telegram_id] = self._make_state(user, open_tickets.get(user.id))
+
+        with self._lock:
+            self._states = states
+
+        return len(states)
+
+    def _make_state(self, user: User, ticket_id: Optional[str]) -> UserState:
+        token = self.generate_token(str(user.id), str(user.telegram_id), ticket_id) if ticket_id else None
+        return UserState(telegram_id=user.telegram_id, user_id=user.id, enable_echo=user.enable_echo, ticket_id=ticket_id, token=token)
+
+    def get(self, telegram_id: int) -> UserState:
+        """
+        Get state of user without database access
+
+        :param telegram_id: telegram user id
+
+        :returns: state of user
+        """
+        with self._lock:
+            state = self._states.get(int(telegram_id))
+
+        return state if state is not None else UserState(telegram_id=int(telegram_id))
+
+    def refresh(self, telegram_id: int) -> UserState:
+        """
+        Reload state of user from database, e.g. after ticket was closed by another process
+
+        :param telegram_id: telegram user id
+
+        :returns: state of user
+        """
+        user = self.users.get_by_telegram_id(telegram_id)
+        if user is not None:
+            # cached row may be stale too
+            self.users.invalidate(user.id)
+            user = self.users.get(user.id)
+
+        if user is None:
+            return self.forget(telegram_id)
+
+        with session_scope(self.engine) as session:
+            ticket = get_open_ticket(session, user.id)
+
+        state = self._make_state(user, ticket.ticket_id if ticket else None)
+        self._set(state)
+
+        return state
+
+    def set_echo(self, telegram_id: int, enable_echo: bool) -> Optional[User]:
+        """
+        Write echo status of user to database and state
+
+        :param telegram_id: telegram user id
+
+        :param enable_echo: new echo status
+
+        :returns: updated user
+        """
+        with session_scope(self.engine) as session:
+            user = session.exec(select(User).where(User.telegram_id == telegram_id)).first()
+            if user is None:
+                return None
+
+            user.enable_echo = enable_echo
+            session.add(user)
+            session.flush()
+
+            user = self.users.put(user)
+
+        state = self.get(user.telegram_id)
+        state.user_id = user.id
+        state.enable_echo = enable_echo
+
+        # ticket is closed together with echo mode
+        if not enable_echo:
+            state.ticket_id = None
+            state.token = None
+
+        self._set(state)
+        return user
+
+    def open_ticket(self, user: User, ticket_id: str) -> UserState:
+        """
+        Remember ticket opened for user, echo status is set separately
+
+        :param user: user
+        :param ticket_id: id of ticket
+
+        :returns: state of user
+        """
+        state = self._make_state(user, ticket_id)
+        state.enable_echo = self.get(user.telegram_id).enable_echo
+
+        self._set(state)
+        return state
+
+    def renew_token(self, state: UserState) -> str:
+        state.token = self.generate_token(str(state.user_id), str(state.telegram_id), state.ticket_id)
+        return state.token
+
+    def forget(self, telegram_id: int) -> UserState:
+        with self._lock:
+            self._states.pop(int(telegram_id), None)
+
+        return UserState(telegram_id=int(telegram_id))
+
+    def _set(self, state: UserState):
+        with self._lock:
+            if state.enable_echo or state.ticket_id is not None:
+                self._states[state.telegram_id] = state
+            else:
+                self._states.pop(state.telegram_id, None)
@@ -1,13 +1,71 @@
 import jwt
+import hmac
+import json
+import base64
 import datetime
-from flask import Flask, request, jsonify, render_template
+import threading
+from flask import Flask, Response, g, request, jsonify, render_template
 from werkzeug.exceptions import Unauthorized, NotAcceptable, Forbidden, BadRequest, NotFound
 from dataclasses import asdict
-from schemes import User, Message, UserTicket, ConversationThread, create_conversation_table, add_conversation_message, get_conversation_messages
-from sqlmodel import Session, select
+from telebot import types
+from schemes import UserTicket, ConversationThread, add_conversation_message, get_conversation_messages, get_conversation_page
+from sqlmodel import select
+from unit_of_work import commit, release, session_scope, transactional
 import os
-from typing import Dict, List
-from time import sleep
+from typing import Callable, Dict, List, Optional, Tuple
+from time import perf_counter
+from hub import TicketHub
+from message_store import Cursor, MessageStore, message_key
+from user_cache import UserCache
+from bus import create_bus
+from instrumentation import profiler, timed
+from metrics import registry
+
+
+stream_connections_metric = registry.gauge('katyax_stream_connections', 'Count of open operator event streams')
+streams_rejected_metric = registry.counter('katyax_stream_rejected_total', 'Count of operator event streams rejected over connection limit')
+stream_fanout_metric = registry.histogram('katyax_stream_fanout_seconds', 'Time from ticket notification to event written to stream')
+
+
+def bad_request(message: str) -> BadRequest:
+    # response of exception is sent as is, so it carries status code itself
+    response = jsonify({'error': message})
+    response.status_code = 400
+
+    return BadRequest(response=response)
+
+
+class TelegramWebhook(Flask):
+    """
+    Receives telegram updates on own server, so operator streams and long polls
+    don't take threads, which receive updates
+    """
+
+    def __init__(self, name, path: str, secret: str, receive: Callable[..., bool]):
+        super().__init__(name)
+
+        # secret token is sent by telegram in header of every request
+        self.secret = secret
+
+        # queues updates, returns False if they were not queued
+        self.receive_updates = receive
+
+        self.add_url_rule(path, 'telegram_webhook', self.telegram_webhook, methods=['POST'])
+
+    def telegram_webhook(self):
+        token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(token.encode(), self.secret.encode()):
+            return jsonify({'error': 'invalid secret token'}), 403
+
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict) or 'update_id' not in data:
+            return jsonify({'error': 'invalid update'}), 400
+
+        # update is answered at once and handled by bot workers, telegram retries it, if queue is full
+        if not self.receive_updates([types.Update.de_json(data)], 0):
+            return jsonify({'error': 'queue is full'}), 503
+
+        return jsonify({'status': 'ok'})
 
 
 class WebServer(Flask):
@@ -16,28 +74,79 @@ class WebServer(Flask):
         self.secret = os.getenv('FLASK_SECRET')
         self.engine = engine
         self.bot = bot_cls
+
+        # cache is shared with the bot, if both run in one process
+        self.users: UserCache = getattr(bot_cls, 'users', None) or UserCache(self.engine)
         
         self.set_routers()
 
-        self.messages: Dict[str, List[ConversationThread]] = {}
+        self.messages = MessageStore(self.engine)
+        self.hub = TicketHub()
+
+        # every stream holds a thread of server, the rest of threads serve other requests
+        threads = int(os.getenv('FLASK_THREADS', 10))
+        self.max_streams = int(os.getenv('STREAM_MAX_CONNECTIONS', max(1, threads // 2)))
+        self._streams = 0
+        self._streams_lock = threading.Lock()
+
+        # messages of one ticket are stored and published one by one, so they reach operators in order of id
+        self._ticket_locks = [threading.Lock() for _ in range(64)]
+
+        # messages of all web workers and the bot come through the bus
+        self.bus = create_bus(self.engine)
+        self.bus.subscribe(self.on_bus_message)
 
     def set_routers(self):
-        self.add_url_rule('/<token>', 'chat', self.chat, methods=['GET'])
-        self.add_url_rule('/<token>/get_messages', 'get_messages', self.chat, methods=['GET'])
-        self.add_url_rule('/<token>/store_user_message', 'store_user_message', self.store_user_message, methods=['POST'])
-        self.add_url_rule('/<token>/send_message', 'send_message', self.send_message, methods=['POST'])
-        self.add_url_rule('/<token>/close_thread', 'close_thread', self.close_thread, methods=['GET'])
-        self.add_url_rule('/<token>/polling/<timestamp>', 'polling', self.polling, methods=['GET'])
-        self.add_url_rule('/<token>/get_timestamp', 'get_timestamp', self.get_timestamp, methods=['GET'])
+        # every request is handled in one session and one transaction
+        def unit(view):
+            return transactional(self.engine, view, 'web.' + view.__name__)
+
+        self.add_url_rule('/<token>', 'chat', unit(self.chat), methods=['GET'])
+        self.add_url_rule('/<token>/get_messages', 'get_messages', unit(self.chat), methods=['GET'])
+        self.add_url_rule('/<token>/store_user_message', 'store_user_message', unit(self.store_user_message), methods=['POST'])
+        self.add_url_rule('/<token>/send_message', 'send_message', unit(self.send_message), methods=['POST'])
+        self.add_url_rule('/<token>/close_thread', 'close_thread', unit(self.close_thread), methods=['GET'])
+        self.add_url_rule('/<token>/polling/<cursor>', 'polling', unit(self.polling), methods=['GET'])
+        # stream outlives its view, every read of the stream opens own session
+        self.add_url_rule('/<token>/stream', 'stream', self.stream, methods=['GET'])
+        self.add_url_rule('/<token>/history', 'history', unit(self.history), methods=['GET'])
+
+        # single request is profiled by secret header, /metrics and /profile are served on internal port by serve_metrics
+        if os.getenv('PROFILE_SECRET'):
+            self.before_request(self.start_request_profile)
+            self.teardown_request(self.stop_request_profile)
+
+    def on_bus_message(self, ticket_id, message: ConversationThread):
+        # tickets, which are not opened in this process, are loaded from db on demand
+        if self.messages.append(ticket_id, message):
+            self.hub.notify(ticket_id)
+
+    def is_profile_allowed(self) -> bool:
+        secret = request.headers.get('X-Profile-Secret', '')
+        return hmac.compare_digest(secret.encode(), os.getenv('PROFILE_SECRET').encode())
+
+    def start_request_profile(self):
+        if self.is_profile_allowed():
+            g.profile_token = profiler.request()
+
+    def stop_request_profile(self, exc):
+        token = g.pop('profile_token', None)
+        if token is not None:
+            profiler.reset(token)
+
+    def ticket_lock(self, ticket_id) -> threading.Lock:
+        return self._ticket_locks[hash(ticket_id) % len(self._ticket_locks)]
 
     def generate_token(self, user_id, telegram_id, ticket_id):
         minutes = int(os.getenv('TOKEN_EXPIRE_MINUTES'))
-        token = jwt.encode({'user_id': user_id, 'telegram_id': telegram_id, 'ticket_id': ticket_id, 'exp': datetime.datetime.utcnow() + datetime.timedelta(minutes=minutes)}, self.secret, algorithm="HS256")
+        with timed('jwt.encode'):
+            token = jwt.encode({'user_id': user_id, 'telegram_id': telegram_id, 'ticket_id': ticket_id, 'exp': datetime.datetime.utcnow() + datetime.timedelta(minutes=minutes)}, self.secret, algorithm="HS256")
         return token
 
     def verify_token(self, token):
         try:
-            data = jwt.decode(token, self.secret, options={"require": ["user_id", "telegram_id", "ticket_id"]}, algorithms=["HS256"])
+            with timed('jwt.verify'):
+                data = jwt.decode(token, self.secret, options={"require": ["user_id", "telegram_id", "ticket_id"]}, algorithms=["HS256"])
             return data
             
         except jwt.ExpiredSignatureError:
@@ -57,64 +166,83 @@ class WebServer(Flask):
         message = request.args.get('message')
         date = request.args.get('date')
 
-        id_ = add_conversation_message(self.engine, ticket_id, user_id, date, message)
-        conv_message = ConversationThread(id=id_, user_id=user_id, message=message, date=date)
-        
-        self.messages[ticket_id].append(conv_message)
+        status = self.ingest_user_message(ticket_id, user_id, message, date)
 
-        return jsonify({'status': 'ok'})
+        return jsonify({'status': status})
+
+    def ingest_user_message(self, ticket_id, user_id, message, date) -> str:
+        """
+        Store message of user to ticket and publish it to operators
+
+        :param ticket_id: id of ticket
+        :param user_id: id of user
+
+        :param message: text of message
+        :param date: timestamp of message
+
+        :returns: ok or closed, if ticket is already closed
+        """
+        # message keeps its telegram date, operators receive messages in order of id
+        date = float(date) if date else datetime.datetime.now().timestamp()
+
+        with self.ticket_lock(ticket_id):
+            # bot keeps echo mode in memory, it falls back to answering, if ticket was closed here
+            ticket = self.lock_ticket(ticket_id)
+            if ticket is None or ticket.is_solved:
+                return 'closed'
+
+            id_ = add_conversation_message(self.engine, ticket_id, user_id, date, message)
+            conv_message = ConversationThread(id=id_, user_id=user_id, message=message, date=date)
+
+            # message is delivered after commit, before the next message of ticket is stored
+            self.bus.publish(ticket_id, conv_message)
+            commit()
+
+        return 'ok'
+
+    def lock_ticket(self, ticket_id) -> Optional[UserTicket]:
+        # row lock keeps writers of ticket in other processes waiting until commit, so ids of messages follow commits
+        with session_scope(self.engine) as session:
+            return session.exec(select(UserTicket).where(UserTicket.ticket_id == ticket_id).with_for_update()).first()
 
     def send_message(self, token):
         token_data = self.verify_token(token)
         ticket_id = token_data['ticket_id']
 
-        # get ticket status from db
-        with Session(self.engine) as session:
-            ticket = select(UserTicket).where(UserTicket.ticket_id == ticket_id)
-            ticket = session.exec(ticket).first()
-
-        # if ticket is closed, return error
-        if ticket.is_solved == True:
-            raise NotFound(response=jsonify({'error': 'ticket is closed'}))
-
         message = request.form.get('message')
 
         if message is None or message == '':
             raise BadRequest(response=jsonify({'error': 'message is required and must be not null'}))
 
-        # remove chars that notsql can't handle
-        message = message.replace("'", '"')
-
         user_id = token_data['user_id']
-        date = datetime.datetime.now().timestamp()
-        conv_message_id = add_conversation_message(self.engine, ticket_id, user_id, date, message)
-        conv_message = ConversationThread(id=conv_message_id, user_id=user_id, date=date, message=message)
-        
-        self.messages[ticket_id].append(conv_message)
+
+        with self.ticket_lock(ticket_id):
+            # if ticket is closed, return error
+            if self.lock_ticket(ticket_id).is_solved == True:
+                raise NotFound(response=jsonify({'error': 'ticket is closed'}))
+
+            date = datetime.datetime.now().timestamp()
+            conv_message_id = add_conversation_message(self.engine, ticket_id, user_id, date, message)
+            conv_message = ConversationThread(id=conv_message_id, user_id=user_id, date=date, message=message)
+
+            self.bus.publish(ticket_id, conv_message)
+            commit()
 
         if self.bot is not None:
             user_id = ticket_id.split('_')[1]
-
-            # get user from db
-            with Session(self.engine) as session:
-                user = session.exec(select(User).where(User.id == user_id)).one()
+            user = self.users.get(int(user_id))
 
             # send message to bot
             self.bot.send_echo_message(int(user.telegram_id), message)
 
         return jsonify({'status': 'ok'})
 
-    def get_timestamp(self, token):
-        self.verify_token(token)
-
-        return jsonify({'timestamp': datetime.datetime.now().timestamp()})
-
     def close_thread(self, token):
         token_data = self.verify_token(token)
         ticket_id = token_data['ticket_id']
 
         # get ticket status from db
-        with Session(self.engine) as session:
+        with session_scope(self.engine) as session:
             ticket = select(UserTicket).where(UserTicket.ticket_id == ticket_id)
             ticket = session.exec(ticket).first()
 
@@ -123,102 +251,221 @@ class WebServer(Flask):
             raise NotFound(response=jsonify({'error': 'ticket is closed'}))
 
         # close ticket
-        with Session(self.engine) as session:
+        with session_scope(self.engine) as session:
             ticket.is_solved = True
             session.add(ticket)
-            session.commit()
+
+        # closed ticket is not kept in memory, waiting pollers are woken up
+        self.messages.evict(ticket_id, closed=True)
+        self.hub.discard(ticket_id)
 
         # disable echo bot for user
         if self.bot is not None:
             user_id = ticket_id.split('_')[1]
+            user = self.users.get(int(user_id))
 
-            with Session(self.engine) as session:
-                user = session.exec(select(User).where(User.id == user_id)).one()
-            
             # disable echo bot for user
             self.bot.set_echo_status(int(user.telegram_id), False)
+            commit()
 
             # send message to bot
             self.bot.send_echo_message(int(user.telegram_id), 'Оператор завершил чат, бот снова доступен')
 
         return jsonify({'status': 'ok'})
 
-    def polling(self, token, timestamp):
+    def polling(self, token, cursor):
         token_data = self.verify_token(token)
         ticket_id = token_data['ticket_id']
 
-        if ticket_id not in self.messages:
-            return jsonify({'timestamp': datetime.datetime.now().timestamp(), 'ticket_id': ticket_id, 'messages': []})
-
-        new_messages: List[ConversationThread] = []
         wait_for = request.args.get('wait_for', 20)
 
-        end_time = datetime.datetime.now().timestamp() + int(wait_for)
-        
-        while len(new_messages) == 0:
-            for message in self.messages[ticket_id]:
-                if float(message.date) >= float(timestamp):
-                    new_messages.append(message)
+        # sleep until store_user_message or send_message notifies the ticket
+        key = self.decode_cursor(cursor)
+        new_messages, notified_at = self.wait_messages(ticket_id, key, int(wait_for))
 
-            if datetime.datetime.now().timestamp() > end_time:
-                break
+        # next poll continues after the last delivered message
+        if new_messages:
+            cursor = self.encode_cursor(new_messages[-1])
 
-            sleep(.0000001)
+        closed = not new_messages and self.is_ticket_solved(ticket_id)
 
+        # authors of new messages are taken from cache
+        users = {k: v.as_dict() for k, v in self.users.get_many(x.user_id for x in new_messages).items()}
         new_messages = [asdict(x) for x in new_messages]
-        
-        # from user ids in new_messages, get users from database
-        with Session(self.engine) as session:
-            users = session.exec(select(User)).all()
 
-        # get all users from conversaion
-        users = [x for x in users if str(x.id) in [str(y["user_id"]) for y in new_messages]]
-        users = [x.as_dict() for x in users]
-        users = {x['id']: x for x in users}
+        response = jsonify({'cursor': cursor, 'closed': closed, 'ticket_id': ticket_id, 'messages': new_messages, 'users': users})
+        self.hub.observe_response(notified_at)
 
-        return jsonify({'timestamp': datetime.datetime.now().timestamp(), 'ticket_id': ticket_id, 'messages': new_messages, 'users': users})
+        return response
 
-    def _get_messages(self, ticket_id):
-        # get conversation from db
-        conversation = get_conversation_messages(self.engine, ticket_id)
+    def wait_messages(self, ticket_id, cursor: Cursor, timeout: float) -> Tuple[List[ConversationThread], Optional[float]]:
+        """
+        Wait for messages of ticket after cursor
 
-        # get users by user_id from db
-        with Session(self.engine) as session:
-            users = session.exec(select(User)).all()
+        :param ticket_id: id of ticket
+        :param cursor: (date, id) of last delivered message
 
-        # get all users from conversaion
-        users = [x for x in users if x.id in [y.user_id for y in conversation]]
-        
-        self.messages[ticket_id] = conversation
+        :param timeout: timeout in seconds
+
+        :returns: new messages and time of notification, which woke up the waiter
+        """
+        # buffer is loaded and older messages are read from database outside of hub lock
+        new_messages = self.messages.since(ticket_id, cursor)
+        if new_messages:
+            return new_messages, None
+
+        # transaction and connection of request are not held while waiting
+        release()
+
+        # under hub lock messages are only read from memory
+        new_messages, notified_at = self.hub.wait(ticket_id, lambda: self.messages.peek(ticket_id, cursor), timeout)
+        return new_messages or [], notified_at
 
-        # return all messages from conversation
-        return conversation, users
-    
-    def get_messages(self, token):
+    def is_ticket_solved(self, ticket_id) -> bool:
+        with session_scope(self.engine) as session:
+            return bool(session.exec(select(UserTicket.is_solved).where(UserTicket.ticket_id == ticket_id)).first())
+
+    def stream(self, token):
+        # token is verified once per connection instead of once per message
         token_data = self.verify_token(token)
         ticket_id = token_data['ticket_id']
 
-        messages, users = self._get_messages(token, ticket_id)
-        
-        return jsonify({'messages': [asdict(x) for x in messages]})
+        # browser reconnects with id of the last received event, so nothing is sent twice
+        last_event_id = request.headers.get('Last-Event-ID')
+        cursor = last_event_id or request.args.get('cursor')
+        start = self.decode_cursor(cursor) if cursor else self.latest_cursor(ticket_id)
+
+        # no content tells browser to stop reconnecting
+        if self.is_ticket_solved(ticket_id):
+            return Response(status=204)
+
+        # browser doesn't reconnect after error status, page falls back to polling
+        with self._streams_lock:
+            if self._streams >= self.max_streams:
+                streams_rejected_metric.inc()
+                return jsonify({'error': 'too many streams'}), 503
+
+            self._streams += 1
+
+        heartbeat = float(os.getenv('STREAM_HEARTBEAT', 10))
+        expires_at = float(token_data.get('exp', 'inf'))
+
+        def events():
+            stream_connections_metric.inc()
+
+            try:
+                cursor = start
+
+                yield 'retry: 3000\n\n'
+
+                while True:
+                    timeout = min(heartbeat, expires_at - datetime.datetime.now().timestamp())
+                    if timeout <= 0:
+                        yield 'event: closed\ndata: {"reason": "token expired"}\n\n'
+                        return
+
+                    new_messages, notified_at = self.wait_messages(ticket_id, cursor, timeout)
+
+                    if not new_messages:
+                        # closed ticket gets no more messages, stream is ended after the last of them
+                        if self.is_ticket_solved(ticket_id):
+                            yield 'event: closed\ndata: {"reason": "ticket closed"}\n\n'
+                            return
+
+                        yield ': keep-alive\n\n'
+                        continue
+
+                    cursor = message_key(new_messages[-1])
+
+                    users = self.users.get_many(x.user_id for x in new_messages)
+
+                    data = json.dumps({
+                        'ticket_id': ticket_id,
+                        'messages': [asdict(x) for x in new_messages],
+                        'users': {k: v.as_dict() for k, v in users.items()},
+                    }, default=str)
+
+                    if notified_at is not None:
+                        stream_fanout_metric.observe(perf_counter() - notified_at)
+
+                    yield f'id: {self.encode_cursor(new_messages[-1])}\nevent: messages\ndata: {data}\n\n'
+            finally:
+                stream_connections_metric.dec()
+
+        def release():
+            with self._streams_lock:
+                self._streams -= 1
+
+        # closing response releases the slot, even if the stream was never read
+        response = Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+        response.call_on_close(release)
+
+        return response
+
+    @staticmethod
+    def encode_cursor(message: Optional[ConversationThread]) -> str:
+        # cursor is opaque for clients, it points to the oldest loaded or the last delivered message, None is before all messages
+        key = message_key(message) if message is not None else (0.0, 0)
+        data = json.dumps(list(key)).encode('utf-8')
+        return base64.urlsafe_b64encode(data).decode('ascii')
+
+    @staticmethod
+    def decode_cursor(cursor: str) -> Tuple[float, int]:
+        try:
+            date, id_ = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+            return float(date), int(id_)
+        except (ValueError, TypeError):
+            raise bad_request('invalid cursor')
+
+    def latest_cursor(self, ticket_id) -> Cursor:
+        messages, _ = get_conversation_messages(self.engine, ticket_id, limit=1)
+        return message_key(messages[-1]) if messages else (0.0, 0)
+
+    def _get_page(self, ticket_id, cursor: str = None, limit: int = None) -> Tuple[List[ConversationThread], Dict[int, dict], Optional[str]]:
+        limit = limit or int(os.getenv('CHAT_PAGE_SIZE', 50))
+        before = self.decode_cursor(cursor) if cursor else None
+
+        messages, has_more = get_conversation_page(self.engine, ticket_id, before, limit)
+
+        users = {k: v.as_dict() for k, v in self.users.get_many(x.user_id for x in messages).items()}
+        next_cursor = self.encode_cursor(messages[0]) if has_more else None
+
+        return messages, users, next_cursor
+
+    def history(self, token):
+        token_data = self.verify_token(token)
+        ticket_id = token_data['ticket_id']
+
+        try:
+            limit = int(request.args.get('limit', os.getenv('CHAT_PAGE_SIZE', 50)))
+        except ValueError:
+            raise bad_request('limit must be integer')
+
+        limit = max(1, min(limit, 500))
+        messages, users, cursor = self._get_page(ticket_id, request.args.get('cursor'), limit)
+
+        return jsonify({'ticket_id': ticket_id, 'messages': [asdict(x) for x in messages], 'users': users, 'cursor': cursor})
 
     def chat(self, token):
         token_data = self.verify_token(token)
         ticket_id = token_data["ticket_id"]
 
-        messages, users = self._get_messages(ticket_id)
-        messages = [asdict(x) for x in messages]
-        users = [x.as_dict() for x in users]
-        users = {x['id']: x for x in users}
-
         # get ticket status
-        with Session(self.engine) as session:
+        with session_scope(self.engine) as session:
             ticket = select(UserTicket).where(UserTicket.ticket_id == ticket_id)
             ticket = session.exec(ticket).first()
 
+        # only the latest page is rendered, older messages are loaded on scroll
+        messages, users, cursor = self._get_page(ticket_id)
+
+        # new messages are delivered after the last stored one, messages of ticket are stored in order of id
+        live_cursor = self.encode_cursor(max(messages, key=lambda x: x.id, default=None))
+
+        messages = [asdict(x) for x in messages]
+
         # render template of index.html
-        return render_template('index.html', ticket_id=ticket_id, token=token, 
-        messages=messages, users=users, is_solved=ticket.is_solved, host=os.getenv('REMOTE_ADDR'), port=os.getenv('FLASK_PORT'))
+        return render_template('index.html', ticket_id=ticket_id, token=token, live_cursor=live_cursor,
+        messages=messages, users=users, cursor=cursor, is_solved=ticket.is_solved, host=os.getenv('REMOTE_ADDR'), port=os.getenv('FLASK_PORT'))
 
     def run(self, host=None, port=None, debug=None, load_dotenv=True, **options):
         super().run(host, port, debug, load_dotenv, **options)